@@ -0,0 +1,184 @@
+import itertools
+import json
+import math
+
+from astropy import units
+
+from .cursors import encode_cursor, seek_querysets
+from .models import FoldedLightcurve, Star
+
+
+API_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+API_DEFAULT_FORMAT = 'ndjson'
+
+# The column each API field is read from
+API_FIELDS = {
+    'superwasp_id': 'superwasp_id',
+    'period_length': 'period_length',
+    'ra': '_ra',
+    'dec': '_dec',
+    'max_magnitude': 'max_magnitude',
+    'min_magnitude': 'min_magnitude',
+    'mean_magnitude': 'mean_magnitude',
+    'classification': 'classification',
+    'classification_count': 'classification_count',
+    'period_uncertainty': 'period_uncertainty',
+    'sigma': 'sigma',
+    'chi_squared': 'chi_squared',
+}
+# Only available for cone searches, in degrees
+DISTANCE_FIELD = 'distance'
+
+API_DEFAULT_LIMIT = 1000
+API_MAX_LIMIT = 100000
+API_CHUNK_SIZE = 2000
+
+
+def parse_fields(fields_param, distance=False):
+    """
+    Returns the API fields named in a comma separated fields param, or every
+    field if it's empty. Raises ValueError for unknown fields.
+    """
+    available = list(API_FIELDS)
+    if distance:
+        available.append(DISTANCE_FIELD)
+    if not fields_param:
+        return available
+
+    fields = []
+    for field in fields_param.split(','):
+        field = field.strip()
+        if field not in available:
+            raise ValueError(f'Unknown field: {field}')
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+
+def parse_limit(limit_param):
+    """
+    Returns the number of rows to stream, capped at API_MAX_LIMIT. Raises
+    ValueError if it isn't a positive integer.
+    """
+    if not limit_param:
+        return API_DEFAULT_LIMIT
+    limit = int(limit_param)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, API_MAX_LIMIT)
+
+
+def json_value(value):
+    # Magnitudes can be NaN, which isn't valid JSON
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class CatalogueStream(object):
+    """
+    Streams up to limit catalogue rows as JSON, ordered by (sort_column, pk)
+    and starting after the row whose (value, pk) is given. Rows are read
+    from a server-side cursor in chunks, so memory use doesn't grow with the
+    number of rows. Once the rows have been read, next_cursor is set if
+    there are more.
+    """
+
+    def __init__(self, queryset, fields, sort, order, sort_column, after=None, limit=API_DEFAULT_LIMIT,
+                 chunk_size=API_CHUNK_SIZE):
+        self.queryset = queryset
+        self.fields = fields
+        self.sort = sort
+        self.order = order
+        self.sort_column = sort_column
+        self.after = after
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.next_cursor = None
+
+    def rows(self):
+        columns = {API_FIELDS.get(field, field) for field in self.fields}
+        columns.update(('superwasp_id', self.sort_column, 'pk'))
+        if 'ra' in self.fields or 'dec' in self.fields:
+            columns.update(('_ra', '_dec'))
+        rows = itertools.chain.from_iterable(
+            queryset.values(*columns).iterator(chunk_size=self.chunk_size)
+            for queryset in seek_querysets(self.queryset, self.sort_column, self.order == 'desc', self.after)
+        )
+        # One more than the limit, to show whether there's another page
+        return itertools.islice(rows, self.limit + 1)
+
+    def records(self):
+        classifications = dict(FoldedLightcurve.CLASSIFICATION_CHOICES)
+        period_uncertainties = dict(FoldedLightcurve.PERIOD_UNCERTAINTY_CHOICES)
+        coords_fields = 'ra' in self.fields or 'dec' in self.fields
+
+        rows = self.rows()
+        count = 0
+        last = None
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                return
+
+            parsed_coords = {}
+            if coords_fields:
+                # Stars which haven't had their coordinates stored yet
+                missing_coords = [
+                    row['superwasp_id'] for row in chunk if row['_ra'] is None or row['_dec'] is None
+                ]
+                if missing_coords:
+                    coords = Star.parse_coords(missing_coords)
+                    for superwasp_id, ra_deg, ra, dec in zip(
+                        missing_coords,
+                        coords.ra.to_value(),
+                        coords.ra.to_string(units.hour),
+                        coords.dec.to_string(),
+                    ):
+                        # IDs which can't be parsed are NaN
+                        parsed_coords[superwasp_id] = (None, None) if math.isnan(ra_deg) else (ra, dec)
+
+            for row in chunk:
+                if count == self.limit:
+                    self.next_cursor = encode_cursor(self.sort, self.order, last[self.sort_column], last['pk'])
+                    return
+
+                values = {field: row[column] for field, column in API_FIELDS.items() if field in self.fields}
+                if row['superwasp_id'] in parsed_coords:
+                    values['ra'], values['dec'] = parsed_coords[row['superwasp_id']]
+                elif coords_fields and row['_ra'] == '':
+                    # Stored as empty when the ID couldn't be parsed
+                    values['ra'], values['dec'] = None, None
+                if 'classification' in values:
+                    values['classification'] = classifications.get(values['classification'])
+                if 'period_uncertainty' in values:
+                    values['period_uncertainty'] = period_uncertainties.get(values['period_uncertainty'])
+                if DISTANCE_FIELD in self.fields:
+                    values[DISTANCE_FIELD] = math.degrees(row[DISTANCE_FIELD])
+
+                yield {field: json_value(values[field]) for field in self.fields}
+                count += 1
+                last = row
+
+    def ndjson(self):
+        """
+        Yields one line per row. If there are more rows, the last line is
+        {"next_cursor": ...} rather than a row.
+        """
+        for record in self.records():
+            yield json.dumps(record) + '\n'
+        if self.next_cursor is not None:
+            yield json.dumps({'next_cursor': self.next_cursor}) + '\n'
+
+    def json(self):
+        """
+        Yields a single JSON object, {"results": [...], "next_cursor": ...}, in
+        pieces.
+        """
+        yield '{"results": ['
+        for i, record in enumerate(self.records()):
+            yield (', ' if i else '') + json.dumps(record)
+        yield '], "next_cursor": {}}}\n'.format(json.dumps(self.next_cursor))
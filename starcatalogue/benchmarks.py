@@ -0,0 +1,563 @@
+import csv
+import io
+import json
+import os
+import resource
+import statistics
+import tempfile
+import time
+
+import numpy
+
+from astropy import units
+import astropy.io.fits as fits
+from astropy.table import vstack
+from astropy.time import Time
+from astropy.timeseries import TimeSeries
+from astropy.units import Quantity
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from .lightcurves import _load_lightcurve, load_lightcurve, outlier_clip
+from .models import CatalogueEntry, DataExport, FoldedLightcurve, Star
+from .rendering import render_lightcurve
+from .stats import calculate_magnitudes
+from .tasks import (
+    EXPORT_CHUNK_SIZE,
+    export_chunks,
+    fold_lightcurve,
+    generate_export,
+    render_all_star_images,
+    write_export_zip,
+)
+
+
+BENCHMARKS = {}
+# Benchmarks which need a (throwaway) database with the synthetic catalogue
+DATABASE_BENCHMARKS = set()
+
+DEFAULT_CATALOGUE_SIZE = 10000
+FOLDS_PER_STAR = 2
+BROWSE_REPEATS = 5
+
+# The import commands, in the order they have to run, and their input files
+IMPORT_COMMANDS = (
+    ('importclassifications', 'class_top.csv'),
+    ('importlightcurves', 'results_total.dat'),
+    ('importzooniverse', 'superwasp-variable-stars-subjects.csv'),
+)
+
+
+def benchmark(name, database=False):
+    def register(func):
+        BENCHMARKS[name] = func
+        if database:
+            DATABASE_BENCHMARKS.add(name)
+        return func
+    return register
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def synthetic_superwasp_ids(count, seed=0):
+    rng = numpy.random.default_rng(seed)
+    ra = rng.uniform(0, 24 * 3600, count)
+    dec = rng.uniform(-89 * 3600, 89 * 3600, count)
+    for ra_s, dec_s in zip(ra, dec):
+        sign = '-' if dec_s < 0 else '+'
+        dec_s = abs(dec_s)
+        yield (
+            f'1SWASPJ{int(ra_s // 3600):02d}{int(ra_s % 3600 // 60):02d}{ra_s % 60:05.2f}'
+            f'{sign}{int(dec_s // 3600):02d}{int(dec_s % 3600 // 60):02d}{dec_s % 60:04.1f}'
+        )
+
+
+def write_synthetic_fits(path, points=10000, period=86400.0, seed=0):
+    """
+    Writes a WASP-style FITS lightcurve (TMID in seconds since the WASP
+    epoch, TAMFLUX2 in micro-vegas) of a sinusoidal variable with noise and
+    the occasional wild outlier.
+    """
+    rng = numpy.random.default_rng(seed)
+    tmid = numpy.sort(rng.uniform(0, 4 * 365 * 86400, points))
+    flux = 1000 + 200 * numpy.sin(2 * numpy.pi * tmid / period) + rng.normal(0, 20, points)
+    outliers = rng.random(points) < 0.001
+    flux[outliers] = rng.choice([-1e6, 1e6], outliers.sum())
+    fits.HDUList([
+        fits.PrimaryHDU(),
+        fits.BinTableHDU.from_columns([
+            fits.Column(name='TMID', format='J', array=tmid.astype(numpy.int32)),
+            fits.Column(name='TAMFLUX2', format='E', array=flux.astype(numpy.float32)),
+            fits.Column(name='TAMFLUX2_ERR', format='E', array=numpy.full(points, 20, dtype=numpy.float32)),
+        ]),
+    ]).writeto(path, overwrite=True)
+
+
+def synthetic_export_chunks(count, chunk_size=EXPORT_CHUNK_SIZE, seed=0):
+    rng = numpy.random.default_rng(seed)
+    classifications = [label for value, label in FoldedLightcurve.CLASSIFICATION_CHOICES]
+    period_uncertainties = [label for value, label in FoldedLightcurve.PERIOD_UNCERTAINTY_CHOICES]
+    superwasp_ids = synthetic_superwasp_ids(count, seed)
+    for offset in range(0, count, chunk_size):
+        size = min(chunk_size, count - offset)
+        ids = [next(superwasp_ids) for _ in range(size)]
+        coords = Star.parse_coords(ids)
+        mean_magnitudes = rng.uniform(8, 15, size)
+        yield list(zip(
+            ids,
+            rng.uniform(1e3, 1e7, size),
+            coords.ra.to_string(units.hour),
+            coords.dec.to_string(),
+            mean_magnitudes - 0.5,
+            mean_magnitudes + 0.5,
+            mean_magnitudes,
+            rng.choice(classifications, size),
+            rng.integers(1, 50, size),
+            rng.choice(period_uncertainties, size),
+            rng.uniform(0, 1, size),
+            rng.uniform(0, 10, size),
+        ))
+
+
+def time_export_zip(chunks, rows):
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as export_file:
+        write_export_zip(export_file, chunks, {'object_count': rows})
+        zip_bytes = export_file.tell()
+    seconds = time.perf_counter() - start
+    return {
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds,
+        'zip_bytes': zip_bytes,
+        'peak_rss_bytes': peak_rss(),
+        'peak_rss_growth_bytes': peak_rss() - rss_before,
+    }
+
+
+@benchmark('export_zip')
+def benchmark_export_zip(size=1000000):
+    """
+    Writes `size` synthetic in-memory rows through the export zip writer
+    alone, without the database, and reports the peak RSS of the process
+    afterwards.
+    """
+    return time_export_zip(synthetic_export_chunks(size), size)
+
+
+def legacy_render_lightcurve(x, y, title, xlabel):
+    """
+    The pyplot and seaborn image generation which LightcurveRenderer
+    replaced, kept as a baseline for the images benchmark.
+    """
+    import seaborn
+    from matplotlib import pyplot
+    from PIL import Image
+
+    fig = pyplot.figure()
+    plot = seaborn.scatterplot(
+        data={xlabel: x, 'flux': y},
+        x=xlabel,
+        y='flux',
+        alpha=0.5,
+        s=1,
+    )
+    plot.set_title(title)
+    image_data = ContentFile(b'')
+    fig.savefig(image_data)
+
+    thumbnail_data = ContentFile(b'')
+    thumbmail_image = Image.open(image_data)
+    thumbmail_image.thumbnail((100, 60))
+    thumbmail_image.save(thumbnail_data, format='png')
+    pyplot.close()
+    return image_data, thumbnail_data
+
+
+@benchmark('images')
+def benchmark_images(size=50):
+    """
+    Renders `size` lightcurve images plus thumbnails with the legacy
+    pyplot/seaborn code and with LightcurveRenderer.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fits_path = os.path.join(temp_dir, 'lightcurve.fits')
+        write_synthetic_fits(fits_path)
+        lightcurve = load_lightcurve(0, fits_path)
+        time_data = numpy.array(lightcurve['HJD'])
+        flux = outlier_clip(lightcurve['TAMFLUX2'])
+
+    results = {'images': size}
+    for name, render in (
+        ('legacy', legacy_render_lightcurve),
+        ('agg', lambda *args: render_lightcurve(*args, thumbnail=True)),
+    ):
+        start = time.perf_counter()
+        for i in range(size):
+            render(time_data, flux, f'Benchmark {i}', 'time')
+        results[f'{name}_images_per_second'] = size / (time.perf_counter() - start)
+    results['speedup'] = results['agg_images_per_second'] / results['legacy_images_per_second']
+    return results
+
+
+def legacy_fold_lightcurve(timeseries, period_length):
+    """
+    The TimeSeries.fold and vstack folding which fold_lightcurve replaced,
+    kept as a baseline for the folding benchmark.
+    """
+    ts = timeseries.fold(period=period_length * units.second)
+    epoch_length = ts['time'].max() - ts['time'].min()
+    ts_extend = ts.copy()
+    ts_extend['time'] = ts_extend['time'] + epoch_length
+    ts = vstack([ts, ts_extend])
+    return (ts.time / epoch_length) - Quantity(0.5, unit=None), ts['TAMFLUX2']
+
+
+@benchmark('folding')
+def benchmark_folding(size=200000, repeats=20):
+    """
+    Folds a synthetic lightcurve of `size` points at `repeats` periods with
+    astropy and with NumPy.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fits_path = os.path.join(temp_dir, 'lightcurve.fits')
+        write_synthetic_fits(fits_path, points=size)
+        lightcurve = numpy.array(load_lightcurve(0, fits_path))
+    timeseries = TimeSeries(
+        time=Time(lightcurve['HJD'], format='jd'),
+        data={'TAMFLUX2': lightcurve['TAMFLUX2']},
+    )
+    periods = numpy.geomspace(600, 86400 * 30, repeats)
+
+    results = {'points': size, 'folds': repeats}
+    for name, fold in (
+        ('astropy', lambda period: legacy_fold_lightcurve(timeseries, period)),
+        ('numpy', lambda period: fold_lightcurve(lightcurve['HJD'], lightcurve['TAMFLUX2'], period)),
+    ):
+        start = time.perf_counter()
+        for period in periods:
+            fold(period)
+        results[f'{name}_folds_per_second'] = repeats / (time.perf_counter() - start)
+    results['speedup'] = results['numpy_folds_per_second'] / results['astropy_folds_per_second']
+    return results
+
+
+def write_synthetic_catalogue(directory, count, folds_per_star=FOLDS_PER_STAR, seed=0):
+    """
+    Writes the import files for `count` synthetic stars, each with
+    folds_per_star folded lightcurves and one Zooniverse subject per fold, in
+    the formats the import commands read. Returns the paths in
+    IMPORT_COMMANDS order.
+    """
+    rng = numpy.random.default_rng(seed)
+    classifications = [
+        value for value, label in FoldedLightcurve.CLASSIFICATION_CHOICES
+        if value != FoldedLightcurve.JUNK
+    ]
+    paths = [os.path.join(directory, file_name) for _, file_name in IMPORT_COMMANDS]
+    with open(paths[0], 'w') as class_top, open(paths[1], 'w') as results, open(paths[2], 'w', newline='') as subjects:
+        subjects_csv = csv.writer(subjects)
+        subjects_csv.writerow(['subject_id', 'subject_set_id', 'locations'])
+        subject_id = 1
+        for superwasp_id in synthetic_superwasp_ids(count, seed):
+            for period_number in range(1, folds_per_star + 1):
+                period_length = rng.uniform(1e3, 1e7)
+                class_top.write(' '.join(str(value) for value in (
+                    subject_id,
+                    superwasp_id,
+                    period_number,
+                    period_length,
+                    rng.choice(classifications),
+                    rng.integers(0, 2),
+                    rng.integers(1, 50),
+                )) + '\n')
+                results.write(' '.join(str(value) for value in (
+                    subject_id,
+                    superwasp_id[:6],
+                    superwasp_id[6:],
+                    period_number,
+                    period_length,
+                    rng.uniform(0, 1),
+                    rng.uniform(0, 10),
+                    0,
+                )) + '\n')
+                subjects_csv.writerow([
+                    subject_id,
+                    1,
+                    json.dumps({'0': f'https://panoptes-uploads.zooniverse.org/production/subject_location/{subject_id}.png'}),
+                ])
+                subject_id += 1
+    return paths
+
+
+def run_imports(paths):
+    """
+    Runs the import commands on the given files, returning how long each
+    took in seconds.
+    """
+    seconds = {}
+    for (command, _), path in zip(IMPORT_COMMANDS, paths):
+        start = time.perf_counter()
+        call_command(command, path, stdout=io.StringIO())
+        seconds[command] = time.perf_counter() - start
+    return seconds
+
+
+def clear_catalogue():
+    with connection.cursor() as cursor:
+        cursor.execute(f'TRUNCATE {Star._meta.db_table} CASCADE')
+    CatalogueEntry.refresh()
+
+
+def synthetic_catalogue(size, seed=0):
+    """
+    Makes sure the database holds exactly the synthetic catalogue of `size`
+    stars, importing it if not. Magnitudes are filled in directly, so that
+    the browse benchmarks don't depend on FITS files.
+    """
+    if Star.objects.count() == size and not Star.objects.filter(_mean_magnitude=None).exists():
+        return
+
+    clear_catalogue()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run_imports(write_synthetic_catalogue(temp_dir, size, seed=seed))
+
+    rng = numpy.random.default_rng(seed)
+    stars = list(Star.objects.order_by('id'))
+    for star, mean_magnitude in zip(stars, rng.uniform(8, 15, len(stars))):
+        star.set_magnitudes((mean_magnitude + 0.5, mean_magnitude, mean_magnitude - 0.5))
+    Star.objects.bulk_update(
+        stars,
+        ['_min_magnitude', '_mean_magnitude', '_max_magnitude', 'stats_version'],
+        batch_size=1000,
+    )
+    CatalogueEntry.refresh()
+
+
+def synthetic_fits_stars(count, points=10000):
+    """
+    Returns the first `count` stars of the synthetic catalogue, with
+    synthetic FITS files written to storage for any which don't have one.
+    """
+    stars = list(Star.objects.order_by('id')[:count])
+    missing = [star for star in stars if not star.fits_file]
+    for star in missing:
+        name = star.fits_file.field.generate_filename(star, f'{star.superwasp_id}.fits')
+        path = star.fits_file.storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_synthetic_fits(path, points=points, seed=star.id)
+        star.fits_file.name = name
+    Star.objects.bulk_update(missing, ['fits_file'])
+    return stars
+
+
+def timings(func, repeats):
+    """
+    Calls func `repeats` times and returns (median, min) in milliseconds.
+    """
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), min(samples)
+
+
+@benchmark('import', database=True)
+def benchmark_import(size=DEFAULT_CATALOGUE_SIZE):
+    """
+    Imports a synthetic catalogue of `size` stars into an empty database
+    with each of the import commands, then imports it again over the
+    existing records.
+    """
+    rows = size * FOLDS_PER_STAR
+    results = {'stars': size, 'rows': rows}
+    clear_catalogue()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = write_synthetic_catalogue(temp_dir, size)
+        for run in ('new', 'existing'):
+            for command, seconds in run_imports(paths).items():
+                results[f'{command}_{run}_seconds'] = seconds
+                results[f'{command}_{run}_rows_per_second'] = rows / seconds
+    return results
+
+
+def browse_scenarios(stars):
+    """
+    Returns a dict of scenario name: browse query params, covering each sort
+    order and filter, and cone searches of a few sizes around given stars.
+    """
+    scenarios = {}
+    for sort in ('star__superwasp_id', 'period_length', 'classification', 'star___mean_magnitude'):
+        for order in ('asc', 'desc'):
+            scenarios[f'sort_{sort.strip("_")}_{order}'] = {'sort': sort, 'order': order}
+    scenarios.update({
+        'filter_period': {'min_period': 1e4, 'max_period': 1e5},
+        'filter_magnitude': {'min_magnitude': 10, 'max_magnitude': 11},
+        'filter_type': {'type_pulsator': 'on'},
+        'filter_uncertain_period': {'uncertain_period': 'on'},
+        'filter_combined': {
+            'min_period': 1e4,
+            'max_magnitude': 12,
+            'type_ew': 'on',
+            'certain_period': 'on',
+            'sort': 'period_length',
+        },
+    })
+    for radius in (0.1, 1, 10):
+        for i, star in enumerate(stars):
+            scenarios[f'cone_{radius}deg_{i}'] = {
+                'search': star.superwasp_id,
+                'search_radius': radius,
+                'sort': 'distance',
+            }
+    return scenarios
+
+
+@benchmark('browse', database=True)
+def benchmark_browse(size=DEFAULT_CATALOGUE_SIZE):
+    """
+    Times the browse page for each scenario in browse_scenarios() on a
+    synthetic catalogue of `size` stars, both with an empty response cache
+    (cold) and with it filled (warm), and the second page of each via its
+    cursor.
+    """
+    synthetic_catalogue(size)
+    client = Client()
+    url = reverse('browse')
+    results = {'stars': size}
+    for name, params in browse_scenarios(Star.objects.order_by('id')[:3]).items():
+        def cold():
+            cache.clear()
+            return client.get(url, params)
+
+        cold_median, cold_min = timings(cold, BROWSE_REPEATS)
+        warm_median, warm_min = timings(lambda: client.get(url, params), BROWSE_REPEATS)
+        results[f'{name}_cold_ms'] = cold_median
+        results[f'{name}_cold_min_ms'] = cold_min
+        results[f'{name}_warm_ms'] = warm_median
+
+        # An empty cursor starts cursor pagination, which links to page two
+        next_link = client.get(url, {**params, 'cursor': ''}).get('Link')
+        if next_link:
+            next_url = next_link.split(';')[0].strip('<>')
+
+            def next_page():
+                cache.clear()
+                return client.get(next_url)
+            results[f'{name}_cursor_page_ms'] = timings(next_page, BROWSE_REPEATS)[0]
+    return results
+
+
+@benchmark('timeseries', database=True)
+def benchmark_timeseries(size=50, catalogue_size=DEFAULT_CATALOGUE_SIZE):
+    """
+    Loads Star.timeseries for `size` stars with synthetic FITS files, first
+    with no .npy sidecars or cached arrays, then with both.
+    """
+    synthetic_catalogue(catalogue_size)
+    star_ids = [star.id for star in synthetic_fits_stars(size)]
+    for star in Star.objects.filter(id__in=star_ids):
+        sidecar = f'{star.fits_file.path}.npy'
+        if os.path.exists(sidecar):
+            os.unlink(sidecar)
+    _load_lightcurve.cache_clear()
+
+    results = {'stars': size}
+    for run in ('cold', 'warm'):
+        stars = list(Star.objects.filter(id__in=star_ids))
+        start = time.perf_counter()
+        for star in stars:
+            star.timeseries
+        results[f'{run}_stars_per_second'] = size / (time.perf_counter() - start)
+    return results
+
+
+@benchmark('magnitudes', database=True)
+def benchmark_magnitudes(size=200, catalogue_size=DEFAULT_CATALOGUE_SIZE):
+    """
+    Calculates magnitudes for `size` stars with synthetic FITS files.
+    """
+    synthetic_catalogue(catalogue_size)
+    stars = synthetic_fits_stars(size)
+    _load_lightcurve.cache_clear()
+    start = time.perf_counter()
+    calculated = calculate_magnitudes(stars)
+    seconds = time.perf_counter() - start
+    return {
+        'stars': calculated,
+        'seconds': seconds,
+        'stars_per_second': calculated / seconds,
+    }
+
+
+@benchmark('star_images', database=True)
+def benchmark_star_images(size=20, catalogue_size=DEFAULT_CATALOGUE_SIZE):
+    """
+    Renders and stores all the images for `size` stars with synthetic FITS
+    files, as generate_all_star_images does.
+    """
+    synthetic_catalogue(catalogue_size)
+    stars = synthetic_fits_stars(size)
+    images = size + FoldedLightcurve.objects.filter(star__in=stars).count() * 2
+    start = time.perf_counter()
+    for star in stars:
+        render_all_star_images(star)
+    seconds = time.perf_counter() - start
+    return {
+        'stars': size,
+        'images': images,
+        'seconds': seconds,
+        'stars_per_second': size / seconds,
+        'images_per_second': images / seconds,
+    }
+
+
+@benchmark('export', database=True)
+def benchmark_export(size=DEFAULT_CATALOGUE_SIZE):
+    """
+    Streams the whole synthetic catalogue of `size` stars from a server-side
+    cursor through export_chunks into the export zip writer, and reports the
+    peak RSS of the process afterwards. With FOLDS_PER_STAR rows per star,
+    --size 500000 exports a million rows.
+    """
+    synthetic_catalogue(size)
+    rows = CatalogueEntry.objects.count()
+    return dict(time_export_zip(export_chunks(CatalogueEntry.objects.all()), rows), stars=size)
+
+
+@benchmark('generate_export', database=True)
+def benchmark_generate_export(size=DEFAULT_CATALOGUE_SIZE):
+    """
+    Runs generate_export over the whole synthetic catalogue of `size` stars
+    in each available format.
+    """
+    from .tasks import available_export_formats
+
+    synthetic_catalogue(size)
+    rows = CatalogueEntry.objects.count()
+    results = {'stars': size, 'rows': rows}
+    for label, export_format in available_export_formats().items():
+        export = DataExport.objects.create(
+            data_version=settings.DATA_VERSION,
+            export_format=export_format,
+        )
+        start = time.perf_counter()
+        generate_export(export.id)
+        seconds = time.perf_counter() - start
+        export.refresh_from_db()
+        label = label.lower()
+        results[f'{label}_seconds'] = seconds
+        results[f'{label}_rows_per_second'] = rows / seconds
+        results[f'{label}_zip_bytes'] = export.export_file.size
+    return results
@@ -0,0 +1,146 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+RESPONSE_CACHE_TIMEOUT = 7 * 86400
+RESPONSE_CACHE_NAMES = ('browse', 'source', 'sprite')
+
+CATALOGUE_GENERATION_KEY = 'catalogue-generation'
+GENERATION_BASE_KEY = 'generation-base'
+# Generations are read through the cache, and an invalidation racing with a
+# read could leave the old value there for this long
+GENERATION_CACHE_TIMEOUT = 60
+
+# Response cache hits and misses are counted in memory, and added to their
+# counters at most this often by each process
+LOOKUP_FLUSH_SECONDS = 10
+
+_lookups = collections.Counter()
+_lookups_lock = threading.Lock()
+_lookups_flushed = time.monotonic()
+
+
+# Generations are kept in Counters, so that culling the cache can't bring
+# one back at a value which older entries were keyed on. A generation which
+# has never been bumped has no counter, and reads as the base generation,
+# which is set once from the clock by a migration in case entries keyed on
+# an older database's counters are still cached.
+def get_generation(key):
+    from .models import Counter
+
+    generation = cache.get(key)
+    if generation is not None:
+        return generation
+    values = Counter.get_values([key, GENERATION_BASE_KEY])
+    generation = values.get(key, values.get(GENERATION_BASE_KEY, 0))
+    cache.set(key, generation, GENERATION_CACHE_TIMEOUT)
+    return generation
+
+
+def bump_generations(keys):
+    from .models import Counter
+
+    keys = list(keys)
+    Counter.add(dict.fromkeys(keys, 1), start_from=GENERATION_BASE_KEY)
+    cache.delete_many(keys)
+
+
+def star_generation_key(superwasp_id):
+    return f'star-generation:{superwasp_id}'
+
+
+def catalogue_generation():
+    return get_generation(CATALOGUE_GENERATION_KEY)
+
+
+def star_generation(superwasp_id):
+    return get_generation(star_generation_key(superwasp_id))
+
+
+def invalidate_stars(superwasp_ids):
+    """
+    Invalidates cached pages for the given stars, after their images or
+    magnitudes have been regenerated.
+
+    Browse pages, counts and sprites are read from the catalogue view, so
+    they're left until it's refreshed (hourly, and after imports), when
+    invalidate_catalogue() is called. Images are regenerated under new
+    names, and gcmedia keeps the old ones for much longer than an hour.
+    """
+    bump_generations(star_generation_key(superwasp_id) for superwasp_id in superwasp_ids)
+
+
+def invalidate_catalogue():
+    """
+    Invalidates every cached browse page, count and sprite.
+    """
+    bump_generations([CATALOGUE_GENERATION_KEY])
+
+
+def versioned_key(prefix, params, generation):
+    """
+    Builds a cache key from canonical params, which changes whenever the data
+    version, image or stats versions, or the given generation change.
+    """
+    from .models import FoldedLightcurve, Star
+
+    params_hash = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    return ':'.join(str(part) for part in (
+        prefix,
+        settings.DATA_VERSION,
+        Star.CURRENT_IMAGE_VERSION,
+        FoldedLightcurve.CURRENT_IMAGE_VERSION,
+        Star.CURRENT_STATS_VERSION,
+        generation,
+        params_hash,
+    ))
+
+
+def lookup_stats_key(name, hit):
+    return f'response-cache-{"hits" if hit else "misses"}:{name}'
+
+
+def record_lookup(name, hit):
+    with _lookups_lock:
+        _lookups[lookup_stats_key(name, hit)] += 1
+        if time.monotonic() - _lookups_flushed < LOOKUP_FLUSH_SECONDS:
+            return
+    flush_lookups()
+
+
+def flush_lookups():
+    """
+    Adds the hits and misses counted by this process to their counters.
+    """
+    global _lookups_flushed
+    from .models import Counter
+
+    with _lookups_lock:
+        lookups = dict(_lookups)
+        _lookups.clear()
+        _lookups_flushed = time.monotonic()
+    Counter.add(lookups)
+
+
+def hit_rates(names=RESPONSE_CACHE_NAMES):
+    """
+    Returns a dict of name: (hits, misses, hit rate) for the response caches.
+    Other processes' counts may be up to LOOKUP_FLUSH_SECONDS behind.
+    """
+    from .models import Counter
+
+    flush_lookups()
+    counts = Counter.get_values([lookup_stats_key(name, hit) for name in names for hit in (True, False)])
+    rates = {}
+    for name in names:
+        hits = counts.get(lookup_stats_key(name, True), 0)
+        misses = counts.get(lookup_stats_key(name, False), 0)
+        total = hits + misses
+        rates[name] = (hits, misses, hits / total if total else None)
+    return rates
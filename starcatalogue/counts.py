@@ -0,0 +1,116 @@
+import collections
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, Page, Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .caching import catalogue_generation, versioned_key
+
+
+COUNT_CACHE_TIMEOUT = 86400
+
+Count = collections.namedtuple('Count', ('value', 'approximate'))
+
+
+def count_cache_key(params):
+    return versioned_key('catalogue-count', params, catalogue_generation())
+
+
+def estimate_count(queryset):
+    """
+    Returns the PostgreSQL planner's estimate of how many rows the queryset
+    will return, without running it.
+    """
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def get_count(queryset, params):
+    """
+    Returns a Count for the queryset, cached under the normalised filter
+    params. Above COUNT_ESTIMATE_THRESHOLD rows, the planner's estimate is
+    used instead of running COUNT(*).
+    """
+    if queryset.query.is_empty():
+        return Count(0, False)
+
+    key = count_cache_key(params)
+    count = cache.get(key)
+    if count is not None:
+        return Count(*count)
+
+    count = None
+    if connections[queryset.db].vendor == 'postgresql':
+        estimate = estimate_count(queryset)
+        if estimate > settings.COUNT_ESTIMATE_THRESHOLD:
+            count = Count(estimate, True)
+    if count is None:
+        count = Count(queryset.count(), False)
+
+    cache.set(key, tuple(count), COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class ApproximatePage(Page):
+    """
+    A page from a paginator whose count is an estimate, which knows whether
+    there's a next page from the rows rather than the count.
+    """
+
+    def __init__(self, object_list, number, paginator, more):
+        super().__init__(object_list, number, paginator)
+        self.more = more
+
+    def has_next(self):
+        return self.more
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1
+
+
+class CachedCountPaginator(Paginator):
+    """
+    A Paginator which takes its count from get_count(). When the count is an
+    estimate, pages past the estimated end are still allowed, and each page
+    reads one extra row to find whether there's another.
+    """
+
+    def __init__(self, object_list, per_page, count_params, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_params = count_params
+
+    @cached_property
+    def cached_count(self):
+        return get_count(self.object_list, self.count_params)
+
+    @cached_property
+    def count(self):
+        return self.cached_count.value
+
+    @property
+    def approximate(self):
+        return self.cached_count.approximate
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if self.approximate and number > 1:
+                return number
+            raise
+
+    def page(self, number):
+        if not self.approximate:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        return ApproximatePage(rows[:self.per_page], number, self, len(rows) > self.per_page)
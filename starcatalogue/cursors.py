@@ -0,0 +1,131 @@
+import base64
+import binascii
+import json
+
+from django.db.models import BooleanField, F, Func, Value
+
+
+class RowCompare(Func):
+    """
+    Compares two rows of expressions, e.g. (mean_magnitude, id) > (12.1, 345),
+    which PostgreSQL can answer by seeking in an index on the same columns.
+    """
+    output_field = BooleanField()
+
+    def __init__(self, lhs, rhs, operator):
+        if len(lhs) != len(rhs):
+            raise ValueError('Rows must be the same length')
+        super().__init__(*lhs, *rhs)
+        self.operator = operator
+        self.width = len(lhs)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sqls = []
+        params = []
+        for expression in self.source_expressions:
+            sql, expression_params = compiler.compile(expression)
+            sqls.append(sql)
+            params.extend(expression_params)
+        return '({}) {} ({})'.format(
+            ', '.join(sqls[:self.width]),
+            self.operator,
+            ', '.join(sqls[self.width:]),
+        ), params
+
+
+def encode_cursor(sort, order, value, pk):
+    """
+    Encodes the sort key of the last row on a page as an opaque token.
+    """
+    data = json.dumps([sort, order, value, pk], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(token, sort, order):
+    """
+    Returns the (value, pk) encoded in a token. Raises ValueError if the
+    token is malformed or was made for a different sort order.
+    """
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        token_sort, token_order, value, pk = json.loads(data)
+    except (binascii.Error, TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if (token_sort, token_order) != (sort, order) or not isinstance(pk, int):
+        raise ValueError('Cursor is for a different sort order')
+    return value, pk
+
+
+def seek_querysets(queryset, column, descending, after):
+    """
+    Returns the querysets which, read one after the other, give the rows of
+    a queryset ordered by (column, pk) which come after the row whose
+    (value, pk) is given, or every row if after is None.
+
+    PostgreSQL sorts NULLs last ascending and first descending, so the NULL
+    rows are read separately by pk at that end of the ordering.
+    """
+    if after is None:
+        return [queryset]
+
+    value, pk = after
+    null_filter = {f'{column}__isnull': True}
+    if value is None:
+        querysets = [queryset.filter(
+            **null_filter,
+            **{'pk__lt' if descending else 'pk__gt': pk},
+        )]
+        if descending:
+            querysets.append(queryset.exclude(**null_filter))
+    else:
+        querysets = [queryset.filter(RowCompare(
+            (F(column), F('pk')),
+            (Value(value), Value(pk)),
+            '<' if descending else '>',
+        ))]
+        if not descending:
+            querysets.append(queryset.filter(**null_filter))
+    return querysets
+
+
+def seek(queryset, column, descending, after, size):
+    """
+    Returns up to size + 1 rows of a queryset ordered by (column, pk), starting
+    after the row whose (value, pk) is given, or from the start if after is
+    None. The extra row shows whether there's another page.
+    """
+    rows = []
+    for part in seek_querysets(queryset, column, descending, after):
+        rows += part[:size + 1 - len(rows)]
+        if len(rows) > size:
+            break
+    return rows
+
+
+class CursorPage(object):
+    """
+    A page of results from seek(), with the same interface the templates
+    use from Django's Page where it makes sense.
+    """
+
+    def __init__(self, object_list, cursor, next_cursor):
+        self.object_list = object_list
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.number = None
+        self.paginator = None
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return bool(self.cursor)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
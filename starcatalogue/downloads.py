@@ -0,0 +1,216 @@
+import http.client
+import logging
+import os
+import tempfile
+import threading
+import urllib.parse
+import warnings
+
+from concurrent.futures import ThreadPoolExecutor
+
+import astropy.io.fits as fits
+
+from astropy.utils.exceptions import AstropyUserWarning
+
+from django.conf import settings
+
+from .metrics import increment, timer
+
+
+logger = logging.getLogger(__name__)
+
+FITS_BLOCK_SIZE = 2880
+FITS_SIGNATURE = b'SIMPLE  =                    T'
+FITS_REQUIRED_COLUMNS = ('TMID', 'TAMFLUX2')
+DOWNLOAD_BUFFER_SIZE = 64 * 1024
+
+
+class InvalidFITSDownload(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Keeps one keep-alive HTTP connection per host for each thread, so a
+    thread pool downloading many files reuses its connections.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.all_connections = []
+
+    def get_connection(self, scheme, netloc):
+        connections = self.local.__dict__.setdefault('connections', {})
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connection = connection_class(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+            with self.lock:
+                self.all_connections.append(connection)
+        return connection
+
+    def discard_connection(self, scheme, netloc):
+        connection = self.local.__dict__.get('connections', {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def request(self, url):
+        """
+        Sends a GET request and returns the response. A connection which the
+        server has closed since its last use is replaced and the request
+        retried once.
+        """
+        url = urllib.parse.urlsplit(url)
+        path = url.path or '/'
+        if url.query:
+            path = f'{path}?{url.query}'
+
+        for attempt in range(2):
+            connection = self.get_connection(url.scheme, url.netloc)
+            try:
+                connection.request('GET', path)
+                return connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.discard_connection(url.scheme, url.netloc)
+                if attempt:
+                    raise
+            except Exception:
+                self.discard_connection(url.scheme, url.netloc)
+                raise
+
+    def close(self):
+        with self.lock:
+            for connection in self.all_connections:
+                connection.close()
+            self.all_connections = []
+
+
+def fits_url(superwasp_id):
+    encoded_params = urllib.parse.urlencode(
+        {'objid': superwasp_id.replace('1SWASP', '1SWASP ')},
+        quote_via=urllib.parse.quote,
+    )
+    return f'{settings.FITS_DOWNLOAD_URL}?{encoded_params}'
+
+
+def validate_fits(path, size):
+    """
+    Checks that a downloaded file is a complete FITS lightcurve before it's
+    put in place.
+    """
+    if size < 2 * FITS_BLOCK_SIZE or size % FITS_BLOCK_SIZE:
+        raise InvalidFITSDownload(f'Unexpected size {size}')
+    with open(path, 'rb') as f:
+        if not f.read(len(FITS_SIGNATURE)) == FITS_SIGNATURE:
+            raise InvalidFITSDownload('Not a FITS file')
+    try:
+        # Astropy only warns when the data is shorter than the headers say
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', AstropyUserWarning)
+            with fits.open(path, memmap=True) as hdul:
+                columns = hdul[1].columns.names
+    except (OSError, IndexError, AttributeError, AstropyUserWarning) as e:
+        raise InvalidFITSDownload(f'Unreadable FITS file: {e}')
+    missing = [name for name in FITS_REQUIRED_COLUMNS if name not in columns]
+    if missing:
+        raise InvalidFITSDownload(f'Missing columns {missing}')
+
+
+def download_fits_file(pool, url, path):
+    """
+    Downloads a FITS file to path. The response is written to a temporary
+    file in the same directory, validated, and then renamed into place, so
+    path never holds a partial or invalid file.
+    """
+    response = pool.request(url)
+    if response.status != 200:
+        response.read()
+        raise InvalidFITSDownload(f'HTTP {response.status}')
+
+    expected_size = response.getheader('Content-Length')
+    max_size = settings.FITS_DOWNLOAD_MAX_SIZE
+    if expected_size is not None and int(expected_size) > max_size:
+        # Close rather than read the body, so the connection isn't reused
+        response.close()
+        pool.discard_connection(*urllib.parse.urlsplit(url)[:2])
+        raise InvalidFITSDownload(f'Response too large ({expected_size} bytes)')
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                data = response.read(DOWNLOAD_BUFFER_SIZE)
+                if not data:
+                    break
+                size += len(data)
+                if size > max_size:
+                    response.close()
+                    pool.discard_connection(*urllib.parse.urlsplit(url)[:2])
+                    raise InvalidFITSDownload(f'Response too large (over {max_size} bytes)')
+                f.write(data)
+        if expected_size is not None and size != int(expected_size):
+            raise InvalidFITSDownload(f'Truncated response ({size} of {expected_size} bytes)')
+        validate_fits(temp_path, size)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return size
+
+
+def download_fits_files(stars, concurrency=None, progress=None):
+    """
+    Downloads FITS files for the given stars over a bounded pool of threads
+    with keep-alive connections, setting fits_file on each star which
+    succeeds and incrementing fits_error_count on each which doesn't.
+    Returns the stars which were downloaded. The stars aren't saved.
+
+    If given, progress is called with no arguments as each download
+    finishes, in the calling thread.
+    """
+    if concurrency is None:
+        concurrency = settings.FITS_DOWNLOAD_CONCURRENCY
+
+    stars = list(stars)
+    names = [
+        star.fits_file.field.generate_filename(star, f'{star.superwasp_id}.fits')
+        for star in stars
+    ]
+    paths = [star.fits_file.storage.path(name) for name in names]
+    pool = ConnectionPool(settings.FITS_DOWNLOAD_TIMEOUT)
+
+    def download(args):
+        star, path = args
+        try:
+            return download_fits_file(pool, fits_url(star.superwasp_id), path)
+        except (InvalidFITSDownload, OSError, http.client.HTTPException) as e:
+            return e
+
+    try:
+        with timer('fits_download'), ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = []
+            for result in executor.map(download, zip(stars, paths)):
+                results.append(result)
+                if progress is not None:
+                    progress()
+    finally:
+        pool.close()
+
+    downloaded = []
+    for star, name, result in zip(stars, names, results):
+        if isinstance(result, Exception):
+            logger.warning(f'Could not download FITS file for star {star.id}: {result}')
+            star.fits_error_count += 1
+            increment('fits_download_failures')
+            continue
+        star.fits_file.name = name
+        downloaded.append(star)
+        increment('fits_downloaded')
+        increment('bytes_downloaded', result)
+    return downloaded
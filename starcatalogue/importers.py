@@ -0,0 +1,63 @@
+import abc
+import itertools
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from .models import CatalogueEntry
+
+
+IMPORT_CHUNK_SIZE = 5000
+BULK_BATCH_SIZE = 1000
+
+
+class ChunkedImportCommand(abc.ABC, BaseCommand):
+    """
+    Base for the import commands, which must implement read_rows() and
+    import_chunk(). Rows are read from the input file in chunks, and each
+    chunk is imported in a single transaction by import_chunk(), which
+    returns how many records it imported. The catalogue table is refreshed
+    once everything is imported.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs=1, type=open)
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+
+    @abc.abstractmethod
+    def read_rows(self, file):
+        """
+        Returns an iterator of the rows to import from the open input file.
+        """
+
+    @abc.abstractmethod
+    def import_chunk(self, rows):
+        """
+        Imports a list of rows, and returns how many records were imported.
+        """
+
+    def handle(self, *args, **options):
+        rows = self.read_rows(options['file'][0])
+        imported_total = 0
+        rows_total = 0
+        start = time.perf_counter()
+        while True:
+            chunk = list(itertools.islice(rows, options['chunk_size']))
+            if not chunk:
+                break
+
+            chunk_start = time.perf_counter()
+            with transaction.atomic():
+                imported_total += self.import_chunk(chunk)
+            rows_total += len(chunk)
+            self.stdout.write('Processed {} rows ({:.0f} rows/s)'.format(
+                rows_total,
+                len(chunk) / (time.perf_counter() - chunk_start),
+            ))
+
+        self.stdout.write('Processed {} rows in {:.1f}s'.format(rows_total, time.perf_counter() - start))
+        self.stdout.write("Total imported: {}".format(imported_total))
+
+        self.stdout.write('Refreshing catalogue')
+        CatalogueEntry.refresh()
@@ -0,0 +1,131 @@
+import functools
+import os
+import tempfile
+
+import numpy
+
+import astropy.io.fits as fits
+from astropy.stats import sigma_clip
+
+
+OUTLIER_SIGMA_CLIP = 5
+FLUX_MAX_CLIP = 2e5
+
+LIGHTCURVE_CACHE_SIZE = 64
+
+# The subset of the WASP FITS columns which is kept in the sidecar files
+LIGHTCURVE_DTYPE = numpy.dtype([
+    ('HJD', '<f8'),
+    ('TAMFLUX2', '<f8'),
+])
+
+
+def tmid_to_hjd(tmid):
+    return tmid / 86400 + 2453005.5
+
+
+def outlier_clip(flux):
+    return sigma_clip(
+        numpy.ma.masked_greater(
+            numpy.ma.masked_less(
+                flux,
+                -FLUX_MAX_CLIP,
+            ),
+            FLUX_MAX_CLIP
+        ),
+        sigma=OUTLIER_SIGMA_CLIP
+    )
+
+
+def flux_to_magnitude(flux):
+    return 15 - 2.5 * numpy.log10(flux)
+
+
+def flux_magnitudes(flux):
+    """
+    Returns the (min, mean, max) magnitudes of a lightcurve's flux, after
+    clipping outliers. "min" and "max" are the magnitudes of the minimum and
+    maximum flux, i.e. the faintest and brightest points.
+    """
+    flux = outlier_clip(flux).compressed()
+    if not len(flux):
+        return numpy.nan, numpy.nan, numpy.nan
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return tuple(
+            float(flux_to_magnitude(value))
+            for value in (flux.min(), flux.mean(), flux.max())
+        )
+
+
+def fold_phase(time, period, epoch=None):
+    """
+    Returns the phase, ((time - epoch) / period) mod 1, of each point in
+    [0, 1). time, period and epoch are plain floats in the same units, and
+    epoch defaults to the first time.
+    """
+    time = numpy.asarray(time)
+    if epoch is None:
+        epoch = time[0]
+    phase = numpy.mod((time - epoch) / period, 1.0)
+    # Tiny negative values can round up to exactly 1
+    phase[phase >= 1.0] = 0.0
+    return phase
+
+
+def tile_cycles(phase, values, cycles=2):
+    """
+    Repeats folded data over consecutive cycles, e.g. for plotting, keeping
+    any mask on values.
+    """
+    return (
+        numpy.concatenate([phase + cycle for cycle in range(cycles)]),
+        numpy.ma.concatenate([values] * cycles),
+    )
+
+
+def sidecar_path(fits_path):
+    return f'{fits_path}.npy'
+
+
+def write_sidecar(fits_path):
+    """
+    Extracts the HJD and TAMFLUX2 columns from a WASP FITS lightcurve into a
+    .npy file next to it. The file is written to a temporary name and renamed
+    into place, so readers never see a partial file.
+    """
+    with fits.open(fits_path) as fits_file:
+        data = fits_file[1].data
+        lightcurve = numpy.empty(len(data), dtype=LIGHTCURVE_DTYPE)
+        lightcurve['HJD'] = tmid_to_hjd(data['TMID'])
+        lightcurve['TAMFLUX2'] = data['TAMFLUX2']
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(fits_path), suffix='.npy.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            numpy.save(temp_file, lightcurve)
+        os.replace(temp_path, sidecar_path(fits_path))
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+@functools.lru_cache(maxsize=LIGHTCURVE_CACHE_SIZE)
+def _load_lightcurve(star_id, fits_path, fits_mtime):
+    path = sidecar_path(fits_path)
+    try:
+        sidecar_outdated = os.stat(path).st_mtime < fits_mtime
+    except FileNotFoundError:
+        sidecar_outdated = True
+    if sidecar_outdated:
+        write_sidecar(fits_path)
+    return numpy.load(path, mmap_mode='r')
+
+
+def load_lightcurve(star_id, fits_path):
+    """
+    Returns a read-only, memory-mapped structured array with HJD and TAMFLUX2
+    fields for the given star's FITS file. Loaded arrays are kept in a
+    per-process LRU cache keyed on the star and the FITS file's mtime, so a
+    replaced FITS file is picked up automatically.
+    """
+    return _load_lightcurve(star_id, str(fits_path), os.stat(fits_path).st_mtime)
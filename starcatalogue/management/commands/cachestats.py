@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from starcatalogue.caching import hit_rates
+
+
+class Command(BaseCommand):
+    help = 'Shows hit rates for the browse and source page caches'
+
+    def handle(self, *args, **options):
+        for name, (hits, misses, rate) in hit_rates().items():
+            if rate is None:
+                rate = '-'
+            else:
+                rate = '{:.1%}'.format(rate)
+            self.stdout.write('{}: {} hits, {} misses ({})'.format(name, hits, misses, rate))
@@ -0,0 +1,46 @@
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from starcatalogue.models import CatalogueEntry
+from starcatalogue.stats import STATS_CHUNK_SIZE, calculate_magnitudes, stale_stats_stars
+
+
+class Command(BaseCommand):
+    help = ('Calculates magnitudes for every star with missing or outdated stats, '
+            'spreading the work over a pool of processes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=STATS_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        # Forked workers mustn't share the parent's database connection
+        connections.close_all()
+
+        calculated_total = 0
+        last_id = 0
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=options['processes']) as executor:
+            while True:
+                stars = list(
+                    stale_stats_stars().filter(id__gt=last_id).order_by('id')[:options['chunk_size']]
+                )
+                if not stars:
+                    break
+                last_id = stars[-1].id
+
+                calculated_total += calculate_magnitudes(stars, executor)
+                self.stdout.write('Calculated {} stars ({:.0f} stars/s)'.format(
+                    calculated_total,
+                    calculated_total / (time.perf_counter() - start),
+                ))
+
+        self.stdout.write("Total calculated: {}".format(calculated_total))
+
+        self.stdout.write('Refreshing catalogue')
+        CatalogueEntry.refresh()
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from starcatalogue.models import ArtifactJob, Star
+from starcatalogue.tasks import download_fits_batch
+
+
+# Stars are claimed in one statement per this many
+CLAIM_CHUNK_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = ('Queues FITS downloads for stars which don\'t have a FITS file yet, '
+            'in batches which are each downloaded concurrently by one task.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=settings.FITS_DOWNLOAD_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        star_ids = Star.objects.filter(
+            Q(fits_file=None) | Q(fits_file=''),
+            fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS,
+        ).order_by('id').values_list('id', flat=True)
+        if options['limit'] is not None:
+            star_ids = star_ids[:options['limit']]
+        star_ids = list(star_ids.iterator())
+
+        queued = 0
+        for i in range(0, len(star_ids), CLAIM_CHUNK_SIZE):
+            # Skip stars which are already being downloaded
+            claimed = ArtifactJob.claim_many(ArtifactJob.FITS, star_ids[i:i + CLAIM_CHUNK_SIZE])
+            for j in range(0, len(claimed), options['batch_size']):
+                download_fits_batch.delay(claimed[j:j + options['batch_size']])
+            queued += len(claimed)
+
+        self.stdout.write('Queued {} downloads'.format(queued))
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from starcatalogue.mediagc import GARBAGE_REASONS, MEDIA_GC_BATCH_SIZE, collect_media_garbage
+
+
+class Command(BaseCommand):
+    help = ('Finds lightcurve images in media storage which are no longer referenced, '
+            'e.g. after an image version bump, and deletes or archives them. '
+            'Only reports what would be removed unless --delete or --archive is given.')
+
+    def add_arguments(self, parser):
+        action = parser.add_mutually_exclusive_group()
+        action.add_argument('--delete', action='store_true')
+        action.add_argument('--archive', metavar='DIRECTORY', help='Moves files here instead of deleting them')
+        parser.add_argument('--grace-seconds', type=int, default=settings.MEDIA_GC_GRACE_SECONDS)
+        parser.add_argument('--batch-size', type=int, default=MEDIA_GC_BATCH_SIZE)
+        parser.add_argument('--limit', type=int, default=None, help='Maximum number of files to remove')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        dry_run = not (options['delete'] or options['archive'])
+        report = collect_media_garbage(
+            dry_run=dry_run,
+            archive_root=options['archive'],
+            grace_seconds=options['grace_seconds'],
+            batch_size=options['batch_size'],
+            limit=options['limit'],
+            pause=options['pause'],
+        )
+
+        for reason in GARBAGE_REASONS:
+            files, size = report.garbage[reason]
+            self.stdout.write('{}: {} files ({})'.format(reason, files, filesizeformat(size)))
+        self.stdout.write('Kept: {} referenced, {} recently written, {} with images being generated'.format(
+            report.kept,
+            report.recent,
+            report.busy,
+        ))
+        self.stdout.write('Reclaimable: {} files ({})'.format(
+            report.reclaimable_files,
+            filesizeformat(report.reclaimable_bytes),
+        ))
+        if not dry_run:
+            self.stdout.write('{}: {} files ({})'.format(
+                'Archived' if options['archive'] else 'Deleted',
+                report.removed,
+                filesizeformat(report.removed_bytes),
+            ))
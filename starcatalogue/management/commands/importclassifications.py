@@ -1,24 +1,19 @@
-from django.core.management.base import BaseCommand, CommandError
-
 import csv
 
+from starcatalogue.importers import BULK_BATCH_SIZE, ChunkedImportCommand
 from starcatalogue.models import Star, FoldedLightcurve, ZooniverseSubject
 
 
 
-class Command(BaseCommand):
+class Command(ChunkedImportCommand):
     help = ('Creates records for stars, lightcurves, and Zooniverse subjects. '
             'Imports classifications (class_top.csv) . Run this first.')
 
-    def add_arguments(self, parser):
-        parser.add_argument('file', nargs=1, type=open)
-
-    def handle(self, *args, **options):
-        r = csv.reader(options['file'][0], delimiter=' ', skipinitialspace=True)
-        imported_total = 0
+    def read_rows(self, file):
+        r = csv.reader(file, delimiter=' ', skipinitialspace=True)
         for count, row in enumerate(r):
             try:
-                subject_id = row[0]
+                subject_id = int(row[0])
                 superwasp_id = row[1]
                 period_number = int(row[2])
                 period_length = float(row[3])
@@ -32,24 +27,77 @@ class Command(BaseCommand):
             if classification == FoldedLightcurve.JUNK:
                 continue
 
-            star, created = Star.objects.get_or_create(superwasp_id=superwasp_id)
-            lightcurve, created = FoldedLightcurve.objects.get_or_create(
-                star=star,
-                period_number=period_number,
+            yield (
+                subject_id,
+                superwasp_id,
+                period_number,
+                period_length,
+                classification,
+                period_uncertainty,
+                classification_count,
             )
-            
+
+    def import_chunk(self, rows):
+        superwasp_ids = set(row[1] for row in rows)
+        stars = {
+            star.superwasp_id: star
+            for star in Star.objects.filter(superwasp_id__in=superwasp_ids)
+        }
+        new_stars = [
+            Star(superwasp_id=superwasp_id)
+            for superwasp_id in superwasp_ids if superwasp_id not in stars
+        ]
+        Star.fill_locations(new_stars)
+        Star.objects.bulk_create(new_stars, batch_size=BULK_BATCH_SIZE)
+        stars.update((star.superwasp_id, star) for star in new_stars)
+
+        lightcurves = {
+            (lightcurve.star_id, lightcurve.period_number): lightcurve
+            for lightcurve in FoldedLightcurve.objects.filter(
+                star__in=[star.id for star in stars.values()],
+            )
+        }
+        new_lightcurves = {}
+        # Only the existing lightcurves which appear in this chunk
+        updated_lightcurves = {}
+        for (
+            subject_id, superwasp_id, period_number, period_length,
+            classification, period_uncertainty, classification_count,
+        ) in rows:
+            key = (stars[superwasp_id].id, period_number)
+            if key in lightcurves:
+                lightcurve = updated_lightcurves[key] = lightcurves[key]
+            else:
+                lightcurve = new_lightcurves.get(key)
+            if lightcurve is None:
+                lightcurve = new_lightcurves[key] = FoldedLightcurve(
+                    star=stars[superwasp_id],
+                    period_number=period_number,
+                )
             lightcurve.period_length = period_length
             lightcurve.classification = classification
             lightcurve.period_uncertainty = period_uncertainty
             lightcurve.classification_count = classification_count
-            lightcurve.save()
 
-            zooniverse_subject, created = ZooniverseSubject.objects.get_or_create(
-                zooniverse_id=subject_id, 
-                lightcurve=lightcurve,
+        FoldedLightcurve.objects.bulk_create(new_lightcurves.values(), batch_size=BULK_BATCH_SIZE)
+        FoldedLightcurve.objects.bulk_update(
+            updated_lightcurves.values(),
+            ['period_length', 'classification', 'period_uncertainty', 'classification_count'],
+            batch_size=BULK_BATCH_SIZE,
+        )
+        lightcurves.update(new_lightcurves)
+
+        existing_subjects = set(ZooniverseSubject.objects.filter(
+            zooniverse_id__in=[row[0] for row in rows],
+        ).values_list('zooniverse_id', flat=True))
+        new_subjects = {}
+        for subject_id, superwasp_id, period_number, *_ in rows:
+            if subject_id in existing_subjects or subject_id in new_subjects:
+                continue
+            new_subjects[subject_id] = ZooniverseSubject(
+                zooniverse_id=subject_id,
+                lightcurve=lightcurves[(stars[superwasp_id].id, period_number)],
             )
+        ZooniverseSubject.objects.bulk_create(new_subjects.values(), batch_size=BULK_BATCH_SIZE)
 
-            if created:
-                imported_total += 1
-        
-        self.stdout.write("Total imported: {}".format(imported_total))
+        return len(new_subjects)
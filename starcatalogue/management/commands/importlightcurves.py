@@ -1,19 +1,14 @@
-from django.core.management.base import BaseCommand, CommandError
-
 import csv
 
+from starcatalogue.importers import BULK_BATCH_SIZE, ChunkedImportCommand
 from starcatalogue.models import Star, FoldedLightcurve
 
 
-class Command(BaseCommand):
+class Command(ChunkedImportCommand):
     help = 'Imports folded lightcurve data (results_total.dat)'
 
-    def add_arguments(self, parser):
-        parser.add_argument('file', nargs=1, type=open)
-
-    def handle(self, *args, **options):
-        r = csv.reader(options['file'][0], delimiter=' ', skipinitialspace=True)
-        imported_total = 0
+    def read_rows(self, file):
+        r = csv.reader(file, delimiter=' ', skipinitialspace=True)
         for count, row in enumerate(r):
             try:
                 if row[7] != '0':
@@ -27,20 +22,36 @@ class Command(BaseCommand):
                 print('Warning: Skipping row {} due to IndexError'.format(count))
                 continue
 
-            try:
-                star = Star.objects.get(superwasp_id=superwasp_id)
-                lightcurve = FoldedLightcurve.objects.get(
-                    star=star,
-                    period_number=period_number,
-                )
-            except (Star.DoesNotExist, FoldedLightcurve.DoesNotExist):
+            yield superwasp_id, period_number, period_length, sigma, chi_squared
+
+    def import_chunk(self, rows):
+        star_ids = dict(Star.objects.filter(
+            superwasp_id__in=set(row[0] for row in rows),
+        ).values_list('superwasp_id', 'id'))
+        lightcurves = {
+            (lightcurve.star_id, lightcurve.period_number): lightcurve
+            for lightcurve in FoldedLightcurve.objects.filter(
+                star__in=star_ids.values(),
+            )
+        }
+
+        updated_lightcurves = {}
+        imported_total = 0
+        for superwasp_id, period_number, period_length, sigma, chi_squared in rows:
+            lightcurve = lightcurves.get((star_ids.get(superwasp_id), period_number))
+            if lightcurve is None:
                 continue
 
             lightcurve.period_length = period_length
             lightcurve.sigma = sigma
             lightcurve.chi_squared = chi_squared
-            lightcurve.save()
+            updated_lightcurves[lightcurve.id] = lightcurve
 
             imported_total += 1
-        
-        self.stdout.write("Total imported: {}".format(imported_total))
+
+        FoldedLightcurve.objects.bulk_update(
+            updated_lightcurves.values(),
+            ['period_length', 'sigma', 'chi_squared'],
+            batch_size=BULK_BATCH_SIZE,
+        )
+        return imported_total
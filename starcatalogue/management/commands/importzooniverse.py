@@ -1,31 +1,39 @@
-from django.core.management.base import BaseCommand, CommandError
-
 import csv
 import json
 
+from starcatalogue.importers import BULK_BATCH_SIZE, ChunkedImportCommand
 from starcatalogue.models import ZooniverseSubject
 
 
-class Command(BaseCommand):
+class Command(ChunkedImportCommand):
     help = 'Imports Zooniverse subject metadata (superwasp-variable-stars-subjects.csv)'
 
-    def add_arguments(self, parser):
-        parser.add_argument('file', nargs=1, type=open)
+    def read_rows(self, file):
+        return csv.DictReader(file)
+
+    def import_chunk(self, rows):
+        subjects = ZooniverseSubject.objects.in_bulk(
+            [int(row['subject_id']) for row in rows],
+            field_name='zooniverse_id',
+        )
 
-    def handle(self, *args, **options):
-        r = csv.DictReader(options['file'][0])
+        updated_subjects = {}
         imported_total = 0
-        for row in r:
-            try:
-                zooniverse_subject = ZooniverseSubject.objects.get(zooniverse_id=int(row['subject_id']))
-            except ZooniverseSubject.DoesNotExist:
+        for row in rows:
+            zooniverse_subject = subjects.get(int(row['subject_id']))
+            if zooniverse_subject is None:
                 continue
 
             zooniverse_subject.subject_set_id = int(row['subject_set_id'])
             #TODO: zooniverse_subject.retired_at = 
             zooniverse_subject.image_location = json.loads(row['locations'])["0"]
-            zooniverse_subject.save()
+            updated_subjects[zooniverse_subject.id] = zooniverse_subject
 
             imported_total += 1
-        
-        self.stdout.write("Total imported: {}".format(imported_total))
+
+        ZooniverseSubject.objects.bulk_update(
+            updated_subjects.values(),
+            ['subject_set_id', 'image_location'],
+            batch_size=BULK_BATCH_SIZE,
+        )
+        return imported_total
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from starcatalogue.medialayout import MEDIA_LAYOUT_BATCH_SIZE, MediaLayoutError, migrate_media_layout
+
+
+class Command(BaseCommand):
+    help = ('Moves star FITS files and images from sources/<superwasp_id>/ into the '
+            'fanned out sources/<hash>/<superwasp_id>/ layout, and updates their records. '
+            'The old names are left for gcmedia to remove after its grace period. '
+            'Can be interrupted and run again, or resumed with --start-id.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start-id', type=int, default=0, help='Only moves stars with a higher ID')
+        parser.add_argument('--batch-size', type=int, default=MEDIA_LAYOUT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        def progress(report):
+            self.stdout.write('Checked {} stars, moved {} files for {} stars (last ID {})'.format(
+                report.stars,
+                report.moved_files,
+                report.moved_stars,
+                report.last_id,
+            ))
+
+        try:
+            report = migrate_media_layout(
+                start_id=options['start_id'],
+                batch_size=options['batch_size'],
+                progress=progress,
+            )
+        except MediaLayoutError as e:
+            raise CommandError(e)
+
+        self.stdout.write('Moved {} files for {} stars'.format(report.moved_files, report.moved_stars))
+        if report.missing_files:
+            self.stdout.write('{} files were missing and are still recorded under their old names'.format(
+                report.missing_files,
+            ))
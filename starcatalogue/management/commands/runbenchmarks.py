@@ -0,0 +1,104 @@
+import datetime
+import inspect
+import json
+import platform
+import tempfile
+
+import astropy
+import django
+import matplotlib
+import numpy
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    override_settings,
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+
+from starcatalogue.benchmarks import BENCHMARKS, DATABASE_BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = ('Runs performance benchmarks. Benchmarks which need the catalogue run '
+            'against a throwaway test database. Available: {}'.format(', '.join(BENCHMARKS)))
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS))
+        parser.add_argument('--size', type=int, default=None)
+        parser.add_argument(
+            '--catalogue-size',
+            type=int,
+            default=None,
+            help='Number of synthetic stars for benchmarks which only use part of the catalogue',
+        )
+        parser.add_argument('--output', help='Writes the results to this file as JSON')
+        parser.add_argument('--compare', help='Compares the results with an earlier --output file')
+        parser.add_argument('--keepdb', action='store_true', help='Keeps the test database between runs')
+
+    def handle(self, *args, **options):
+        for name in options['benchmarks']:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark: {}'.format(name))
+
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['benchmarks']
+
+        report = {
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'data_version': settings.DATA_VERSION,
+            'platform': platform.platform(),
+            'versions': {
+                'python': platform.python_version(),
+                'django': django.__version__,
+                'numpy': numpy.__version__,
+                'astropy': astropy.__version__,
+                'matplotlib': matplotlib.__version__,
+            },
+            'benchmarks': {},
+        }
+
+        database = any(name in DATABASE_BENCHMARKS for name in options['benchmarks'])
+        if database:
+            setup_test_environment()
+            old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+            report['database'] = '{} {}'.format(connection.vendor, connection.pg_version)
+        try:
+            with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+                for name in options['benchmarks']:
+                    benchmark = BENCHMARKS[name]
+                    kwargs = {}
+                    if options['size'] is not None:
+                        kwargs['size'] = options['size']
+                    if (
+                        options['catalogue_size'] is not None
+                        and 'catalogue_size' in inspect.signature(benchmark).parameters
+                    ):
+                        kwargs['catalogue_size'] = options['catalogue_size']
+                    results = benchmark(**kwargs)
+
+                    report['benchmarks'][name] = {'parameters': kwargs, 'results': results}
+                    self.write_results(name, results, baseline.get(name, {}).get('results', {}))
+        finally:
+            if database:
+                teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+                teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    def write_results(self, name, results, baseline):
+        self.stdout.write(name)
+        for key, value in results.items():
+            previous = baseline.get(key)
+            if isinstance(value, (int, float)) and isinstance(previous, (int, float)) and previous:
+                self.stdout.write('  {}: {} ({:+.1%})'.format(key, value, value / previous - 1))
+            else:
+                self.stdout.write('  {}: {}'.format(key, value))
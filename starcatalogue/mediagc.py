@@ -0,0 +1,273 @@
+import itertools
+import logging
+import os
+import re
+import shutil
+import time
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import MEDIA_FANOUT_LENGTH, ArtifactJob, FoldedLightcurve, Star, star_media_dir
+
+
+logger = logging.getLogger(__name__)
+
+SOURCES_DIR = 'sources'
+MEDIA_GC_BATCH_SIZE = 500
+
+RENDER_SUFFIXES = ('.png', '.webp')
+# Left behind by downloads and sidecar writes which were interrupted
+TEMPORARY_SUFFIXES = ('.part', '.npy.tmp')
+
+VERSION_PATTERN = re.compile(r'^v(?P<version>\d+(?:\.\d+)?)_')
+
+MIGRATED = 'migrated'
+ORPHANED = 'orphaned'
+OUTDATED = 'outdated'
+TEMPORARY = 'temporary'
+GARBAGE_REASONS = (OUTDATED, ORPHANED, TEMPORARY, MIGRATED)
+
+MediaFile = namedtuple('MediaFile', ('name', 'path', 'size', 'mtime', 'ctime'))
+
+
+class MediaGCReport(object):
+    def __init__(self):
+        self.garbage = {reason: [0, 0] for reason in GARBAGE_REASONS}
+        self.kept = 0
+        self.recent = 0
+        self.busy = 0
+        self.removed = 0
+        self.removed_bytes = 0
+
+    def add_garbage(self, reason, media_file):
+        self.garbage[reason][0] += 1
+        self.garbage[reason][1] += media_file.size
+
+    @property
+    def reclaimable_files(self):
+        return sum(files for files, _ in self.garbage.values())
+
+    @property
+    def reclaimable_bytes(self):
+        return sum(size for _, size in self.garbage.values())
+
+
+def scan_star_dir(star_dir, name_prefix):
+    files = []
+    with os.scandir(star_dir.path) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            files.append(MediaFile(
+                f'{name_prefix}/{star_dir.name}/{entry.name}',
+                entry.path,
+                stat.st_size,
+                stat.st_mtime,
+                stat.st_ctime,
+            ))
+    return files
+
+
+def scan_sources(root, name_prefix=SOURCES_DIR):
+    """
+    Yields (superwasp_id, [MediaFile]) for each star directory under the
+    media sources directory, one directory at a time, so that the tree is
+    never held in memory. Both the fanned out sources/<hash>/<superwasp_id>
+    layout and the older sources/<superwasp_id> are scanned.
+    """
+    try:
+        star_dirs = os.scandir(root)
+    except FileNotFoundError:
+        return
+    with star_dirs:
+        for star_dir in star_dirs:
+            if not star_dir.is_dir(follow_symlinks=False):
+                continue
+            if name_prefix == SOURCES_DIR and len(star_dir.name) == MEDIA_FANOUT_LENGTH:
+                yield from scan_sources(star_dir.path, f'{name_prefix}/{star_dir.name}')
+                continue
+            try:
+                files = scan_star_dir(star_dir, name_prefix)
+            except FileNotFoundError:
+                continue
+            yield star_dir.name, files
+
+
+def referenced_names(superwasp_ids):
+    """
+    Returns the names of every file which the given stars and their folded
+    lightcurves point to.
+    """
+    names = set()
+    for row in Star.objects.filter(superwasp_id__in=superwasp_ids).values_list(
+        'image_file',
+        'image_webp_file',
+        'fits_file',
+    ):
+        names.update(row)
+    for row in FoldedLightcurve.objects.filter(
+        star__superwasp_id__in=superwasp_ids,
+    ).values_list('image_file', 'thumbnail_file', 'image_webp_file', 'thumbnail_webp_file'):
+        names.update(row)
+    names.discard(None)
+    names.discard('')
+    return names
+
+
+def busy_stars(superwasp_ids):
+    """
+    Returns the SuperWASP IDs of the given stars which have an image
+    generation queued or running, whose new files may not be referenced yet.
+    """
+    star_ids = dict(Star.objects.filter(superwasp_id__in=superwasp_ids).values_list('id', 'superwasp_id'))
+    return set(
+        star_ids[object_id] for object_id in ArtifactJob.objects.filter(
+            kind=ArtifactJob.STAR_IMAGES,
+            object_id__in=star_ids,
+            state__in=(ArtifactJob.QUEUED, ArtifactJob.RUNNING),
+            lease_expires__gt=timezone.now(),
+        ).values_list('object_id', flat=True)
+    )
+
+
+def migrated_name(media_file):
+    """
+    Returns the name which migratemedialayout gives a file in the older
+    sources/<superwasp_id> layout, or None if it's in the fanned out layout.
+    """
+    parts = media_file.name.split('/')
+    if len(parts) != 3:
+        return None
+    return f'{star_media_dir(parts[1])}/{parts[2]}'
+
+
+def garbage_reason(media_file, referenced):
+    """
+    Returns why an unreferenced file is garbage, or None if it should be
+    kept. FITS files and their sidecars are only collected once they've
+    been migrated to the fanned out layout.
+    """
+    if media_file.name in referenced:
+        return None
+    new_name = migrated_name(media_file)
+    if new_name is not None and os.path.exists(default_storage.path(new_name)):
+        return MIGRATED
+    file_name = os.path.basename(media_file.name)
+    if file_name.endswith(TEMPORARY_SUFFIXES):
+        return TEMPORARY
+    if not file_name.endswith(RENDER_SUFFIXES):
+        return None
+    match = VERSION_PATTERN.match(file_name)
+    if match is None:
+        return ORPHANED
+    # Folded lightcurve images are named lightcurve-<id>, and star images
+    # plain lightcurve
+    if file_name[match.end():].startswith('lightcurve-'):
+        current_version = FoldedLightcurve.CURRENT_IMAGE_VERSION
+    else:
+        current_version = Star.CURRENT_IMAGE_VERSION
+    if float(match.group('version')) < current_version:
+        return OUTDATED
+    return ORPHANED
+
+
+def remove_file(media_file, archive_root):
+    """
+    Deletes the file, or moves it to the same name under archive_root.
+    Returns whether it was removed, i.e. it was still there.
+    """
+    try:
+        if archive_root is None:
+            os.unlink(media_file.path)
+        else:
+            archive_path = os.path.join(archive_root, media_file.name)
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            shutil.move(media_file.path, archive_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def collect_media_garbage(
+    dry_run=True,
+    archive_root=None,
+    grace_seconds=None,
+    batch_size=MEDIA_GC_BATCH_SIZE,
+    limit=None,
+    pause=0,
+):
+    """
+    Finds render files which nothing in the database points to, and deletes
+    them (or moves them to archive_root) unless dry_run is set, along with
+    the old names of files moved by migratemedialayout. Returns a
+    MediaGCReport of what was found and removed.
+
+    Star directories are checked in batches of batch_size, each against the
+    database as it is just before that batch is collected. Workers write
+    files before saving the records which point to them, so files modified
+    within grace_seconds, and files for stars with an image generation in
+    progress, are always kept. Migrated files are kept for grace_seconds
+    after they were linked to their new names, for workers which still hold
+    the old ones. No more than limit files are removed, and the
+    collection sleeps for pause seconds between batches.
+    """
+    if grace_seconds is None:
+        grace_seconds = settings.MEDIA_GC_GRACE_SECONDS
+
+    report = MediaGCReport()
+    star_dirs = scan_sources(default_storage.path(SOURCES_DIR))
+    while True:
+        batch = list(itertools.islice(star_dirs, batch_size))
+        if not batch:
+            break
+
+        superwasp_ids = [superwasp_id for superwasp_id, _ in batch]
+        referenced = referenced_names(superwasp_ids)
+        busy = busy_stars(superwasp_ids)
+        cutoff = time.time() - grace_seconds
+        removed_in_batch = 0
+        for superwasp_id, files in batch:
+            for media_file in files:
+                reason = garbage_reason(media_file, referenced)
+                if reason is None:
+                    report.kept += 1
+                    continue
+                modified = media_file.mtime
+                if reason == MIGRATED:
+                    # Linking a file to its new name changes its ctime,
+                    # but not its mtime
+                    modified = max(modified, media_file.ctime)
+                if modified > cutoff:
+                    report.recent += 1
+                    continue
+                if superwasp_id in busy and reason != TEMPORARY:
+                    report.busy += 1
+                    continue
+
+                report.add_garbage(reason, media_file)
+                if dry_run or (limit is not None and report.removed >= limit):
+                    continue
+                if remove_file(media_file, archive_root):
+                    report.removed += 1
+                    report.removed_bytes += media_file.size
+                    removed_in_batch += 1
+            if not dry_run and files and migrated_name(files[0]) is not None:
+                try:
+                    os.rmdir(os.path.dirname(files[0].path))
+                except OSError:
+                    # Still holds files which are being kept
+                    pass
+
+        if removed_in_batch:
+            logger.info(f'Removed {removed_in_batch} files from {len(batch)} star directories')
+            if pause:
+                time.sleep(pause)
+    return report
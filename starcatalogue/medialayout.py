@@ -0,0 +1,150 @@
+import os
+import shutil
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from .caching import invalidate_stars
+from .lightcurves import sidecar_path
+from .models import FoldedLightcurve, Star, star_media_dir
+
+MEDIA_LAYOUT_BATCH_SIZE = 500
+
+STAR_FILE_FIELDS = ('fits_file', 'image_file', 'image_webp_file')
+LIGHTCURVE_FILE_FIELDS = ('image_file', 'thumbnail_file', 'image_webp_file', 'thumbnail_webp_file')
+
+
+class MediaLayoutError(Exception):
+    pass
+
+
+class MediaLayoutReport(object):
+    def __init__(self):
+        self.stars = 0
+        self.moved_stars = 0
+        self.moved_files = 0
+        self.missing_files = 0
+        self.last_id = 0
+
+
+def fanned_out_name(name, superwasp_id):
+    return f'{star_media_dir(superwasp_id)}/{os.path.basename(name)}'
+
+
+def link_file(old_path, new_path):
+    """
+    Gives the file at old_path a second name, new_path, so that it can be
+    found under either until the records are updated. Returns False if
+    there's no file at either.
+    """
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    try:
+        os.link(old_path, new_path)
+    except FileExistsError:
+        # Already linked by a run which was interrupted
+        if not os.path.samefile(old_path, new_path):
+            raise MediaLayoutError(f'{new_path} already exists')
+    except FileNotFoundError:
+        return os.path.exists(new_path)
+    except OSError:
+        # Hard links aren't supported by every filesystem
+        shutil.copy2(old_path, new_path)
+        # Linking would have changed the old file's ctime, which gcmedia
+        # measures its grace period from; so does changing its mode
+        os.chmod(old_path, os.stat(old_path).st_mode)
+    return True
+
+
+def unlink_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def move_field_files(instances, field_names, superwasp_id_of, report):
+    """
+    Links the files of each instance's fields to their fanned out names,
+    and points the fields at them. Returns the instances which changed.
+    """
+    changed = []
+    for instance in instances:
+        instance_changed = False
+        for field_name in field_names:
+            field_file = getattr(instance, field_name)
+            if not field_file:
+                continue
+            new_name = fanned_out_name(field_file.name, superwasp_id_of(instance))
+            if field_file.name == new_name:
+                continue
+
+            old_path = default_storage.path(field_file.name)
+            new_path = default_storage.path(new_name)
+            if not link_file(old_path, new_path):
+                report.missing_files += 1
+                continue
+            if field_name == 'fits_file' and os.path.exists(sidecar_path(old_path)):
+                # A missing sidecar would only be recreated, so this needn't
+                # be atomic
+                unlink_file(sidecar_path(new_path))
+                link_file(sidecar_path(old_path), sidecar_path(new_path))
+            field_file.name = new_name
+            report.moved_files += 1
+            instance_changed = True
+        if instance_changed:
+            changed.append(instance)
+    return changed
+
+
+def migrate_media_layout(start_id=0, batch_size=MEDIA_LAYOUT_BATCH_SIZE, progress=None):
+    """
+    Moves star FITS files and star and folded lightcurve images from
+    sources/<superwasp_id>/ to the fanned out star_media_dir(), in batches
+    of stars in ID order, and returns a MediaLayoutReport.
+
+    Each batch's rows are locked while its files are linked to their new
+    names and the records updated, so that image generation can't save new
+    names which this would overwrite. The old names aren't removed here, as
+    running workers may have read the records before they were updated;
+    gcmedia removes them once its grace period has passed. Files which are
+    already in place are skipped, so an interrupted migration can be run
+    again, or resumed from the report's last_id.
+    """
+    report = MediaLayoutReport()
+    report.last_id = start_id
+    while True:
+        with transaction.atomic():
+            stars = list(
+                Star.objects.select_for_update().filter(id__gt=report.last_id).order_by('id')[:batch_size]
+            )
+            if not stars:
+                break
+            report.last_id = stars[-1].id
+            report.stars += len(stars)
+
+            superwasp_ids = {star.id: star.superwasp_id for star in stars}
+            lightcurves = list(FoldedLightcurve.objects.select_for_update().filter(star_id__in=superwasp_ids))
+            changed_stars = move_field_files(
+                stars,
+                STAR_FILE_FIELDS,
+                lambda star: star.superwasp_id,
+                report,
+            )
+            changed_lightcurves = move_field_files(
+                lightcurves,
+                LIGHTCURVE_FILE_FIELDS,
+                lambda lightcurve: superwasp_ids[lightcurve.star_id],
+                report,
+            )
+            Star.objects.bulk_update(changed_stars, STAR_FILE_FIELDS)
+            FoldedLightcurve.objects.bulk_update(changed_lightcurves, LIGHTCURVE_FILE_FIELDS)
+
+        moved_ids = set(star.id for star in changed_stars)
+        moved_ids.update(lightcurve.star_id for lightcurve in changed_lightcurves)
+        report.moved_stars += len(moved_ids)
+        # Cached pages link to the old names
+        if moved_ids:
+            invalidate_stars(superwasp_ids[star_id] for star_id in moved_ids)
+        if progress is not None:
+            progress(report)
+    return report
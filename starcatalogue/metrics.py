@@ -0,0 +1,321 @@
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Q
+
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'vespa'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Stages of the lightcurve pipeline which are timed within tasks
+STAGES = (
+    'fits_download',
+    'fits_read',
+    'sigma_clip',
+    'fold',
+    'render',
+    'png_encode',
+    'webp_encode',
+    'storage_write',
+)
+
+COUNTERS = {
+    'fits_downloaded': 'FITS files downloaded',
+    'fits_download_failures': 'FITS downloads which failed or were invalid',
+    'bytes_downloaded': 'Bytes of FITS files downloaded',
+    'images_rendered': 'Lightcurve images and thumbnails rendered',
+    'bytes_written': 'Bytes of images and exports written to storage',
+    'magnitudes_calculated': 'Stars whose magnitudes were calculated',
+    'export_rows': 'Rows written to data exports',
+}
+
+# Tasks which are timed as a whole. Counters and stage timings are only
+# recorded within these.
+TASKS = (
+    'download_fits',
+    'download_fits_batch',
+    'generate_all_star_images',
+    'calculate_star_magnitudes',
+    'generate_export',
+    'queue_image_generations',
+    'calculate_magnitudes',
+    'set_locations',
+    'refresh_catalogue',
+)
+
+_local = threading.local()
+
+
+def metrics_enabled():
+    return getattr(settings, 'METRICS_ENABLED', False)
+
+
+class TaskMetrics(object):
+    """
+    Collects a task's stage timings and counters in memory, so that they're
+    added to their Counters in one statement when the task finishes rather
+    than on every observation.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.stage_counts = dict.fromkeys(STAGES, 0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def observe(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+        self.stage_counts[stage] += 1
+
+    def increment(self, name, value):
+        self.counters[name] += value
+
+    def flush(self, seconds, failed):
+        from .models import Counter
+
+        values = {
+            task_key('task_seconds_sum', self.task): seconds_to_micros(seconds),
+            task_key('task_runs_total', self.task): 1,
+            task_key('task_failures_total', self.task): int(failed),
+        }
+        for stage in STAGES:
+            if self.stage_counts[stage]:
+                values[stage_key('stage_seconds_sum', stage)] = seconds_to_micros(self.stage_seconds[stage])
+                values[stage_key('stage_seconds_count', stage)] = self.stage_counts[stage]
+        for name, value in self.counters.items():
+            if value:
+                values[counter_key(name)] = value
+        Counter.add({key: value for key, value in values.items() if value})
+
+        logger.info(json.dumps({
+            'event': 'task_metrics',
+            'task': self.task,
+            'seconds': round(seconds, 6),
+            'failed': failed,
+            'stages': {
+                stage: {
+                    'seconds': round(self.stage_seconds[stage], 6),
+                    'count': self.stage_counts[stage],
+                }
+                for stage in STAGES if self.stage_counts[stage]
+            },
+            'counters': {name: value for name, value in self.counters.items() if value},
+        }, sort_keys=True))
+
+
+def seconds_to_micros(seconds):
+    # Counters are integers
+    return int(round(seconds * 1e6))
+
+
+def task_key(metric, task):
+    return f'metrics:{metric}:{task}'
+
+
+def stage_key(metric, stage):
+    return f'metrics:{metric}:{stage}'
+
+
+def counter_key(name):
+    return f'metrics:counter:{name}'
+
+
+def current_metrics():
+    return getattr(_local, 'metrics', None)
+
+
+def instrumented(func):
+    """
+    Times a task, and collects the stage timings and counters recorded while
+    it runs. Does nothing beyond a settings lookup unless METRICS_ENABLED is
+    set.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not metrics_enabled() or current_metrics() is not None:
+            return func(*args, **kwargs)
+
+        metrics = _local.metrics = TaskMetrics(func.__name__)
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            _local.metrics = None
+            try:
+                metrics.flush(time.perf_counter() - start, failed)
+            except Exception:
+                logger.exception(f'Could not record metrics for {func.__name__}')
+    return wrapper
+
+
+@contextlib.contextmanager
+def timer(stage):
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(stage, time.perf_counter() - start)
+
+
+def observe(stage, seconds):
+    """
+    Records a stage timing measured elsewhere, e.g. in a worker process,
+    where there are no task metrics to record it to.
+    """
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.observe(stage, seconds)
+
+
+def increment(name, value=1):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.increment(name, value)
+
+
+def backlog_querysets():
+    """
+    Returns a dict of name: (description, queryset) for the backlog gauges.
+    """
+    from .models import FoldedLightcurve, Star
+    from .stats import stale_stats_stars
+
+    retryable = Star.objects.filter(fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS)
+    return {
+        'stars_missing_fits': (
+            'Stars without a FITS file which can still be downloaded',
+            retryable.filter(Q(fits_file=None) | Q(fits_file='')),
+        ),
+        'stars_stale_stats': (
+            'Stars whose magnitudes are missing or out of date',
+            stale_stats_stars(),
+        ),
+        'stars_missing_location': (
+            'Stars whose coordinates have not been stored',
+            Star.missing_locations(),
+        ),
+        'stars_stale_images': (
+            'Stars whose image is missing or out of date',
+            retryable.filter(
+                Q(image_version=None)
+                | Q(image_version__lt=Star.CURRENT_IMAGE_VERSION)
+            ),
+        ),
+        'lightcurves_stale_images': (
+            'Folded lightcurves whose images are missing or out of date',
+            FoldedLightcurve.objects.filter(
+                star__fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS,
+            ).filter(
+                Q(image_version=None)
+                | Q(image_version__lt=FoldedLightcurve.CURRENT_IMAGE_VERSION)
+            ),
+        ),
+    }
+
+
+def format_metric(lines, name, metric_type, description, samples):
+    """
+    Appends a metric to lines. samples are (suffix, labels, value), where
+    suffix is e.g. '_sum' for one part of a summary.
+    """
+    name = f'{METRIC_PREFIX}_{name}'
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} {metric_type}')
+    for suffix, labels, value in samples:
+        label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+        if label_text:
+            label_text = f'{{{label_text}}}'
+        lines.append(f'{name}{suffix}{label_text} {format_value(value)}')
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render_metrics():
+    """
+    Returns all metrics in the Prometheus text exposition format. Task and
+    stage metrics are read from their Counters; the backlog gauges use the
+    (cached, and for large backlogs estimated) catalogue counts.
+    """
+    from .caching import hit_rates
+    from .counts import get_count
+    from .models import ArtifactJob, Counter
+
+    keys = (
+        [task_key(metric, task) for metric in ('task_seconds_sum', 'task_runs_total', 'task_failures_total') for task in TASKS]
+        + [stage_key(metric, stage) for metric in ('stage_seconds_sum', 'stage_seconds_count') for stage in STAGES]
+        + [counter_key(name) for name in COUNTERS]
+    )
+    values = Counter.get_values(keys)
+
+    def value(key, scale=None):
+        if scale is None:
+            return values.get(key, 0)
+        return values.get(key, 0) / scale
+
+    lines = []
+    format_metric(lines, 'task_seconds', 'summary', 'Time spent running tasks', [
+        sample
+        for task in TASKS
+        for sample in (
+            ('_sum', {'task': task}, value(task_key('task_seconds_sum', task), 1e6)),
+            ('_count', {'task': task}, value(task_key('task_runs_total', task))),
+        )
+    ])
+    format_metric(lines, 'task_failures_total', 'counter', 'Tasks which raised an exception', [
+        ('', {'task': task}, value(task_key('task_failures_total', task))) for task in TASKS
+    ])
+    format_metric(lines, 'stage_seconds', 'summary', 'Time spent in each stage of the lightcurve pipeline', [
+        sample
+        for stage in STAGES
+        for sample in (
+            ('_sum', {'stage': stage}, value(stage_key('stage_seconds_sum', stage), 1e6)),
+            ('_count', {'stage': stage}, value(stage_key('stage_seconds_count', stage))),
+        )
+    ])
+    for name, description in COUNTERS.items():
+        format_metric(lines, f'{name}_total', 'counter', description, [('', {}, value(counter_key(name)))])
+
+    for name, (description, queryset) in backlog_querysets().items():
+        count = get_count(queryset, {'backlog': name})
+        format_metric(lines, f'backlog_{name}', 'gauge', description, [('', {}, count.value)])
+
+    job_counts = {
+        (kind, state): 0
+        for kind, _ in ArtifactJob.KIND_CHOICES
+        for state, _ in ArtifactJob.STATE_CHOICES
+    }
+    for row in ArtifactJob.objects.values('kind', 'state').annotate(count=Count('id')).order_by():
+        job_counts[(row['kind'], row['state'])] = row['count']
+    kinds = dict(ArtifactJob.KIND_CHOICES)
+    states = dict(ArtifactJob.STATE_CHOICES)
+    format_metric(lines, 'artifact_jobs', 'gauge', 'FITS download and image jobs by state', [
+        ('', {'kind': kinds[kind], 'state': states[state]}, count)
+        for (kind, state), count in job_counts.items()
+    ])
+
+    rates = hit_rates()
+    format_metric(lines, 'response_cache_hits_total', 'counter', 'Response cache hits', [
+        ('', {'cache': name}, hits) for name, (hits, misses, rate) in rates.items()
+    ])
+    format_metric(lines, 'response_cache_misses_total', 'counter', 'Response cache misses', [
+        ('', {'cache': name}, misses) for name, (hits, misses, rate) in rates.items()
+    ])
+    return '\n'.join(lines) + '\n'
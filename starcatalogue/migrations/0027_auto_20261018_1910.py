@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0026_star_stats_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='star',
+            name='_dec',
+            field=models.CharField(max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='star',
+            name='_ra',
+            field=models.CharField(max_length=16, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0027_auto_20261018_1910'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataexport',
+            name='export_format',
+            field=models.IntegerField(choices=[(0, 'CSV'), (1, 'FITS'), (2, 'Parquet')], default=0),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+import starcatalogue.fields
+
+
+CREATE_CATALOGUE_SQL = """
+CREATE MATERIALIZED VIEW starcatalogue_catalogueentry AS
+SELECT
+    lightcurve.id AS lightcurve_id,
+    lightcurve.star_id,
+    star.superwasp_id,
+    star.location,
+    star._ra,
+    star._dec,
+    lightcurve.period_length,
+    lightcurve.sigma,
+    lightcurve.chi_squared,
+    lightcurve.classification,
+    lightcurve.period_uncertainty,
+    lightcurve.classification_count,
+    star._min_magnitude AS min_magnitude,
+    star._mean_magnitude AS mean_magnitude,
+    star._max_magnitude AS max_magnitude
+FROM starcatalogue_foldedlightcurve lightcurve
+INNER JOIN starcatalogue_star star ON star.id = lightcurve.star_id;
+"""
+
+# The unique index is needed for REFRESH MATERIALIZED VIEW CONCURRENTLY.
+# Each sort column gets its own index, which serves the default listing
+# where every type is enabled. The composite indexes serve listings
+# filtered down to a few types, sorted by period or magnitude.
+CREATE_INDEXES_SQL = """
+CREATE UNIQUE INDEX starcatalogue_catalogueentry_pkey ON starcatalogue_catalogueentry (lightcurve_id);
+CREATE INDEX starcatalogue_catalogueentry_location_gist ON starcatalogue_catalogueentry USING GIST (location);
+CREATE INDEX starcatalogue_catalogueentry_superwasp_id ON starcatalogue_catalogueentry (superwasp_id);
+CREATE INDEX starcatalogue_catalogueentry_period_length ON starcatalogue_catalogueentry (period_length);
+CREATE INDEX starcatalogue_catalogueentry_classification ON starcatalogue_catalogueentry (classification);
+CREATE INDEX starcatalogue_catalogueentry_mean_magnitude ON starcatalogue_catalogueentry (mean_magnitude);
+CREATE INDEX starcatalogue_catalogueentry_min_magnitude ON starcatalogue_catalogueentry (min_magnitude);
+CREATE INDEX starcatalogue_catalogueentry_max_magnitude ON starcatalogue_catalogueentry (max_magnitude);
+CREATE INDEX starcatalogue_catalogueentry_type_period ON starcatalogue_catalogueentry (classification, period_uncertainty, period_length);
+CREATE INDEX starcatalogue_catalogueentry_type_magnitude ON starcatalogue_catalogueentry (classification, period_uncertainty, mean_magnitude);
+CREATE INDEX starcatalogue_star_location_gist ON starcatalogue_star USING GIST (location);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0029_resolvedname'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogueEntry',
+            fields=[
+                ('lightcurve', models.OneToOneField(on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='catalogue_entry', serialize=False, to='starcatalogue.foldedlightcurve')),
+                ('star', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='starcatalogue.star')),
+                ('superwasp_id', models.CharField(max_length=26)),
+                ('location', starcatalogue.fields.SPointField(null=True)),
+                ('_ra', models.CharField(max_length=16, null=True)),
+                ('_dec', models.CharField(max_length=16, null=True)),
+                ('period_length', models.FloatField(null=True)),
+                ('sigma', models.FloatField(null=True)),
+                ('chi_squared', models.FloatField(null=True)),
+                ('classification', models.IntegerField(choices=[(1, 'Pulsator'), (2, 'EA/EB'), (3, 'EW'), (4, 'Rotator'), (5, 'Unknown'), (6, 'Junk')], null=True)),
+                ('period_uncertainty', models.IntegerField(choices=[(0, 'Certain'), (1, 'Uncertain')], null=True)),
+                ('classification_count', models.IntegerField(null=True)),
+                ('min_magnitude', models.FloatField(null=True)),
+                ('mean_magnitude', models.FloatField(null=True)),
+                ('max_magnitude', models.FloatField(null=True)),
+            ],
+            options={
+                'managed': False,
+            },
+        ),
+        migrations.RunSQL(
+            CREATE_CATALOGUE_SQL,
+            'DROP MATERIALIZED VIEW starcatalogue_catalogueentry;',
+        ),
+        migrations.RunSQL(
+            CREATE_INDEXES_SQL,
+            'DROP INDEX starcatalogue_star_location_gist;',
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:30
+
+from django.db import migrations
+
+
+SORT_COLUMNS = (
+    'superwasp_id',
+    'period_length',
+    'classification',
+    'mean_magnitude',
+    'min_magnitude',
+    'max_magnitude',
+)
+
+# Cursor pagination seeks on (sort column, lightcurve_id), so each sort
+# column's index gains lightcurve_id as a tie breaker. Descending pages
+# scan the same indexes backwards. Reversing restores the single column
+# indexes which 0030 created.
+CREATE_INDEXES_SQL = ''.join(
+    f'DROP INDEX starcatalogue_catalogueentry_{column};\n'
+    f'CREATE INDEX starcatalogue_catalogueentry_{column} '
+    f'ON starcatalogue_catalogueentry ({column}, lightcurve_id);\n'
+    for column in SORT_COLUMNS
+)
+
+DROP_INDEXES_SQL = ''.join(
+    f'DROP INDEX starcatalogue_catalogueentry_{column};\n'
+    f'CREATE INDEX starcatalogue_catalogueentry_{column} '
+    f'ON starcatalogue_catalogueentry ({column});\n'
+    for column in SORT_COLUMNS
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0030_catalogueentry'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_INDEXES_SQL, DROP_INDEXES_SQL),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0031_catalogueentry_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArtifactJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.IntegerField(choices=[(0, 'FITS download'), (1, 'Star images')])),
+                ('object_id', models.IntegerField()),
+                ('state', models.IntegerField(choices=[(0, 'Queued'), (1, 'Running'), (2, 'Done'), (3, 'Failed')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('lease_expires', models.DateTimeField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='foldedlightcurve',
+            name='image_celery_started',
+        ),
+        migrations.RemoveField(
+            model_name='foldedlightcurve',
+            name='images_celery_task_id',
+        ),
+        migrations.RemoveField(
+            model_name='star',
+            name='fits_celery_started',
+        ),
+        migrations.RemoveField(
+            model_name='star',
+            name='fits_celery_task_id',
+        ),
+        migrations.RemoveField(
+            model_name='star',
+            name='image_celery_started',
+        ),
+        migrations.RemoveField(
+            model_name='star',
+            name='images_celery_task_id',
+        ),
+        migrations.AddConstraint(
+            model_name='artifactjob',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='unique_artifact_job'),
+        ),
+    ]
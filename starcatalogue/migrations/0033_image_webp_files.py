@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:46
+
+from django.db import migrations, models
+import starcatalogue.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0032_artifactjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foldedlightcurve',
+            name='image_webp_file',
+            field=models.ImageField(null=True, upload_to=starcatalogue.models.lightcurve_upload_to),
+        ),
+        migrations.AddField(
+            model_name='foldedlightcurve',
+            name='thumbnail_webp_file',
+            field=models.ImageField(null=True, upload_to=starcatalogue.models.lightcurve_upload_to),
+        ),
+        migrations.AddField(
+            model_name='star',
+            name='image_webp_file',
+            field=models.ImageField(null=True, upload_to=starcatalogue.models.star_upload_to),
+        ),
+    ]
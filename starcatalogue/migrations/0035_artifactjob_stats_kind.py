@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0034_counter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='artifactjob',
+            name='kind',
+            field=models.IntegerField(choices=[(0, 'FITS download'), (1, 'Star images'), (2, 'Star magnitudes')]),
+        ),
+    ]
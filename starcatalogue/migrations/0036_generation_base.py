@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:40
+
+import time
+
+from django.db import migrations
+
+
+def set_generation_base(apps, schema_editor):
+    Counter = apps.get_model('starcatalogue', 'Counter')
+    Counter.objects.get_or_create(name='generation-base', defaults={'value': time.time_ns()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0035_artifactjob_stats_kind'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_generation_base, migrations.RunPython.noop)
+    ]
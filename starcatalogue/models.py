@@ -1,77 +1,85 @@
+import contextlib
 import datetime
+import hashlib
 import logging
+import re
+import time
 import urllib
 import uuid
 
 import numpy
 
-from django.db import models
+from django.conf import settings
+from django.db import connection, models
 from django.utils import timezone
+from django.utils.functional import cached_property
 
-import astropy.io.fits as fits
 from astropy import units
 from astropy.coordinates import SkyCoord
-from astropy.stats import sigma_clip
+from astropy.time import Time
 from astropy.timeseries import TimeSeries
 
-from celery.result import AsyncResult
 from humanize.time import naturaldelta
 from humanize import naturalsize
 
+from .caching import invalidate_catalogue, invalidate_stars
+from .counts import get_count
 from .fields import SPointField
+from .lightcurves import flux_magnitudes, fold_phase, load_lightcurve, outlier_clip
 
+logger = logging.getLogger(__name__)
 
-OUTLIER_SIGMA_CLIP = 5
-FLUX_MAX_CLIP = 2e5
 
-logger = logging.getLogger(__name__)
+MEDIA_FANOUT_LENGTH = 3
+
+SUPERWASP_ID_PATTERN = re.compile(r'1SWASPJ[0-9]{6}\.[0-9]{2}[+-][0-9]{6}\.[0-9]')
+# Parsed in place of malformed IDs, whose coordinates are then NaN
+PLACEHOLDER_SUPERWASP_ID = '1SWASPJ000000.00+000000.0'
 
 
 def export_upload_to(instance, filename):
-    return f'exports/{instance.id.hex[:3]}/{instance.id.hex}/{filename}'
+    return f'exports/{instance.id.hex[:MEDIA_FANOUT_LENGTH]}/{instance.id.hex}/{filename}'
+
+def star_media_dir(superwasp_id):
+    # Spreads the star directories over 4096 parent directories, as with
+    # exports, rather than putting them all directly in sources/
+    fanout = hashlib.md5(superwasp_id.encode()).hexdigest()[:MEDIA_FANOUT_LENGTH]
+    return f'sources/{fanout}/{superwasp_id}'
 
 def star_upload_to(instance, filename):
-    return f'sources/{instance.superwasp_id}/v{instance.CURRENT_IMAGE_VERSION}_{filename}'
+    return f'{star_media_dir(instance.superwasp_id)}/v{instance.CURRENT_IMAGE_VERSION}_{filename}'
 
 def lightcurve_upload_to(instance, filename):
-    return f'sources/{instance.star.superwasp_id}/v{instance.CURRENT_IMAGE_VERSION}_{filename}'
+    return f'{star_media_dir(instance.star.superwasp_id)}/v{instance.CURRENT_IMAGE_VERSION}_{filename}'
 
 
 class ImageGenerator(object):
-    def get_or_generate_image(self, image_attr, generation_task, default=None):
-        image_not_present = not image_attr or not self.image_version
-        image_outdated = self.image_version and self.image_version < self.CURRENT_IMAGE_VERSION
-        if image_not_present or image_outdated:
-            if (
-                not self.images_celery_task_id
-                or AsyncResult(self.images_celery_task_id).ready()
-                or not self.image_celery_started
-                or self.image_celery_started < (timezone.now() - datetime.timedelta(minutes=5))
-            ):
-                self.images_celery_task_id = generation_task.delay(self.id).id
-                self.image_celery_started = timezone.now()
-                self.save()
-            if image_not_present:
-                return default
-        elif self.images_celery_task_id:
-            AsyncResult(self.images_celery_task_id).forget()
+    def queue_image_generation(self):
+        # All of a star's images are rendered together, so one job per star
+        # covers the star and its lightcurves.
+        if ArtifactJob.claim(ArtifactJob.STAR_IMAGES, self.image_star_id):
+            generate_all_star_images.delay(self.image_star_id)
+
+    def get_existing_image(self, image_attr, default=None):
+        # Read-only, so it's safe to call while rendering a page; missing or
+        # outdated images are queued once per request by SourceView, or by
+        # the periodic queue_image_generations task.
+        if not image_attr or not self.image_version:
+            return default
         return image_attr.url
 
 
 class Star(models.Model, ImageGenerator):
-    CURRENT_IMAGE_VERSION = 0.92
+    CURRENT_IMAGE_VERSION = 0.93
     CURRENT_STATS_VERSION = 0.31
 
     superwasp_id = models.CharField(unique=True, max_length=26)
     fits_file = models.FileField(null=True, upload_to=star_upload_to)
-    fits_celery_task_id = models.UUIDField(null=True)
-    fits_celery_started = models.DateTimeField(null=True)
     fits_error_count = models.IntegerField(default=0)
 
     image_file = models.ImageField(null=True, upload_to=star_upload_to)
-    images_celery_task_id = models.UUIDField(null=True)
+    image_webp_file = models.ImageField(null=True, upload_to=star_upload_to)
     image_version = models.FloatField(null=True)
-    image_celery_started = models.DateTimeField(null=True)
 
     _min_magnitude = models.FloatField(null=True)
     _mean_magnitude = models.FloatField(null=True)
@@ -79,25 +87,93 @@ class Star(models.Model, ImageGenerator):
     stats_version = models.FloatField(null=True)
 
     location = SPointField(null=True)
+    _ra = models.CharField(max_length=16, null=True)
+    _dec = models.CharField(max_length=16, null=True)
 
     @classmethod
     def outlier_clip(cls, flux):
-        return sigma_clip(
-            numpy.ma.masked_greater(
-                numpy.ma.masked_less(
-                    flux,
-                    -FLUX_MAX_CLIP,
-                ),
-                FLUX_MAX_CLIP
-            ),
-            sigma=OUTLIER_SIGMA_CLIP
+        return outlier_clip(flux)
+
+    @classmethod
+    def parse_coords(cls, superwasp_ids):
+        """
+        Parses many SuperWASP IDs into a single array SkyCoord. The
+        coordinates of IDs which are malformed or out of range are NaN.
+
+        The IDs are fixed width (1SWASPJhhmmss.ss+ddmmss.s), so the fields are
+        sliced out with NumPy rather than having SkyCoord parse each string.
+        """
+        valid = numpy.array([
+            SUPERWASP_ID_PATTERN.fullmatch(superwasp_id) is not None for superwasp_id in superwasp_ids
+        ], dtype=bool)
+        coords_strs = [
+            (superwasp_id if is_valid else PLACEHOLDER_SUPERWASP_ID).replace('1SWASP', '')
+            for superwasp_id, is_valid in zip(superwasp_ids, valid)
+        ]
+        chars = numpy.array(coords_strs, dtype='S19').view('S1').reshape(len(coords_strs), -1)
+
+        def column(start, end):
+            return numpy.ascontiguousarray(
+                chars[:, start:end]
+            ).view(f'S{end - start}').ravel().astype(float)
+
+        ra = 15 * (column(1, 3) + column(3, 5) / 60 + column(5, 10) / 3600)
+        dec = numpy.where(chars[:, 10] == b'-', -1, 1) * (
+            column(11, 13) + column(13, 15) / 60 + column(15, 19) / 3600
         )
+        valid &= (ra < 360) & (numpy.abs(dec) <= 90)
+        ra[~valid] = numpy.nan
+        dec[~valid] = numpy.nan
+        return SkyCoord(ra=ra, dec=dec, unit=units.deg)
+
+    @classmethod
+    def fill_locations(cls, stars):
+        """
+        Sets the stars' locations from their IDs. Stars whose IDs can't be
+        parsed are logged and get empty _ra and _dec, so that they aren't
+        selected by missing_locations() again.
+        """
+        if not stars:
+            return
+        coords = cls.parse_coords([star.superwasp_id for star in stars])
+        for star, ra_deg, dec_deg, ra, dec in zip(
+            stars,
+            coords.ra.to_value(),
+            coords.dec.to_value(),
+            coords.ra.to_string(units.hour),
+            coords.dec.to_string(),
+        ):
+            if numpy.isnan(ra_deg):
+                logger.warning(f'Could not parse coordinates from SuperWASP ID {star.superwasp_id!r}')
+                star.location = None
+                star._ra = ''
+                star._dec = ''
+                continue
+            star.location = (float(ra_deg), float(dec_deg))
+            star._ra = str(ra)
+            star._dec = str(dec)
+
+    @classmethod
+    def update_locations(cls, stars):
+        stars = list(stars)
+        cls.fill_locations(stars)
+        cls.objects.bulk_update(stars, ['location', '_ra', '_dec'])
+
+    @classmethod
+    def missing_locations(cls):
+        """
+        Stars whose locations haven't been set yet, excluding those whose
+        IDs couldn't be parsed.
+        """
+        return cls.objects.filter(
+            models.Q(location=None) | models.Q(_ra=None) | models.Q(_dec=None)
+        ).exclude(_ra='')
 
     @property
     def coords_str(self):
         return self.superwasp_id.replace('1SWASP', '')
 
-    @property
+    @cached_property
     def coords(self):
         return SkyCoord(self.coords_str, unit=(units.hour, units.deg))
     
@@ -107,11 +183,15 @@ class Star(models.Model, ImageGenerator):
 
     @property
     def ra(self):
-        return self.coords.ra.to_string(units.hour)
+        if self._ra is None:
+            self._ra = self.coords.ra.to_string(units.hour)
+        return self._ra
     
     @property
     def dec(self):
-        return self.coords.dec
+        if self._dec is None:
+            self._dec = self.coords.dec.to_string()
+        return self._dec
 
     @property
     def ra_quoted(self):
@@ -126,6 +206,8 @@ class Star(models.Model, ImageGenerator):
     def set_location(self):
         coords = self.coords
         self.location = (coords.ra.to_value(), coords.dec.to_value())
+        self._ra = coords.ra.to_string(units.hour)
+        self._dec = coords.dec.to_string()
         self.save()
 
     @property
@@ -134,55 +216,103 @@ class Star(models.Model, ImageGenerator):
 
     @property
     def fits(self):
+        if not self.fits_file:
+            return None
+
+        return self.fits_file
+
+    def queue_fits_download(self):
         if (
-            not self.fits_file
-            and (
-                not self.fits_celery_task_id
-                or AsyncResult(self.fits_celery_task_id).ready()
-                or not self.fits_celery_started
-                or self.fits_celery_started < (timezone.now() - datetime.timedelta(minutes=5))
-            )
+            self.fits_error_count < settings.FITS_DOWNLOAD_ATTEMPTS
+            and ArtifactJob.claim(ArtifactJob.FITS, self.id)
         ):
-            self.fits_celery_task_id = download_fits.apply_async(
+            download_fits.apply_async(
                 (self.id,),
-                expires=300,
-            ).id
-            self.fits_celery_started = timezone.now()
-            self.save()
-            return None
+                expires=settings.TASK_LEASE_SECONDS,
+            )
 
-        if self.fits_celery_task_id:
-            AsyncResult(self.fits_celery_task_id).forget()
+    def queue_derived_data(self):
+        """
+        Queues the FITS download, or else the images, which this star is
+        still missing. Claiming a job is a write, so this is called once
+        after rendering a page rather than from the properties it reads.
+        """
+        if not self.fits_file:
+            self.queue_fits_download()
+        elif not self.images_current:
+            self.queue_image_generation()
 
-        return self.fits_file
+    @property
+    def images_current(self):
+        return (
+            self.image_version == self.CURRENT_IMAGE_VERSION
+            and not self.foldedlightcurve_set.exclude(
+                image_version=FoldedLightcurve.CURRENT_IMAGE_VERSION,
+            ).exists()
+        )
+
+    @property
+    def derived_data_current(self):
+        """
+        Whether the FITS file, magnitudes and all images for this star are
+        present and up to date.
+        """
+        return bool(
+            self.fits_file
+            and self.stats_version == self.CURRENT_STATS_VERSION
+            and self.images_current
+        )
 
     @property
     def fits_file_naturalsize(self):
         return naturalsize(self.fits_file.size)
 
     @property
-    def timeseries(self):
+    def lightcurve(self):
+        """
+        The HJD and TAMFLUX2 columns of the FITS file, as a memory-mapped
+        structured array. Use this rather than timeseries where possible.
+        """
         if not self.fits:
             return
 
         try:
-            with fits.open(self.fits.path) as fits_file:
-                hjd_col = fits.Column(name='HJD', format='D', array=fits_file[1].data['TMID']/86400 + 2453005.5)
-                lc_data = fits.BinTableHDU.from_columns(fits_file[1].data.columns + fits.ColDefs([hjd_col]))
-                return TimeSeries.read(lc_data, time_column='HJD', time_format='jd')
+            return load_lightcurve(self.id, self.fits.path)
         except OSError as e:
             logger.warning(f'Could not read FITS file {self.fits.path} for star {self.id}')
             logger.warning(str(e))
             self.fits_file = None
             self.fits_error_count += 1
-            self.save()
+            # Only these fields, so that this can't overwrite fields which
+            # have changed since the star was read, e.g. image names moved
+            # by migratemedialayout
+            self.save(update_fields=['fits_file', 'fits_error_count'])
+
+    @cached_property
+    def timeseries(self):
+        lightcurve = self.lightcurve
+        if lightcurve is None:
+            return
+
+        return TimeSeries(
+            time=Time(lightcurve['HJD'], format='jd'),
+            data={'TAMFLUX2': lightcurve['TAMFLUX2']},
+        )
 
     @property
     def image_location(self):
         return self.get_image_location()
 
     def get_image_location(self):
-        return self.get_or_generate_image(self.image_file, generate_star_images)
+        return self.get_existing_image(self.image_file)
+
+    @property
+    def image_webp_location(self):
+        return self.get_existing_image(self.image_webp_file)
+
+    @property
+    def image_star_id(self):
+        return self.id
 
     @property
     def cerit_url(self):
@@ -207,20 +337,16 @@ class Star(models.Model, ImageGenerator):
         return getattr(self, attr_name)
 
     def calculate_magnitudes(self):
-        agg_funcs = {
-            '_mean_magnitude': lambda x: x.mean(),
-            '_min_magnitude': lambda x: x.min(),
-            '_max_magnitude': lambda x: x.max(),
-        }
-        timeseries = self.timeseries
-        if not timeseries:
+        lightcurve = self.lightcurve
+        if lightcurve is None or not len(lightcurve):
             return
-        flux = Star.outlier_clip(timeseries['TAMFLUX2'])
-        for attr_name, agg_func in agg_funcs.items():
-            mag = 15 - 2.5 * numpy.log10(agg_func(flux))
-            setattr(self, attr_name, mag)
-        self.stats_version = self.CURRENT_STATS_VERSION
+        self.set_magnitudes(flux_magnitudes(lightcurve['TAMFLUX2']))
         self.save()
+        invalidate_stars([self.superwasp_id])
+
+    def set_magnitudes(self, magnitudes):
+        self._min_magnitude, self._mean_magnitude, self._max_magnitude = magnitudes
+        self.stats_version = self.CURRENT_STATS_VERSION
 
     @property
     def mean_magnitude(self):
@@ -258,7 +384,7 @@ class FoldedLightcurve(models.Model, ImageGenerator):
         (UNCERTAIN, 'Uncertain'),
     ]
 
-    CURRENT_IMAGE_VERSION = 0.91
+    CURRENT_IMAGE_VERSION = 0.92
 
     star = models.ForeignKey(to=Star, on_delete=models.CASCADE)
 
@@ -272,9 +398,9 @@ class FoldedLightcurve(models.Model, ImageGenerator):
 
     image_file = models.ImageField(null=True, upload_to=lightcurve_upload_to)
     thumbnail_file = models.ImageField(null=True, upload_to=lightcurve_upload_to)
-    images_celery_task_id = models.UUIDField(null=True)
+    image_webp_file = models.ImageField(null=True, upload_to=lightcurve_upload_to)
+    thumbnail_webp_file = models.ImageField(null=True, upload_to=lightcurve_upload_to)
     image_version = models.FloatField(null=True)
-    image_celery_started = models.DateTimeField(null=True)
 
     @property
     def natural_period(self):
@@ -285,9 +411,8 @@ class FoldedLightcurve(models.Model, ImageGenerator):
         return self.get_image_location()
 
     def get_image_location(self):
-        return self.get_or_generate_image(
+        return self.get_existing_image(
             self.image_file,
-            generate_lightcurve_images,
             self.zooniversesubject.image_location,
         )
 
@@ -296,17 +421,53 @@ class FoldedLightcurve(models.Model, ImageGenerator):
         return self.get_thumbnail_location()
 
     def get_thumbnail_location(self):
-        return self.get_or_generate_image(
+        return self.get_existing_image(
             self.thumbnail_file,
-            generate_lightcurve_images,
             self.zooniversesubject.thumbnail_location,
         )
 
+    @property
+    def image_star_id(self):
+        return self.star_id
+
+    @property
+    def listing_image_location(self):
+        return self.get_existing_image(
+            self.image_file,
+            self.zooniversesubject.image_location,
+        )
+
+    @property
+    def listing_thumbnail_location(self):
+        return self.get_existing_image(
+            self.thumbnail_file,
+            self.zooniversesubject.thumbnail_location,
+        )
+
+    @property
+    def image_webp_location(self):
+        return self.get_existing_image(self.image_webp_file)
+
+    @property
+    def listing_thumbnail_path(self):
+        # For sprite sheets, which can only include rendered thumbnails
+        if not self.thumbnail_file or not self.image_version:
+            return None
+        return self.thumbnail_file.path
+
+    @property
+    def phase(self):
+        lightcurve = self.star.lightcurve
+        if lightcurve is None:
+            return
+        return fold_phase(lightcurve['HJD'], self.period_length / 86400)
+
     @property
     def timeseries(self):
-        if not self.star.timeseries:
+        timeseries = self.star.timeseries
+        if not timeseries:
             return
-        return self.star.timeseries.fold(
+        return timeseries.fold(
             period=self.period_length * units.second,
         )
 
@@ -326,6 +487,302 @@ class ZooniverseSubject(models.Model):
         )
 
 
+class CatalogueEntry(models.Model):
+    """
+    One row per folded lightcurve, carrying the star columns that the
+    catalogue is filtered and sorted on, so that browsing needs no joins.
+
+    This is a materialized view (see migration 0030), which is refreshed
+    after imports and magnitude calculations.
+    """
+    lightcurve = models.OneToOneField(
+        to=FoldedLightcurve,
+        primary_key=True,
+        on_delete=models.DO_NOTHING,
+        related_name='catalogue_entry',
+    )
+    star = models.ForeignKey(to=Star, on_delete=models.DO_NOTHING)
+
+    superwasp_id = models.CharField(max_length=26)
+    location = SPointField(null=True)
+    _ra = models.CharField(max_length=16, null=True)
+    _dec = models.CharField(max_length=16, null=True)
+
+    period_length = models.FloatField(null=True)
+    sigma = models.FloatField(null=True)
+    chi_squared = models.FloatField(null=True)
+    classification = models.IntegerField(choices=FoldedLightcurve.CLASSIFICATION_CHOICES, null=True)
+    period_uncertainty = models.IntegerField(choices=FoldedLightcurve.PERIOD_UNCERTAINTY_CHOICES, null=True)
+    classification_count = models.IntegerField(null=True)
+
+    min_magnitude = models.FloatField(null=True)
+    mean_magnitude = models.FloatField(null=True)
+    max_magnitude = models.FloatField(null=True)
+
+    class Meta:
+        managed = False
+
+    @classmethod
+    def refresh(cls):
+        with connection.cursor() as cursor:
+            cursor.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {cls._meta.db_table}')
+        # Cached pages and counts were built from the old rows
+        invalidate_catalogue()
+
+    @cached_property
+    def parsed_coords(self):
+        """
+        (ra, dec) strings parsed from the SuperWASP ID, for rows whose star
+        hasn't had its coordinates stored yet, without loading the star.
+        """
+        coords = Star.parse_coords([self.superwasp_id])
+        if numpy.isnan(coords.ra.to_value()[0]):
+            return None, None
+        return coords.ra.to_string(units.hour)[0], coords.dec.to_string()[0]
+
+    @property
+    def ra(self):
+        if self._ra is None:
+            return self.parsed_coords[0]
+        return self._ra
+
+    @property
+    def dec(self):
+        if self._dec is None:
+            return self.parsed_coords[1]
+        return self._dec
+
+    @property
+    def natural_period(self):
+        return naturaldelta(self.period_length)
+
+    @property
+    def listing_image_location(self):
+        return self.lightcurve.listing_image_location
+
+    @property
+    def listing_thumbnail_location(self):
+        return self.lightcurve.listing_thumbnail_location
+
+    @property
+    def listing_image_webp_location(self):
+        return self.lightcurve.image_webp_location
+
+    @property
+    def listing_thumbnail_path(self):
+        return self.lightcurve.listing_thumbnail_path
+
+
+class ResolvedName(models.Model):
+    """
+    Cached results of object name lookups for searches. A name which
+    couldn't be resolved has null coordinates.
+    """
+    name = models.CharField(unique=True, max_length=255)
+    ra = models.FloatField(null=True)
+    dec = models.FloatField(null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def location(self):
+        if self.ra is None or self.dec is None:
+            return None
+        return (self.ra, self.dec)
+
+
+class ArtifactJob(models.Model):
+    """
+    Tracks the task producing an artifact (a star's FITS file or its
+    images), so that page views can decide whether to queue it with a
+    single query instead of asking the result backend.
+
+    A job goes from QUEUED to RUNNING to DONE or FAILED. It can be claimed
+    again, and so queued again, once its lease has expired.
+    """
+    FITS = 0
+    STAR_IMAGES = 1
+    STATS = 2
+    KIND_CHOICES = [
+        (FITS, 'FITS download'),
+        (STAR_IMAGES, 'Star images'),
+        (STATS, 'Star magnitudes'),
+    ]
+
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    STATE_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.IntegerField(choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    state = models.IntegerField(choices=STATE_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    lease_expires = models.DateTimeField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_artifact_job'),
+        ]
+
+    @classmethod
+    def lease_expiry(cls, lease_seconds=None):
+        if lease_seconds is None:
+            lease_seconds = settings.TASK_LEASE_SECONDS
+        return timezone.now() + datetime.timedelta(seconds=lease_seconds)
+
+    @classmethod
+    def claim(cls, kind, object_id, force=False):
+        """
+        Atomically marks the job as queued with a new lease, unless another
+        caller holds an unexpired lease. Returns whether the caller got the
+        claim, and so should queue the task. With force, the claim always
+        succeeds.
+        """
+        now = timezone.now()
+        table = cls._meta.db_table
+        condition = '' if force else f'WHERE {table}.lease_expires < %s'
+        params = [kind, object_id, cls.QUEUED, cls.lease_expiry(), now]
+        if not force:
+            params.append(now)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (kind, object_id, state, attempts, lease_expires, updated)
+                VALUES (%s, %s, %s, 1, %s, %s)
+                ON CONFLICT (kind, object_id) DO UPDATE SET
+                    state = EXCLUDED.state,
+                    attempts = {table}.attempts + 1,
+                    lease_expires = EXCLUDED.lease_expires,
+                    updated = EXCLUDED.updated
+                {condition}
+                RETURNING id
+                """,
+                params,
+            )
+            return cursor.fetchone() is not None
+
+    @classmethod
+    def claim_many(cls, kind, object_ids, lease_seconds=None):
+        """
+        Claims the jobs for many objects in one statement, as claim() does,
+        with a lease of lease_seconds (by default TASK_LEASE_SECONDS).
+        Returns the IDs of the objects which were claimed, in the given order.
+        """
+        object_ids = list(object_ids)
+        if not object_ids:
+            return []
+        now = timezone.now()
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (kind, object_id, state, attempts, lease_expires, updated)
+                SELECT %s, object_id, %s, 1, %s, %s FROM unnest(%s::integer[]) AS job (object_id)
+                ORDER BY object_id
+                ON CONFLICT (kind, object_id) DO UPDATE SET
+                    state = EXCLUDED.state,
+                    attempts = {table}.attempts + 1,
+                    lease_expires = EXCLUDED.lease_expires,
+                    updated = EXCLUDED.updated
+                WHERE {table}.lease_expires < %s
+                RETURNING object_id
+                """,
+                [kind, cls.QUEUED, cls.lease_expiry(lease_seconds), now, object_ids, now],
+            )
+            claimed = set(row[0] for row in cursor.fetchall())
+        return [object_id for object_id in object_ids if object_id in claimed]
+
+    @classmethod
+    def set_state(cls, kind, object_ids, state, renew_lease=False):
+        fields = {'state': state, 'updated': timezone.now()}
+        if renew_lease:
+            fields['lease_expires'] = cls.lease_expiry()
+        cls.objects.filter(kind=kind, object_id__in=object_ids).update(**fields)
+
+    @classmethod
+    @contextlib.contextmanager
+    def run(cls, kind, object_ids):
+        """
+        Marks the jobs as running for the duration of a task. Failed jobs
+        keep a fresh lease, so they aren't retried until that expires.
+
+        Yields a function which long tasks should call as they make progress.
+        It renews the leases once a third of TASK_LEASE_SECONDS has passed
+        since they were last renewed, so that the jobs aren't claimed again
+        while they're still running.
+        """
+        renewed = time.monotonic()
+
+        def renew():
+            nonlocal renewed
+            if time.monotonic() - renewed >= settings.TASK_LEASE_SECONDS / 3:
+                cls.set_state(kind, object_ids, cls.RUNNING, renew_lease=True)
+                renewed = time.monotonic()
+
+        cls.set_state(kind, object_ids, cls.RUNNING, renew_lease=True)
+        try:
+            yield renew
+        except BaseException:
+            cls.set_state(kind, object_ids, cls.FAILED, renew_lease=True)
+            raise
+        cls.set_state(kind, object_ids, cls.DONE)
+
+
+class Counter(models.Model):
+    """
+    Named counters, such as cache generations, response cache hits and task
+    metrics. Unlike cache entries they're never culled, and they're
+    incremented atomically, so concurrent workers can't lose counts.
+    """
+    name = models.CharField(primary_key=True, max_length=255)
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def add(cls, values, start_from=None):
+        """
+        Atomically adds each of a dict of name: value to its counter, which is
+        created if it doesn't exist yet, and returns their new values. New
+        counters start from the value of the start_from counter if given and
+        it exists, otherwise from 0.
+        """
+        if not values:
+            return {}
+        # Rows are locked in name order, so concurrent adds can't deadlock
+        names = sorted(values)
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH start AS (
+                    SELECT COALESCE((SELECT value FROM {table} WHERE name = %s), 0) AS value
+                )
+                INSERT INTO {table} (name, value)
+                SELECT counter.name, start.value + counter.value
+                FROM unnest(%s::varchar[], %s::bigint[]) AS counter (name, value), start
+                ORDER BY counter.name
+                ON CONFLICT (name) DO UPDATE
+                SET value = {table}.value + EXCLUDED.value - (SELECT value FROM start)
+                RETURNING name, value
+                """,
+                [start_from, names, [values[name] for name in names]],
+            )
+            return dict(cursor.fetchall())
+
+    @classmethod
+    def get_values(cls, names):
+        """
+        Returns a dict of name: value for the counters which exist.
+        """
+        return dict(cls.objects.filter(name__in=names).values_list('name', 'value'))
+
+
 class DataExport(models.Model):
     EXPORT_FILE_NAME = 'superwasp-vespa-export.zip'
 
@@ -346,6 +803,16 @@ class DataExport(models.Model):
         (STATUS_FAILED, 'Failed'),
     )
 
+    FORMAT_CSV = 0
+    FORMAT_FITS = 1
+    FORMAT_PARQUET = 2
+    FORMAT_CHOICES = (
+        (FORMAT_CSV, 'CSV'),
+        (FORMAT_FITS, 'FITS'),
+        (FORMAT_PARQUET, 'Parquet'),
+    )
+    FORMAT_CHOICES_DICT = dict([ (v, k) for (k, v) in FORMAT_CHOICES])
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
     min_period = models.FloatField(null=True)
@@ -361,6 +828,7 @@ class DataExport(models.Model):
     type_unknown = models.BooleanField(choices=CHECKBOX_CHOICES, default=True)
     search = models.TextField(null=True)
     search_radius = models.FloatField(null=True)
+    export_format = models.IntegerField(choices=FORMAT_CHOICES, default=FORMAT_CSV)
 
     data_version = models.FloatField()
 
@@ -397,10 +865,15 @@ class DataExport(models.Model):
     def queryset(self):
         return StarListView().get_queryset(params=self.queryset_params)
 
+    @cached_property
+    def object_count(self):
+        view = StarListView()
+        return get_count(view.get_queryset(params=self.queryset_params), view.count_params)
+
     @property
     def export_file_naturalsize(self):
         return naturalsize(self.export_file.size)
 
 
-from .tasks import download_fits, generate_lightcurve_images, generate_star_images
+from .tasks import download_fits, generate_all_star_images
 from .views import StarListView
\ No newline at end of file
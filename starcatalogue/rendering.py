@@ -0,0 +1,158 @@
+import io
+
+from collections import namedtuple
+
+from django.core.files.base import ContentFile
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from PIL import Image, features
+
+from .metrics import timer
+
+
+FIGURE_SIZE = (6.4, 4.8)
+FIGURE_DPI = 100
+THUMBNAIL_SIZE = (100, 60)
+PNG_COMPRESS_LEVEL = 3
+WEBP_QUALITY = 80
+WEBP_METHOD = 4
+
+RenderedLightcurve = namedtuple('RenderedLightcurve', ('image', 'thumbnail', 'image_webp', 'thumbnail_webp'))
+
+
+class LightcurveRenderer(object):
+    """
+    Draws lightcurve scatter plots on a figure and Agg canvas which are kept
+    for the life of the process, rather than creating a pyplot figure per
+    image. The points are a single marker-only line whose data is replaced
+    for each plot.
+    """
+
+    def __init__(self):
+        self.figure = Figure(figsize=FIGURE_SIZE, dpi=FIGURE_DPI)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        self.points, = self.axes.plot(
+            [],
+            [],
+            linestyle='none',
+            marker='o',
+            markersize=1,
+            markeredgewidth=0,
+            alpha=0.5,
+        )
+
+    def render(self, x, y, title, xlabel, ylabel='flux'):
+        """
+        Returns the plot as a PIL image, copied out of the canvas's buffer.
+        """
+        self.points.set_data(x, y)
+        self.axes.relim()
+        self.axes.autoscale_view()
+        self.axes.set_title(title)
+        self.axes.set_xlabel(xlabel)
+        self.axes.set_ylabel(ylabel)
+        self.canvas.draw()
+        return Image.frombuffer(
+            'RGBA',
+            self.canvas.get_width_height(),
+            self.canvas.buffer_rgba(),
+            'raw',
+            'RGBA',
+            0,
+            1,
+        ).convert('RGB')
+
+
+_renderer = None
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = LightcurveRenderer()
+    return _renderer
+
+
+def webp_supported():
+    return features.check('webp')
+
+
+def encode_png(image):
+    image_data = io.BytesIO()
+    with timer('png_encode'):
+        image.save(image_data, format='png', compress_level=PNG_COMPRESS_LEVEL)
+    return ContentFile(image_data.getvalue())
+
+
+def encode_webp(image):
+    image_data = io.BytesIO()
+    with timer('webp_encode'):
+        image.save(image_data, format='webp', quality=WEBP_QUALITY, method=WEBP_METHOD)
+    return ContentFile(image_data.getvalue())
+
+
+def render_lightcurve_variants(x, y, title, xlabel, thumbnail=False):
+    """
+    Renders a lightcurve plot and returns a RenderedLightcurve of PNG and,
+    where Pillow supports it, WebP ContentFiles. Everything is encoded from
+    the same raster. The thumbnails are None unless requested, and the WebP
+    variants None if WebP isn't supported.
+    """
+    with timer('render'):
+        image = get_renderer().render(x, y, title, xlabel)
+    thumbnail_image = None
+    if thumbnail:
+        thumbnail_image = image.copy()
+        thumbnail_image.thumbnail(THUMBNAIL_SIZE)
+
+    webp = webp_supported()
+    return RenderedLightcurve(
+        encode_png(image),
+        encode_png(thumbnail_image) if thumbnail else None,
+        encode_webp(image) if webp else None,
+        encode_webp(thumbnail_image) if thumbnail and webp else None,
+    )
+
+
+def render_lightcurve(x, y, title, xlabel, thumbnail=False):
+    """
+    Renders a lightcurve plot and returns (image, thumbnail) as PNG
+    ContentFiles. thumbnail is None unless requested.
+    """
+    rendered = render_lightcurve_variants(x, y, title, xlabel, thumbnail=thumbnail)
+    return rendered.image, rendered.thumbnail
+
+
+def compose_sprite(paths, image_format):
+    """
+    Stacks the thumbnails at the given paths into a single column of
+    THUMBNAIL_SIZE cells, one per path, and returns the encoded image.
+    Cells whose path is None or can't be read are left blank.
+    """
+    cell_width, cell_height = THUMBNAIL_SIZE
+    sheet = Image.new('RGB', (cell_width, cell_height * len(paths)), 'white')
+    for i, path in enumerate(paths):
+        if path is None:
+            continue
+        try:
+            with Image.open(path) as thumbnail:
+                thumbnail.thumbnail(THUMBNAIL_SIZE)
+                sheet.paste(
+                    thumbnail.convert('RGB'),
+                    (
+                        (cell_width - thumbnail.width) // 2,
+                        i * cell_height + (cell_height - thumbnail.height) // 2,
+                    ),
+                )
+        except OSError:
+            continue
+
+    sprite_data = io.BytesIO()
+    if image_format == 'webp':
+        sheet.save(sprite_data, format='webp', quality=WEBP_QUALITY, method=WEBP_METHOD)
+    else:
+        sheet.save(sprite_data, format='png', compress_level=PNG_COMPRESS_LEVEL)
+    return sprite_data.getvalue()
@@ -0,0 +1,138 @@
+import collections
+import datetime
+import threading
+
+from astropy import units
+from astropy.coordinates import SkyCoord
+from astropy.coordinates.name_resolve import NameResolveError
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import ResolvedName
+
+
+class NameResolverUnavailable(Exception):
+    """
+    Raised when the resolver backend can't be reached, so that it's unknown
+    whether the name exists.
+    """
+    pass
+
+
+class SesameResolver(object):
+    """
+    Resolves names with CDS Sesame, via astropy. This is a network request.
+    """
+
+    def resolve(self, name):
+        try:
+            return SkyCoord.from_name(name, parse=True)
+        except NameResolveError as e:
+            # astropy raises the same error when every Sesame mirror fails
+            # or times out, and only this message means it wasn't found
+            if str(e).startswith('Unable to find coordinates'):
+                return None
+            raise NameResolverUnavailable(str(e)) from e
+
+
+class NameCache(object):
+    """
+    A small thread-safe LRU of normalised name -> (ra, dec) or None.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            location, expires = entry
+            if expires is not None and expires < timezone.now():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, location, expires):
+        with self.lock:
+            self.entries[key] = (location, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+name_cache = NameCache(settings.NAME_RESOLVER_CACHE_SIZE)
+
+
+def get_resolver():
+    return import_string(settings.NAME_RESOLVER_BACKEND)()
+
+
+def normalize_name(name):
+    return ' '.join(name.split()).lower()
+
+
+def location_to_coords(location):
+    if location is None:
+        return None
+    return SkyCoord(*location, unit=units.deg)
+
+
+def resolve_name(name):
+    """
+    Returns a SkyCoord for an object name, or None if it can't be resolved.
+
+    Looks in the in-process cache, then the ResolvedName table, and only then
+    asks the resolver backend. Names the resolver doesn't know are cached
+    too, for NAME_RESOLVER_NEGATIVE_TTL seconds. If the resolver can't be
+    reached, NameResolverUnavailable is raised and nothing is cached.
+    """
+    key = normalize_name(name)
+    if not key or len(key) > ResolvedName._meta.get_field('name').max_length:
+        return location_to_coords(_resolve_location(name))
+
+    cached = name_cache.get(key)
+    if cached is not None:
+        return location_to_coords(cached[0])
+
+    negative_ttl = datetime.timedelta(seconds=settings.NAME_RESOLVER_NEGATIVE_TTL)
+    try:
+        resolved_name = ResolvedName.objects.get(name=key)
+    except ResolvedName.DoesNotExist:
+        resolved_name = None
+
+    if resolved_name is None or (
+        resolved_name.location is None
+        and resolved_name.updated < timezone.now() - negative_ttl
+    ):
+        location = _resolve_location(name)
+        resolved_name, _ = ResolvedName.objects.update_or_create(
+            name=key,
+            defaults={
+                'ra': location[0] if location else None,
+                'dec': location[1] if location else None,
+            },
+        )
+
+    expires = None
+    if resolved_name.location is None:
+        expires = resolved_name.updated + negative_ttl
+    name_cache.set(key, resolved_name.location, expires)
+    return location_to_coords(resolved_name.location)
+
+
+def _resolve_location(name):
+    coords = get_resolver().resolve(name)
+    if coords is None:
+        return None
+    return (coords.ra.to_value(units.deg), coords.dec.to_value(units.deg))
@@ -0,0 +1,97 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db.models import Q
+
+from .caching import invalidate_stars
+from .lightcurves import flux_magnitudes, load_lightcurve
+from .metrics import increment, observe
+from .models import Star
+
+
+STATS_CHUNK_SIZE = 500
+STATS_MAP_CHUNK_SIZE = 10
+
+logger = logging.getLogger(__name__)
+
+
+def stale_stats_stars():
+    # Empty FileFields are saved as '', so isnull alone would include stars
+    # whose FITS file hasn't been downloaded
+    return Star.objects.exclude(fits_file='').filter(
+        fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
+    ).filter(
+        Q(fits_file__isnull=False)
+        & (
+            Q(_min_magnitude__isnull=True)
+            | Q(_max_magnitude__isnull=True)
+            | Q(_mean_magnitude__isnull=True)
+            | Q(stats_version__lt=Star.CURRENT_STATS_VERSION)
+            | Q(stats_version__isnull=True)
+        )
+    )
+
+
+def star_magnitudes(star_id, fits_path):
+    """
+    Returns (star_id, magnitudes, error, timings) for one star, where
+    timings is a list of (stage, seconds). This runs in pool worker
+    processes, so it only deals in plain values, and the caller records the
+    timings.
+    """
+    start = time.perf_counter()
+    try:
+        lightcurve = load_lightcurve(star_id, fits_path)
+    except OSError as e:
+        return star_id, None, str(e), [('fits_read', time.perf_counter() - start)]
+    read = time.perf_counter()
+    magnitudes = flux_magnitudes(lightcurve['TAMFLUX2'])
+    return star_id, magnitudes, None, [('fits_read', read - start), ('sigma_clip', time.perf_counter() - read)]
+
+
+def calculate_magnitudes(stars, executor=None, progress=None):
+    """
+    Calculates magnitudes for a chunk of stars and saves them with a single
+    bulk_update. If an executor (e.g. a ProcessPoolExecutor) is given, the
+    FITS reading and clipping are spread over it. If given, progress is
+    called with no arguments after each star.
+    """
+    stars = [star for star in stars if star.fits_file]
+    if not stars:
+        return 0
+
+    star_ids = [star.id for star in stars]
+    fits_paths = [star.fits_file.path for star in stars]
+    if executor is None:
+        results = map(star_magnitudes, star_ids, fits_paths)
+    else:
+        results = executor.map(star_magnitudes, star_ids, fits_paths, chunksize=STATS_MAP_CHUNK_SIZE)
+
+    for star, (star_id, magnitudes, error, timings) in zip(stars, results):
+        if progress is not None:
+            progress()
+        for stage, seconds in timings:
+            observe(stage, seconds)
+        if error is not None:
+            logger.warning(f'Could not read FITS file {star.fits_file.path} for star {star.id}')
+            logger.warning(error)
+            star.fits_file = None
+            star.fits_error_count += 1
+            continue
+        star.set_magnitudes(magnitudes)
+        increment('magnitudes_calculated')
+
+    Star.objects.bulk_update(
+        stars,
+        [
+            '_min_magnitude',
+            '_mean_magnitude',
+            '_max_magnitude',
+            'stats_version',
+            'fits_file',
+            'fits_error_count',
+        ],
+    )
+    invalidate_stars(star.superwasp_id for star in stars)
+    return len(stars)
@@ -1,24 +1,37 @@
 import csv
 import io
-import urllib
+import itertools
+import shutil
+import tempfile
 import yaml
 import zipfile
 
-import seaborn
+import numpy
 
-from astropy.table import vstack
-from astropy.units import Quantity
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
-from celery import shared_task
+import astropy.io.fits as fits
 
-from django.conf import settings
-from django.core.files.base import ContentFile
+from astropy import units
 
-from matplotlib import pyplot
+from celery import shared_task
 
-from PIL import Image
+from django.conf import settings
+from django.core.files.base import File
+from django.db import transaction
+from django.db.models import Q
 
-from .models import DataExport, Star, FoldedLightcurve
+from .caching import invalidate_stars
+from .downloads import download_fits_files
+from .lightcurves import fold_phase, tile_cycles
+from .metrics import increment, instrumented, timer
+from .models import ArtifactJob, DataExport, Star, FoldedLightcurve
+from .rendering import render_lightcurve_variants
+from .stats import calculate_magnitudes
 
 
 EXPORT_DATA_DESCRIPTION = {
@@ -36,164 +49,402 @@ EXPORT_DATA_DESCRIPTION = {
     'Chi squared': 'Chi squared error estimate from original period search',
 }
 
+# The columns each EXPORT_DATA_DESCRIPTION field is read from
+EXPORT_FIELDS = {
+    'SuperWASP ID': 'superwasp_id',
+    'Period Length': 'period_length',
+    'RA': '_ra',
+    'Dec': '_dec',
+    'Maximum magnitude': 'max_magnitude',
+    'Minimum magnitude': 'min_magnitude',
+    'Mean magnitude': 'mean_magnitude',
+    'Classification': 'classification',
+    'Classification count': 'classification_count',
+    'Folding flag': 'period_uncertainty',
+    'Sigma': 'sigma',
+    'Chi squared': 'chi_squared',
+}
+
+# NumPy types used for the columnar (FITS and Parquet) formats
+EXPORT_COLUMN_DTYPES = {
+    'SuperWASP ID': 'U26',
+    'Period Length': 'f8',
+    'RA': 'U16',
+    'Dec': 'U16',
+    'Maximum magnitude': 'f8',
+    'Minimum magnitude': 'f8',
+    'Mean magnitude': 'f8',
+    'Classification': 'U8',
+    'Classification count': 'i4',
+    'Folding flag': 'U9',
+    'Sigma': 'f8',
+    'Chi squared': 'f8',
+}
+
+EXPORT_CHUNK_SIZE = 5000
+
+FITS_BLOCK_SIZE = 2880
+FITS_INT_NULL = -1
+
+
+def available_export_formats():
+    """
+    Returns the export formats which can be generated, keyed by display name.
+    """
+    return dict(
+        (label, value) for (value, label) in DataExport.FORMAT_CHOICES
+        if value != DataExport.FORMAT_PARQUET or pyarrow is not None
+    )
+
+
+def export_chunks(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields lists of export rows, in EXPORT_DATA_DESCRIPTION column order,
+    streamed from a server-side cursor over the catalogue table.
+    """
+    classifications = dict(FoldedLightcurve.CLASSIFICATION_CHOICES)
+    period_uncertainties = dict(FoldedLightcurve.PERIOD_UNCERTAINTY_CHOICES)
+    records = queryset.values_list(*EXPORT_FIELDS.values()).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+
+        # Stars which haven't had their coordinates stored yet
+        missing_coords = [record[0] for record in chunk if record[2] is None or record[3] is None]
+        if missing_coords:
+            coords = Star.parse_coords(missing_coords)
+            parsed_coords = dict(zip(
+                missing_coords,
+                zip(coords.ra.to_string(units.hour), coords.dec.to_string()),
+            ))
+
+        rows = []
+        for record in chunk:
+            (
+                superwasp_id, period_length, ra, dec, max_magnitude, min_magnitude,
+                mean_magnitude, classification, classification_count,
+                period_uncertainty, sigma, chi_squared,
+            ) = record
+            if ra is None or dec is None:
+                ra, dec = parsed_coords[superwasp_id]
+            rows.append((
+                superwasp_id,
+                period_length,
+                ra,
+                dec,
+                max_magnitude,
+                min_magnitude,
+                mean_magnitude,
+                classifications.get(classification),
+                classification_count,
+                period_uncertainties.get(period_uncertainty),
+                sigma,
+                chi_squared,
+            ))
+        yield rows
+
+
+def export_columns(chunk):
+    """
+    Converts a chunk of export rows into typed masked arrays, one per
+    EXPORT_COLUMN_DTYPES entry, with missing values masked.
+    """
+    columns = {}
+    for (name, dtype), values in zip(EXPORT_COLUMN_DTYPES.items(), zip(*chunk)):
+        dtype = numpy.dtype(dtype)
+        mask = numpy.fromiter((value is None for value in values), dtype=bool, count=len(values))
+        if mask.any():
+            fill_value = {'U': '', 'i': FITS_INT_NULL, 'f': numpy.nan}[dtype.kind]
+            values = [fill_value if value is None else value for value in values]
+        columns[name] = numpy.ma.masked_array(numpy.array(values, dtype=dtype), mask=mask)
+    return columns
+
+
+def write_csv_export(export_zip, chunks):
+    with export_zip.open('export.csv', 'w', force_zip64=True) as csv_entry:
+        export_csv = io.TextIOWrapper(csv_entry, encoding='utf-8', newline='')
+        w = csv.writer(export_csv)
+        w.writerow(EXPORT_DATA_DESCRIPTION.keys())
+        for chunk in chunks:
+            w.writerows(chunk)
+        export_csv.flush()
+        export_csv.detach()
+
+
+def write_fits_export(export_zip, chunks, params):
+    """
+    Writes a FITS binary table one chunk at a time. The table data are
+    written to a temporary file first, so that the header can carry the
+    final row count without holding the table in memory.
+    """
+    fits_columns = []
+    for name, dtype in EXPORT_COLUMN_DTYPES.items():
+        dtype = numpy.dtype(dtype)
+        if dtype.kind == 'U':
+            fits_columns.append(fits.Column(name=name, format=f'{dtype.itemsize // 4}A'))
+        elif dtype.kind == 'i':
+            fits_columns.append(fits.Column(name=name, format='J', null=FITS_INT_NULL))
+        else:
+            fits_columns.append(fits.Column(name=name, format='D'))
+    table_hdu = fits.BinTableHDU.from_columns(fits_columns, nrows=0)
+    record_dtype = table_hdu.data.dtype.newbyteorder('>')
+
+    total_rows = 0
+    with tempfile.TemporaryFile() as table_data:
+        for chunk in chunks:
+            columns = export_columns(chunk)
+            records = numpy.zeros(len(chunk), dtype=record_dtype)
+            for i, name in enumerate(EXPORT_COLUMN_DTYPES):
+                records[record_dtype.names[i]] = columns[name].data
+            table_data.write(records.tobytes())
+            total_rows += len(chunk)
+
+        header = table_hdu.header
+        header['NAXIS2'] = total_rows
+        for i, description in enumerate(EXPORT_DATA_DESCRIPTION.values(), start=1):
+            header[f'TCOMM{i}'] = description
+        header['DATAVER'] = (params.get('data_version'), 'VeSPA data version')
+
+        with export_zip.open('export.fits', 'w', force_zip64=True) as fits_entry:
+            fits_entry.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+            fits_entry.write(header.tostring().encode('ascii'))
+            table_data.seek(0)
+            shutil.copyfileobj(table_data, fits_entry)
+            data_size = total_rows * record_dtype.itemsize
+            fits_entry.write(b'\0' * (-data_size % FITS_BLOCK_SIZE))
+
+
+def write_parquet_export(export_zip, chunks):
+    schema = pyarrow.schema([
+        pyarrow.field(
+            name,
+            pyarrow.from_numpy_dtype(numpy.dtype(dtype)) if dtype[0] != 'U' else pyarrow.string(),
+            metadata={'description': EXPORT_DATA_DESCRIPTION[name]},
+        )
+        for name, dtype in EXPORT_COLUMN_DTYPES.items()
+    ])
+    with tempfile.TemporaryFile() as parquet_file:
+        with pyarrow.parquet.ParquetWriter(parquet_file, schema) as writer:
+            for chunk in chunks:
+                columns = export_columns(chunk)
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [
+                        pyarrow.array(column.data, mask=numpy.ma.getmaskarray(column))
+                        for column in columns.values()
+                    ],
+                    schema=schema,
+                ))
+
+        # Parquet is already compressed, so it's stored in the zip as-is
+        parquet_file.seek(0)
+        parquet_info = zipfile.ZipInfo('export.parquet')
+        parquet_info.compress_type = zipfile.ZIP_STORED
+        with export_zip.open(parquet_info, 'w', force_zip64=True) as parquet_entry:
+            shutil.copyfileobj(parquet_file, parquet_entry)
+
+
+def write_export_zip(export_file, chunks, params, export_format=DataExport.FORMAT_CSV):
+    with zipfile.ZipFile(export_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as export_zip:
+        if export_format == DataExport.FORMAT_FITS:
+            write_fits_export(export_zip, chunks, params)
+        elif export_format == DataExport.FORMAT_PARQUET:
+            write_parquet_export(export_zip, chunks)
+        else:
+            write_csv_export(export_zip, chunks)
+        export_zip.writestr('fields.yaml', yaml.dump(EXPORT_DATA_DESCRIPTION))
+        export_zip.writestr('params.yaml', yaml.dump(params))
+
 
 @shared_task
+@instrumented
 def generate_export(export_id):
     export = DataExport.objects.get(id=export_id)
     if export.export_status in (export.STATUS_RUNNING, export.STATUS_COMPLETE):
         return
 
     export.export_status = export.STATUS_RUNNING
-    export.save()
+    export.save(update_fields=['export_status'])
 
     try:
-        export_csv = io.StringIO()
-        w = csv.DictWriter(export_csv, fieldnames=EXPORT_DATA_DESCRIPTION.keys())
-        w.writeheader()
-        total_records = export.queryset.count()
-        for i, record in enumerate(export.queryset):
-            if i % 1000 == 0:
-                export.progress = float(i) / total_records * 100
-                export.save()
-            w.writerow({
-                'SuperWASP ID': record.star.superwasp_id,
-                'Period Length': record.period_length,
-                'RA': record.star.ra,
-                'Dec': record.star.dec,
-                'Maximum magnitude': record.star.max_magnitude,
-                'Minimum magnitude': record.star.min_magnitude,
-                'Mean magnitude': record.star.mean_magnitude,
-                'Classification': record.get_classification_display(), 
-                'Classification count': record.classification_count,
-                'Folding flag': record.get_period_uncertainty_display(),
-                'Sigma': record.sigma,
-                'Chi squared': record.chi_squared,
-            })
-
-        export_file = ContentFile(b'')
-        with zipfile.ZipFile(export_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as export_zip:
-            export_zip.writestr('export.csv', export_csv.getvalue())
-            export_zip.writestr('fields.yaml', yaml.dump(EXPORT_DATA_DESCRIPTION))
-            export_zip.writestr('params.yaml', yaml.dump({
-                'min_magnitude': export.min_magnitude,
-                'max_magnitude': export.max_magnitude,
-                'min_period': export.min_period,
-                'max_period': export.max_period,
-                'certain_period': export.certain_period,
-                'uncertain_period': export.uncertain_period,
-                'type_pulsator': export.type_pulsator,
-                'type_rotator': export.type_rotator,
-                'type_ew': export.type_ew,
-                'type_eaeb': export.type_eaeb,
-                'type_unknown': export.type_unknown,
-                'search': export.search,
-                'search_radius': export.search_radius,
-                'data_version': export.data_version,
-                'object_count': total_records,
-            }))
-        export.export_file.save(export.EXPORT_FILE_NAME, export_file)
+        queryset = export.queryset
+        total_records = max(export.object_count.value, 1)
+        params = {
+            'min_magnitude': export.min_magnitude,
+            'max_magnitude': export.max_magnitude,
+            'min_period': export.min_period,
+            'max_period': export.max_period,
+            'certain_period': export.certain_period,
+            'uncertain_period': export.uncertain_period,
+            'type_pulsator': export.type_pulsator,
+            'type_rotator': export.type_rotator,
+            'type_ew': export.type_ew,
+            'type_eaeb': export.type_eaeb,
+            'type_unknown': export.type_unknown,
+            'search': export.search,
+            'search_radius': export.search_radius,
+            'export_format': export.get_export_format_display(),
+            'data_version': export.data_version,
+        }
+
+        def tracked_chunks():
+            exported_records = 0
+            for chunk in export_chunks(queryset):
+                yield chunk
+                exported_records += len(chunk)
+                # The total may be an estimate for large exports
+                export.progress = min(float(exported_records) / total_records * 100, 100)
+                export.save(update_fields=['progress'])
+            params['object_count'] = exported_records
+            increment('export_rows', exported_records)
+
+        with tempfile.TemporaryFile() as export_file:
+            write_export_zip(export_file, tracked_chunks(), params, export.export_format)
+            increment('bytes_written', export_file.tell())
+            export_file.seek(0)
+            with timer('storage_write'):
+                export.export_file.save(export.EXPORT_FILE_NAME, File(export_file), save=False)
     except:
         export.export_status = export.STATUS_FAILED
-        export.save()
+        export.save(update_fields=['export_status'])
         raise
 
     export.export_status = export.STATUS_COMPLETE
-    export.save()
+    export.save(update_fields=['export_status', 'export_file'])
 
 
-@shared_task
+@shared_task(ignore_result=True)
+@instrumented
+def calculate_star_magnitudes(star_ids):
+    with ArtifactJob.run(ArtifactJob.STATS, star_ids) as renew_leases:
+        calculate_magnitudes(Star.objects.filter(id__in=star_ids), progress=renew_leases)
+
+
+@shared_task(ignore_result=True)
+@instrumented
 def download_fits(star_id):
-    star = Star.objects.get(id=star_id)
-    if star.fits_error_count >= settings.FITS_DOWNLOAD_ATTEMPTS:
-        return
-    encoded_params = urllib.parse.urlencode(
-        {'objid': star.superwasp_id.replace('1SWASP', '1SWASP ')},
-        quote_via=urllib.parse.quote,
-    )
-    fits_url = f'http://wasp.warwick.ac.uk/lcextract?{encoded_params}'
-    fits_data = urllib.request.urlopen(fits_url, timeout=30)
-    star.fits_file.save(f'{star.superwasp_id}.fits', fits_data)
-    star.save()
+    fetch_fits_files([star_id])
 
-    star.get_image_location()
-    star.calculate_magnitudes()
 
-    for lightcurve in star.foldedlightcurve_set.all():
-        lightcurve.get_image_location()
+@shared_task(ignore_result=True)
+@instrumented
+def download_fits_batch(star_ids):
+    fetch_fits_files(star_ids)
 
 
-@shared_task
-def generate_lightcurve_images(lightcurve_id):
-    lightcurve = FoldedLightcurve.objects.get(id=lightcurve_id)
+def fetch_fits_files(star_ids):
+    """
+    Downloads the FITS files for the given stars concurrently, calculates
+    their magnitudes, and queues their images. Stars which already have a
+    FITS file, e.g. from an earlier run whose lease expired, are skipped.
+    """
+    with ArtifactJob.run(ArtifactJob.FITS, star_ids) as renew_leases:
+        stars = list(Star.objects.filter(
+            Q(fits_file=None) | Q(fits_file=''),
+            id__in=star_ids,
+            fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS,
+        ))
+        downloaded = download_fits_files(stars, progress=renew_leases)
+        Star.objects.bulk_update(stars, ['fits_file', 'fits_error_count'])
+        renew_leases()
+        calculate_magnitudes(downloaded)
+
+    for star in downloaded:
+        # An images job may have run (and found no FITS file) during the
+        # download, so this claim overrides its lease.
+        ArtifactJob.claim(ArtifactJob.STAR_IMAGES, star.id, force=True)
+        generate_all_star_images.delay(star.id)
+
+
+def fold_lightcurve(hjd, flux, period_length):
+    """
+    Folds a lightcurve at the given period (in seconds), returning the phase
+    and flux for two cycles. As before, the phase runs from -1 to 1 with the
+    first point at the centre of a cycle.
+    """
+    period = period_length / 86400
+    with timer('fold'):
+        phase = fold_phase(hjd, period, epoch=hjd[0] - period / 2)
+        return tile_cycles(phase - 1, flux)
 
-    if not lightcurve.star.fits:
-        return
-    
-    ts = lightcurve.timeseries
-    if not ts:
-        return
-    epoch_length = ts['time'].max() - ts['time'].min()
-    ts_extend = ts.copy()
-    ts_extend['time'] = ts_extend['time'] + epoch_length
-    ts = vstack([ts, ts_extend])
-    ts_flux = Star.outlier_clip(ts['TAMFLUX2'])
-    ts_data = {
-        'phase': (ts.time / epoch_length) - Quantity(0.5, unit=None),
-        'flux': ts_flux,
-    }
-    fig = pyplot.figure()
-    plot = seaborn.scatterplot(
-        data=ts_data,
-        x='phase',
-        y='flux',
-        alpha=0.5,
-        s=1,
-    )
-    plot.set_title(
-        f'{lightcurve.star.superwasp_id} Period {lightcurve.period_length}s ({lightcurve.get_classification_display()})'
-    )
-    image_data = ContentFile(b'')
-    fig.savefig(image_data)
-    lightcurve.image_file.save(f'lightcurve-{lightcurve.id}.png', image_data)
 
-    thumbnail_data = ContentFile(b'')
-    thumbmail_image = Image.open(image_data)
-    thumbmail_image.thumbnail((100, 60))
-    thumbmail_image.save(thumbnail_data, format='png')
-    lightcurve.thumbnail_file.save(f'lightcurve-{lightcurve.id}-small.png', thumbnail_data)
+def save_image(field_file, name, image_data):
+    with timer('storage_write'):
+        field_file.save(name, image_data, save=False)
+    increment('images_rendered')
+    increment('bytes_written', image_data.size)
 
+
+def save_webp_image(instance, field_name, name, image_data):
+    # WebP depends on how Pillow was built, so there may be nothing to save
+    if image_data is None:
+        setattr(instance, field_name, None)
+    else:
+        save_image(getattr(instance, field_name), name, image_data)
+
+
+def render_star_image(star, lc, flux):
+    rendered = render_lightcurve_variants(lc['HJD'], flux, star.superwasp_id, 'time')
+    save_image(star.image_file, f'lightcurve.png', rendered.image)
+    save_webp_image(star, 'image_webp_file', f'lightcurve.webp', rendered.image_webp)
+    star.image_version = star.CURRENT_IMAGE_VERSION
+
+
+def render_lightcurve_images(lightcurve, lc, flux):
+    phase, folded_flux = fold_lightcurve(lc['HJD'], flux, lightcurve.period_length)
+    rendered = render_lightcurve_variants(
+        phase,
+        folded_flux,
+        f'{lightcurve.star.superwasp_id} Period {lightcurve.period_length}s ({lightcurve.get_classification_display()})',
+        'phase',
+        thumbnail=True,
+    )
+    save_image(lightcurve.image_file, f'lightcurve-{lightcurve.id}.png', rendered.image)
+    save_image(lightcurve.thumbnail_file, f'lightcurve-{lightcurve.id}-small.png', rendered.thumbnail)
+    save_webp_image(lightcurve, 'image_webp_file', f'lightcurve-{lightcurve.id}.webp', rendered.image_webp)
+    save_webp_image(
+        lightcurve,
+        'thumbnail_webp_file',
+        f'lightcurve-{lightcurve.id}-small.webp',
+        rendered.thumbnail_webp,
+    )
     lightcurve.image_version = lightcurve.CURRENT_IMAGE_VERSION
-    lightcurve.save()
-    pyplot.close()
 
 
-@shared_task
-def generate_star_images(star_id):
-    star = Star.objects.get(id=star_id)
+@shared_task(ignore_result=True)
+@instrumented
+def generate_all_star_images(star_id):
+    with ArtifactJob.run(ArtifactJob.STAR_IMAGES, [star_id]):
+        render_all_star_images(Star.objects.get(id=star_id))
+
 
+def render_all_star_images(star):
+    """
+    Renders a star's image and the images for all of its folded lightcurves
+    from a single read and outlier clip of its FITS file.
+    """
     if not star.fits:
+        star.queue_fits_download()
         return
-    
-    ts = star.timeseries
-    if not ts:
+
+    with timer('fits_read'):
+        lc = star.lightcurve
+    if lc is None or not len(lc):
         return
-    ts_flux = Star.outlier_clip(ts['TAMFLUX2'])
-    ts_data = {
-        'time': ts.time.jd,
-        'flux': ts_flux,
-    }
-    fig = pyplot.figure()
-    plot = seaborn.scatterplot(
-        data=ts_data,
-        x='time',
-        y='flux',
-        alpha=0.5,
-        s=1,
-    )
-    plot.set_title(star.superwasp_id)
-    image_data = ContentFile(b'')
-    fig.savefig(image_data)
-    star.image_file.save(f'lightcurve.png', image_data)
-    star.image_version = star.CURRENT_IMAGE_VERSION
-    star.save()
-    pyplot.close()
\ No newline at end of file
+    with timer('sigma_clip'):
+        flux = Star.outlier_clip(lc['TAMFLUX2'])
+
+    render_star_image(star, lc, flux)
+    lightcurves = list(star.foldedlightcurve_set.all())
+    for lightcurve in lightcurves:
+        # Avoid fetching the star again for each lightcurve's title
+        lightcurve.star = star
+        render_lightcurve_images(lightcurve, lc, flux)
+
+    with transaction.atomic():
+        star.save(update_fields=['image_file', 'image_webp_file', 'image_version'])
+        FoldedLightcurve.objects.bulk_update(
+            lightcurves,
+            ['image_file', 'thumbnail_file', 'image_webp_file', 'thumbnail_webp_file', 'image_version'],
+        )
+    invalidate_stars([star.superwasp_id])
@@ -5,6 +5,8 @@ from astropy import units as u
 
 from django import template
 
+from starcatalogue.rendering import THUMBNAIL_SIZE
+
 register = template.Library()
 
 
@@ -20,7 +22,7 @@ def isnan(x):
 
 # From https://www.caktusgroup.com/blog/2018/10/18/filtering-and-pagination-django/
 @register.simple_tag(takes_context=True)
-def param_replace(context, **kwargs):
+def param_replace(context, keep='', **kwargs):
     """
     Return encoded URL parameters that are the same as the current
     request's parameters, only with the specified GET parameters added or changed.
@@ -37,13 +39,19 @@ def param_replace(context, **kwargs):
 
     <a href="/things/?with_frosting=true&page=3">Page 3</a>
 
+    Parameters named in ``keep`` (comma separated) are kept even when empty,
+    e.g. an empty ``cursor`` for the first page of cursor pagination:
+
+    <a href="/things/?{% param_replace cursor='' keep='cursor' %}">First</a>
+
     Based on
     https://stackoverflow.com/questions/22734695/next-and-before-links-for-a-django-paginated-query/22735278#22735278
     """
+    keep = set(keep.split(','))
     d = context['request'].GET.copy()
     for k, v in kwargs.items():
         d[k] = v
-    for k in [k for k, v in d.items() if not v]:
+    for k in [k for k, v in d.items() if not v and k not in keep]:
         del d[k]
     return d.urlencode()
 
@@ -52,4 +60,15 @@ def param_replace(context, **kwargs):
 def startswith(text, starts):
     if isinstance(text, str):
         return text.startswith(starts)
-    return False
\ No newline at end of file
+    return False
+
+@register.simple_tag
+def sprite_cell_style(sprite_url, index):
+    """
+    Returns the inline style which shows the index'th thumbnail of a sprite
+    sheet made by compose_sprite.
+    """
+    width, height = THUMBNAIL_SIZE
+    return 'background: url("{}") 0 -{}px no-repeat; width: {}px; height: {}px;'.format(
+        sprite_url, index * height, width, height,
+    )
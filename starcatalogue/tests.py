@@ -1,3 +1,1772 @@
-from django.test import TestCase
+import base64
+import collections
+import csv
+import datetime
+import http.server
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
 
-# Create your tests here.
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module
+from unittest import mock, skipIf
+
+import numpy
+
+from astropy import units
+from astropy.coordinates import SkyCoord
+from astropy.coordinates.name_resolve import NameResolveError
+from astropy.io import fits, votable
+from astropy.time import Time
+from astropy.timeseries import TimeSeries
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F, Value
+from django.db.models.query import QuerySet
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from PIL import Image
+
+from starcatalogue import metrics
+from starcatalogue.benchmarks import (
+    FOLDS_PER_STAR,
+    IMPORT_COMMANDS,
+    legacy_fold_lightcurve,
+    run_imports,
+    synthetic_export_chunks,
+    write_synthetic_catalogue,
+    write_synthetic_fits,
+)
+from starcatalogue.api import API_FIELDS, API_MAX_LIMIT, parse_fields, parse_limit
+from starcatalogue.caching import (
+    GENERATION_BASE_KEY,
+    catalogue_generation,
+    hit_rates,
+    invalidate_catalogue,
+    invalidate_stars,
+    record_lookup,
+    star_generation,
+    star_generation_key,
+    versioned_key,
+)
+from starcatalogue.cursors import RowCompare, decode_cursor, encode_cursor
+from starcatalogue.downloads import (
+    ConnectionPool,
+    InvalidFITSDownload,
+    download_fits_file,
+    fits_url,
+)
+from starcatalogue.lightcurves import (
+    flux_magnitudes,
+    fold_phase,
+    load_lightcurve,
+    outlier_clip,
+    sidecar_path,
+    tile_cycles,
+)
+from starcatalogue.mediagc import collect_media_garbage, scan_sources
+from starcatalogue.medialayout import migrate_media_layout
+from starcatalogue.models import (
+    ArtifactJob,
+    CatalogueEntry,
+    Counter,
+    DataExport,
+    FoldedLightcurve,
+    ResolvedName,
+    Star,
+    ZooniverseSubject,
+    star_media_dir,
+)
+from starcatalogue.rendering import (
+    THUMBNAIL_SIZE,
+    compose_sprite,
+    render_lightcurve,
+    render_lightcurve_variants,
+    webp_supported,
+)
+from starcatalogue.resolvers import NameResolverUnavailable, SesameResolver, name_cache, resolve_name
+from starcatalogue.stats import calculate_magnitudes
+from starcatalogue.tasks import (
+    EXPORT_DATA_DESCRIPTION,
+    download_fits_batch,
+    fold_lightcurve,
+    generate_all_star_images,
+    pyarrow,
+    write_export_zip,
+)
+from starcatalogue.templatetags.starcatalogue_tags import param_replace
+from starcatalogue.views import StarListView
+from starcatalogue.votable import (
+    SCS_FIELDS,
+    ConeSearchError,
+    ConeSearchStream,
+    base64_lines,
+    error_votable,
+    parse_cone_search,
+)
+from vespa.celery import STATS_QUEUE_INTERVAL, calculate_magnitudes as queue_magnitude_calculations
+
+
+def make_superwasp_id(i):
+    return f'1SWASPJ{i % 24:02d}{i % 60:02d}{i % 60:02d}.00+{i % 90:02d}{i % 60:02d}{i % 60:02d}.0'
+
+
+def make_catalogue(count):
+    for i in range(count):
+        star = Star.objects.create(
+            superwasp_id=make_superwasp_id(i),
+            _min_magnitude=13.0,
+            _mean_magnitude=12.0,
+            _max_magnitude=11.0,
+            stats_version=Star.CURRENT_STATS_VERSION,
+        )
+        lightcurve = FoldedLightcurve.objects.create(
+            star=star,
+            period_number=1,
+            period_length=3600.0 + i,
+            classification=FoldedLightcurve.PULSATOR,
+            period_uncertainty=FoldedLightcurve.CERTAIN,
+            classification_count=10,
+        )
+        ZooniverseSubject.objects.create(
+            zooniverse_id=i,
+            lightcurve=lightcurve,
+            image_location=f'https://panoptes-uploads.zooniverse.org/production/subject_location/{i}.png',
+        )
+    CatalogueEntry.refresh()
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+class ResponseCacheMixin(object):
+    """
+    Starts each test with an empty cache and the catalogue generation already
+    read, and counts response cache lookups in memory until hit_rates() is
+    called, so that query counts don't depend on when lookups are flushed.
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        for name, value in (('_lookups', collections.Counter()), ('LOOKUP_FLUSH_SECONDS', math.inf)):
+            patcher = mock.patch(f'starcatalogue.caching.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        catalogue_generation()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StarListViewTestCase(ResponseCacheMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        make_catalogue(25)
+
+    @mock.patch('starcatalogue.tasks.generate_all_star_images.delay')
+    @mock.patch('starcatalogue.tasks.download_fits.apply_async')
+    def test_browse_page_queries(self, download_fits, generate_images):
+        # An EXPLAIN and a COUNT for the paginator and one SELECT for the
+        # page, however many rows are rendered. The count is then cached.
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('browse'))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('browse'), {'page': 2, 'sort': 'period_length'})
+        # The rendered results are cached too
+        with self.assertNumQueries(0):
+            self.client.get(reverse('browse'), {'page': '2', 'sort': 'period_length', 'order': 'bad'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['object_list']), 5)
+        self.assertEqual(response.context['paginator'].count, 25)
+        self.assertFalse(response.context['paginator'].approximate)
+        download_fits.assert_not_called()
+        generate_images.assert_not_called()
+
+    @override_settings(COUNT_ESTIMATE_THRESHOLD=0)
+    def test_browse_page_approximate_count(self):
+        response = self.client.get(reverse('browse'))
+        paginator = response.context['paginator']
+        self.assertTrue(paginator.approximate)
+        self.assertContains(response, 'of ~{}'.format(paginator.num_pages))
+
+    @override_settings(COUNT_ESTIMATE_THRESHOLD=0)
+    @mock.patch('starcatalogue.counts.estimate_count', return_value=5)
+    def test_browse_pages_past_underestimate(self, estimate_count):
+        response = self.client.get(reverse('browse'))
+        paginator = response.context['paginator']
+        self.assertEqual((paginator.count, paginator.num_pages), (5, 1))
+        self.assertTrue(response.context['page_obj'].has_next())
+        self.assertEqual(len(response.context['object_list']), 20)
+
+        # The rows past the estimate are still reachable by page number
+        response = self.client.get(reverse('browse'), {'page': 2})
+        self.assertEqual(response.status_code, 200)
+        page = response.context['page_obj']
+        self.assertEqual(
+            [entry.superwasp_id for entry in page.object_list],
+            list(StarListView().get_queryset(params={}).values_list('superwasp_id', flat=True))[20:],
+        )
+        self.assertFalse(page.has_next())
+        self.assertEqual(page.end_index(), 25)
+
+        response = self.client.get(reverse('browse'), {'page': 3})
+        self.assertEqual(len(response.context['object_list']), 0)
+
+    def test_browse_count_cache_key(self):
+        response = self.client.get(reverse('browse'), {'type_ew': 'on'})
+        self.assertEqual(response.context['paginator'].count, 0)
+        response = self.client.get(reverse('browse'), {'type_pulsator': 'on'})
+        self.assertEqual(response.context['paginator'].count, 25)
+
+    def test_catalogue_refresh(self):
+        Star.objects.filter(superwasp_id=make_superwasp_id(0)).update(_mean_magnitude=8.0)
+        response = self.client.get(reverse('browse'), {'max_magnitude': 10})
+        self.assertEqual(response.context['paginator'].count, 0)
+
+        CatalogueEntry.refresh()
+        response = self.client.get(reverse('browse'), {'max_magnitude': 10})
+        self.assertEqual(
+            [entry.superwasp_id for entry in response.context['object_list']],
+            [make_superwasp_id(0)],
+        )
+
+    def test_browse_sort(self):
+        response = self.client.get(reverse('browse'), {'sort': 'period_length', 'order': 'desc'})
+        periods = [entry.period_length for entry in response.context['object_list']]
+        self.assertEqual(periods, sorted(periods, reverse=True))
+        self.assertEqual(periods[0], 3624.0)
+
+    def test_cursor_pages_match_numbered_pages(self):
+        # Some NULLs, which sort at one end, and some ties
+        Star.objects.filter(id__in=Star.objects.order_by('id').values('id')[:4]).update(_mean_magnitude=None)
+        Star.objects.filter(id__in=Star.objects.order_by('-id').values('id')[:6]).update(_mean_magnitude=14.0)
+        CatalogueEntry.refresh()
+
+        for sort in ('star___mean_magnitude', 'period_length', 'star__superwasp_id', 'distance'):
+            for order in ('asc', 'desc'):
+                params = {'sort': sort, 'order': order}
+                expected = list(StarListView().get_queryset(params=params).values_list('pk', flat=True))
+
+                walked = []
+                cursor = ''
+                pages = 0
+                while cursor is not None:
+                    response = self.client.get(reverse('browse'), dict(params, cursor=cursor))
+                    self.assertEqual(response.status_code, 200)
+                    page = response.context['page_obj']
+                    walked += [entry.pk for entry in page.object_list]
+                    cursor = page.next_cursor
+                    pages += 1
+                    if cursor is not None:
+                        self.assertIn('rel="next"', response['Link'])
+
+                self.assertEqual(walked, expected, (sort, order))
+                self.assertEqual(pages, 2)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('browse'), {'cursor': 'nonsense'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_page_skips_count(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('browse'), {'cursor': ''})
+        self.assertEqual(len(response.context['object_list']), 20)
+        self.assertContains(response, 'cursor={}'.format(response.context['page_obj'].next_cursor))
+
+    def test_browse_page_uses_zooniverse_images(self):
+        response = self.client.get(reverse('browse'))
+        self.assertContains(response, 'https://thumbnails.zooniverse.org/100x80/')
+
+
+class CursorTestCase(SimpleTestCase):
+    def test_cursor_round_trip(self):
+        token = encode_cursor('star___mean_magnitude', 'desc', 12.345678901234567, 42)
+        self.assertNotIn('=', token)
+        self.assertEqual(
+            decode_cursor(token, 'star___mean_magnitude', 'desc'),
+            (12.345678901234567, 42),
+        )
+        self.assertEqual(
+            decode_cursor(encode_cursor('classification', 'asc', None, 7), 'classification', 'asc'),
+            (None, 7),
+        )
+
+    def test_invalid_cursors(self):
+        token = encode_cursor('period_length', 'asc', 3600.0, 1)
+        for bad_token, sort, order in (
+            (token, 'period_length', 'desc'),
+            (token, 'classification', 'asc'),
+            ('not a cursor', 'period_length', 'asc'),
+            (encode_cursor('period_length', 'asc', 3600.0, '1'), 'period_length', 'asc'),
+        ):
+            with self.assertRaises(ValueError):
+                decode_cursor(bad_token, sort, order)
+
+    def test_seek_sql(self):
+        queryset = CatalogueEntry.objects.order_by('mean_magnitude', 'pk').filter(RowCompare(
+            (F('mean_magnitude'), F('pk')),
+            (Value(12.0), Value(3)),
+            '>',
+        ))
+        sql = str(queryset.query)
+        self.assertIn(
+            '("starcatalogue_catalogueentry"."mean_magnitude", "starcatalogue_catalogueentry"."lightcurve_id") > (12.0, 3)',
+            sql,
+        )
+        self.assertNotIn('OFFSET', str(queryset[:21].query))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogueAPITestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        make_catalogue(25)
+        Star.objects.filter(id__in=Star.objects.order_by('id').values('id')[:3]).update(_mean_magnitude=None)
+        CatalogueEntry.refresh()
+
+    def get_lines(self, params):
+        response = self.client.get(reverse('catalogue_api'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_cursor_pages(self):
+        for order in ('asc', 'desc'):
+            params = {'sort': 'star___mean_magnitude', 'order': order, 'limit': 10}
+            expected = list(StarListView().get_queryset(params=params).values_list('superwasp_id', flat=True))
+
+            walked = []
+            cursor = ''
+            while cursor is not None:
+                lines = self.get_lines(dict(params, cursor=cursor))
+                cursor = lines.pop()['next_cursor'] if 'next_cursor' in lines[-1] else None
+                self.assertLessEqual(len(lines), 10)
+                walked += [line['superwasp_id'] for line in lines]
+            self.assertEqual(walked, expected, order)
+
+    def test_fields(self):
+        lines = self.get_lines({'fields': 'superwasp_id,classification,ra', 'limit': 1})
+        self.assertEqual(lines[0], {
+            'superwasp_id': make_superwasp_id(0),
+            'classification': 'Pulsator',
+            'ra': '0h00m00s',
+        })
+
+    def test_malformed_ids(self):
+        Star.objects.filter(superwasp_id=make_superwasp_id(0)).update(superwasp_id='1SWASPJ0000')
+        CatalogueEntry.refresh()
+        params = {'fields': 'superwasp_id,ra,dec', 'limit': 25}
+        malformed = {'superwasp_id': '1SWASPJ0000', 'ra': None, 'dec': None}
+        lines = self.get_lines(params)
+        self.assertEqual(len(lines), 25)
+        self.assertIn(malformed, lines)
+
+        with self.assertLogs('starcatalogue.models', 'WARNING'):
+            Star.update_locations(Star.missing_locations())
+        self.assertFalse(Star.missing_locations().exists())
+        CatalogueEntry.refresh()
+        self.assertIn(malformed, self.get_lines(params))
+
+    def test_json(self):
+        response = self.client.get(reverse('catalogue_api'), {'format': 'json', 'limit': 20})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(data['results']), 20)
+        self.assertEqual(set(data['results'][0]), set(API_FIELDS))
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_bad_params(self):
+        for params in (
+            {'format': 'xml'},
+            {'fields': 'superwasp_id,colour'},
+            {'fields': 'distance'},
+            {'limit': 0},
+            {'cursor': 'nonsense'},
+        ):
+            response = self.client.get(reverse('catalogue_api'), params)
+            self.assertEqual(response.status_code, 400, params)
+
+
+class ParamReplaceTestCase(SimpleTestCase):
+    def test_param_replace(self):
+        request = RequestFactory().get('/browse/', {'sort': 'period', 'cursor': 'abc', 'page': ''})
+        context = {'request': request}
+        self.assertEqual(param_replace(context, cursor=''), 'sort=period')
+        self.assertEqual(param_replace(context, cursor='', keep='cursor'), 'sort=period&cursor=')
+        self.assertEqual(param_replace(context, cursor='def', page=2), 'sort=period&cursor=def&page=2')
+
+
+class CatalogueAPIParamsTestCase(SimpleTestCase):
+    def test_parse_fields(self):
+        self.assertEqual(parse_fields(''), list(API_FIELDS))
+        self.assertEqual(parse_fields('ra, dec,ra'), ['ra', 'dec'])
+        self.assertEqual(parse_fields('distance', distance=True), ['distance'])
+        with self.assertRaises(ValueError):
+            parse_fields('distance')
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit('5'), 5)
+        self.assertEqual(parse_limit(str(API_MAX_LIMIT + 1)), API_MAX_LIMIT)
+        for limit in ('-1', '0', 'ten'):
+            with self.assertRaises(ValueError):
+                parse_limit(limit)
+
+
+class ListConeSearchStream(ConeSearchStream):
+    # Reads from a list, so the VOTable can be checked without a database
+    def rows(self):
+        return iter(self.queryset[:self.limit + 1])
+
+
+def parse_votable(content):
+    if not isinstance(content, bytes):
+        content = ''.join(content).encode()
+    return votable.parse(io.BytesIO(content))
+
+
+class VOTableTestCase(SimpleTestCase):
+    def make_rows(self, count):
+        return [
+            {
+                'pk': i,
+                'superwasp_id': make_superwasp_id(i),
+                'location': (15.0 * i, -1.5 * i),
+                'distance': math.radians(0.01 * i),
+                'period_length': 3600.0 + i,
+                'mean_magnitude': math.nan if i == 1 else 12.0,
+                'classification': FoldedLightcurve.EW,
+                'max_magnitude': 11.0,
+                'min_magnitude': 13.0,
+                'classification_count': None if i == 1 else 10,
+                'period_uncertainty': FoldedLightcurve.CERTAIN,
+                'sigma': 0.5,
+                'chi_squared': 1.5,
+            }
+            for i in range(count)
+        ]
+
+    def test_binary2_stream(self):
+        content = ''.join(ListConeSearchStream(self.make_rows(3), 3, 10))
+        self.assertIn('<BINARY2><STREAM encoding="base64">', content)
+        document = parse_votable(content)
+        table = document.get_first_table()
+        self.assertEqual([field.name for field in table.fields], [field.name for field in SCS_FIELDS])
+        self.assertEqual(table.get_field_by_id('ra').ucd, 'POS_EQ_RA_MAIN')
+
+        data = table.array
+        self.assertEqual(len(data), 3)
+        self.assertEqual(list(data['superwasp_id']), [make_superwasp_id(i) for i in range(3)])
+        self.assertEqual(list(data['ra']), [0.0, 15.0, 30.0])
+        self.assertEqual(list(data['dec']), [0.0, -1.5, -3.0])
+        self.assertAlmostEqual(data['distance'][2], 0.02)
+        self.assertEqual(data['classification'][0], 'EW')
+        self.assertTrue(data['mean_magnitude'].mask[1])
+        self.assertTrue(data['classification_count'].mask[1])
+        self.assertEqual(data['classification_count'][0], 10)
+        self.assertEqual(
+            [info.value for info in document.resources[0].infos],
+            ['OK'],
+        )
+
+    def test_verb(self):
+        table = parse_votable(ListConeSearchStream(self.make_rows(1), 1, 10)).get_first_table()
+        self.assertEqual([field.name for field in table.fields], ['superwasp_id', 'ra', 'dec'])
+
+    def test_overflow(self):
+        stream = ListConeSearchStream(self.make_rows(5), 2, 4)
+        document = parse_votable(stream)
+        self.assertEqual(len(document.get_first_table().array), 4)
+        self.assertEqual(
+            [(info.name, info.value) for info in document.resources[0].infos],
+            [('QUERY_STATUS', 'OK'), ('QUERY_STATUS', 'OVERFLOW')],
+        )
+
+        document = parse_votable(ListConeSearchStream(self.make_rows(0), 2, 0))
+        self.assertEqual(len(document.get_first_table().array), 0)
+        self.assertEqual(len(document.resources[0].infos), 1)
+
+    def test_base64_lines(self):
+        chunks = [bytes([i % 256]) * 1000 for i in range(200)]
+        lines = ''.join(base64_lines(chunks))
+        self.assertEqual(base64.b64decode(lines), b''.join(chunks))
+        self.assertTrue(all(len(line) <= 76 for line in lines.splitlines()))
+
+    def test_error_votable(self):
+        document = parse_votable(error_votable('RA is required'))
+        self.assertEqual(document.infos[0].name, 'Error')
+        self.assertEqual(document.infos[0].value, 'RA is required')
+        self.assertEqual(document.resources[0].infos[0].value, 'ERROR')
+
+    def test_parse_cone_search(self):
+        self.assertEqual(
+            parse_cone_search({'RA': '10', 'DEC': '-20.5', 'SR': '0.1'}, 100),
+            (10.0, -20.5, 0.1, 2, 100),
+        )
+        self.assertEqual(
+            parse_cone_search({'RA': '10', 'DEC': '20', 'SR': '1', 'VERB': '3', 'MAXREC': '1000'}, 100),
+            (10.0, 20.0, 1.0, 3, 100),
+        )
+        for params in (
+            {'DEC': '0', 'SR': '1'},
+            {'RA': '361', 'DEC': '0', 'SR': '1'},
+            {'RA': '0', 'DEC': 'north', 'SR': '1'},
+            {'RA': '0', 'DEC': '0', 'SR': '-1'},
+            {'RA': '0', 'DEC': '0', 'SR': 'nan'},
+            {'RA': '0', 'DEC': '0', 'SR': '1', 'VERB': '4'},
+            {'RA': '0', 'DEC': '0', 'SR': '1', 'MAXREC': '-1'},
+        ):
+            with self.assertRaises(ConeSearchError):
+                parse_cone_search(params, 100)
+
+
+@override_settings(SCS_MAX_RECORDS=3)
+class ConeSearchViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        make_catalogue(10)
+        Star.update_locations(Star.objects.all())
+        CatalogueEntry.refresh()
+
+    def search(self, **params):
+        response = self.client.get(reverse('cone_search'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/xml; content=x-votable'))
+        if response.streaming:
+            return parse_votable(b''.join(response.streaming_content))
+        return parse_votable(response.content)
+
+    def test_cone_search(self):
+        document = self.search(RA=0, DEC=0, SR=0.5)
+        data = document.get_first_table().array
+        self.assertEqual(list(data['superwasp_id']), [make_superwasp_id(0)])
+        self.assertAlmostEqual(data['distance'][0], 0.0)
+
+    def test_nearest_first_with_cap(self):
+        document = self.search(ra=15, dec=1, sr=60, maxrec=100)
+        data = document.get_first_table().array
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data['superwasp_id'][0], make_superwasp_id(1))
+        self.assertEqual(list(data['distance']), sorted(data['distance']))
+        self.assertEqual(document.resources[0].infos[-1].value, 'OVERFLOW')
+
+    def test_error(self):
+        document = self.search(RA=0, DEC=100, SR=1)
+        self.assertEqual(document.infos[0].name, 'Error')
+
+
+class QueryPlanningTestCase(SimpleTestCase):
+    SEARCH = '10h00m00s +10d00m00s'
+
+    def get_sql(self, **params):
+        view = StarListView()
+        sql = str(view.get_queryset(params=params).query)
+        return view, sql, sql.split(' ORDER BY ')[1]
+
+    def test_no_search(self):
+        view, sql, order_by = self.get_sql()
+        self.assertEqual(view.sort, 'star__superwasp_id')
+        self.assertNotIn('<->', sql)
+        self.assertNotIn('scircle', sql)
+        self.assertNotIn('starcatalogue_star"', sql)
+        self.assertEqual(
+            order_by,
+            '"starcatalogue_catalogueentry"."superwasp_id" ASC, "starcatalogue_catalogueentry"."lightcurve_id" ASC',
+        )
+
+    def test_no_search_distance_sort(self):
+        view, sql, order_by = self.get_sql(sort='distance', order='desc')
+        self.assertEqual(view.sort, 'star__superwasp_id')
+        self.assertNotIn('<->', sql)
+        self.assertEqual(
+            order_by,
+            '"starcatalogue_catalogueentry"."superwasp_id" DESC, "starcatalogue_catalogueentry"."lightcurve_id" DESC',
+        )
+
+    def test_no_search_magnitude_sort(self):
+        view, sql, order_by = self.get_sql(sort='star___mean_magnitude', max_magnitude='12')
+        self.assertNotIn('<->', sql)
+        self.assertIn('"starcatalogue_catalogueentry"."mean_magnitude" <= 12.0', sql)
+        self.assertEqual(
+            order_by,
+            '"starcatalogue_catalogueentry"."mean_magnitude" ASC, "starcatalogue_catalogueentry"."lightcurve_id" ASC',
+        )
+
+    def test_search_distance_sort(self):
+        view, sql, order_by = self.get_sql(search=self.SEARCH)
+        self.assertEqual(view.sort, 'distance')
+        self.assertIn('"starcatalogue_catalogueentry"."location" @ scircle', sql)
+        self.assertIn('"starcatalogue_catalogueentry"."location"<->spoint(', sql)
+        self.assertEqual(order_by, '"distance" ASC, "starcatalogue_catalogueentry"."lightcurve_id" ASC')
+
+    def test_search_other_sort(self):
+        view, sql, order_by = self.get_sql(search=self.SEARCH, sort='period_length')
+        self.assertIn('"starcatalogue_catalogueentry"."location" @ scircle', sql)
+        # Still annotated, to show the distance of each result
+        self.assertIn('AS "distance"', sql)
+        self.assertEqual(
+            order_by,
+            '"starcatalogue_catalogueentry"."period_length" ASC, "starcatalogue_catalogueentry"."lightcurve_id" ASC',
+        )
+
+
+class StarCoordsTestCase(SimpleTestCase):
+    SUPERWASP_IDS = [
+        '1SWASPJ002434.88+382005.9',
+        '1SWASPJ235959.99-000001.3',
+        '1SWASPJ120000.10+100000.0',
+    ]
+
+    def test_parse_coords_matches_skycoord(self):
+        coords = Star.parse_coords(self.SUPERWASP_IDS)
+        for superwasp_id, ra, dec, ra_str, dec_str in zip(
+            self.SUPERWASP_IDS,
+            coords.ra.deg,
+            coords.dec.deg,
+            coords.ra.to_string(units.hour),
+            coords.dec.to_string(),
+        ):
+            expected = SkyCoord(superwasp_id.replace('1SWASP', ''), unit=(units.hour, units.deg))
+            self.assertAlmostEqual(ra, expected.ra.deg)
+            self.assertAlmostEqual(dec, expected.dec.deg)
+            self.assertEqual(ra_str, expected.ra.to_string(units.hour))
+            self.assertEqual(dec_str, expected.dec.to_string())
+
+    def test_malformed_ids(self):
+        stars = [
+            Star(superwasp_id=superwasp_id)
+            for superwasp_id in ['1SWASPJ002434.88+382005.9', '1SWASP J002434', '1SWASPJ002434.88+952005.9']
+        ]
+        with self.assertLogs('starcatalogue.models', 'WARNING') as logs:
+            Star.fill_locations(stars)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(stars[0]._ra, '0h24m34.88s')
+        for star in stars[1:]:
+            self.assertIsNone(star.location)
+            self.assertEqual((star._ra, star._dec), ('', ''))
+
+    def test_catalogue_entry_coords(self):
+        # Parsed from the ID, as SimpleTestCase would fail if the star were loaded
+        entry = CatalogueEntry(superwasp_id=self.SUPERWASP_IDS[0], star_id=1)
+        self.assertEqual((entry.ra, entry.dec), ('0h24m34.88s', '38d20m05.9s'))
+        entry = CatalogueEntry(superwasp_id='1SWASP J002434', star_id=1)
+        self.assertEqual((entry.ra, entry.dec), (None, None))
+
+    def test_ra_dec_are_memoized(self):
+        star = Star(superwasp_id=self.SUPERWASP_IDS[0])
+        self.assertEqual(star.ra, '0h24m34.88s')
+        self.assertEqual(star.dec, '38d20m05.9s')
+        self.assertIs(star.coords, star.coords)
+
+
+class ExportZipTestCase(SimpleTestCase):
+    def test_write_export_zip(self):
+        export_file = io.BytesIO()
+        write_export_zip(
+            export_file,
+            synthetic_export_chunks(25, chunk_size=10),
+            {'object_count': 25},
+        )
+
+        with zipfile.ZipFile(export_file) as export_zip:
+            self.assertEqual(
+                sorted(export_zip.namelist()),
+                ['export.csv', 'fields.yaml', 'params.yaml'],
+            )
+            with export_zip.open('export.csv') as csv_entry:
+                rows = list(csv.reader(io.TextIOWrapper(csv_entry, encoding='utf-8')))
+
+        self.assertEqual(rows[0], list(EXPORT_DATA_DESCRIPTION.keys()))
+        self.assertEqual(len(rows), 26)
+
+    def test_write_fits_export(self):
+        chunks = list(synthetic_export_chunks(25, chunk_size=10))
+        chunks[0][0] = chunks[0][0][:8] + (None,) + chunks[0][0][9:]
+        export_file = io.BytesIO()
+        write_export_zip(export_file, chunks, {'data_version': 0.7}, DataExport.FORMAT_FITS)
+
+        with zipfile.ZipFile(export_file) as export_zip, tempfile.NamedTemporaryFile(suffix='.fits') as fits_file:
+            fits_file.write(export_zip.read('export.fits'))
+            fits_file.flush()
+            with fits.open(fits_file.name) as hdus:
+                table = hdus[1]
+                self.assertEqual(table.columns.names, list(EXPORT_DATA_DESCRIPTION.keys()))
+                self.assertEqual(len(table.data), 25)
+                self.assertEqual(table.data['SuperWASP ID'][11], chunks[1][1][0])
+                self.assertEqual(table.data['Mean magnitude'][24], chunks[2][4][6])
+                self.assertEqual(table.data['Classification count'][0], -1)
+                self.assertEqual(table.header['TCOMM1'], EXPORT_DATA_DESCRIPTION['SuperWASP ID'])
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_write_parquet_export(self):
+        chunks = list(synthetic_export_chunks(25, chunk_size=10))
+        export_file = io.BytesIO()
+        write_export_zip(export_file, chunks, {}, DataExport.FORMAT_PARQUET)
+
+        import pyarrow.parquet
+        with zipfile.ZipFile(export_file) as export_zip:
+            table = pyarrow.parquet.read_table(io.BytesIO(export_zip.read('export.parquet')))
+        self.assertEqual(table.column_names, list(EXPORT_DATA_DESCRIPTION.keys()))
+        self.assertEqual(table.num_rows, 25)
+        self.assertEqual(table.column('RA')[12].as_py(), chunks[1][2][2])
+
+
+class ImportCommandsTestCase(TestCase):
+    def test_import_classifications(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.dat') as class_top:
+            class_top.write(
+                '1 1SWASPJ002434.88+382005.9 1 3600.0 1 0 10\n'
+                '2 1SWASPJ002434.88+382005.9 2 7200.0 3 1 12\n'
+                '3 1SWASPJ120000.10+100000.0 1 100.0 6 0 5\n'
+                '4 1SWASPJ235959.99-000001.3 1\n'
+            )
+            class_top.flush()
+            call_command('importclassifications', class_top.name, chunk_size=1, stdout=io.StringIO())
+            call_command('importclassifications', class_top.name, stdout=io.StringIO())
+
+        self.assertEqual(Star.objects.count(), 1)
+        self.assertEqual(FoldedLightcurve.objects.count(), 2)
+        self.assertEqual(ZooniverseSubject.objects.count(), 2)
+        star = Star.objects.get()
+        self.assertEqual(star.ra, '0h24m34.88s')
+        self.assertIsNotNone(star.location)
+        self.assertEqual(
+            FoldedLightcurve.objects.get(period_number=2).zooniversesubject.zooniverse_id,
+            2,
+        )
+
+    def test_reimport_updates_only_imported_lightcurves(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.dat') as class_top:
+            class_top.write(
+                '1 1SWASPJ002434.88+382005.9 1 3600.0 1 0 10\n'
+                '2 1SWASPJ002434.88+382005.9 2 7200.0 3 1 12\n'
+            )
+            class_top.flush()
+            call_command('importclassifications', class_top.name, stdout=io.StringIO())
+        with tempfile.NamedTemporaryFile('w', suffix='.dat') as class_top:
+            class_top.write('2 1SWASPJ002434.88+382005.9 2 7300.0 3 1 12\n')
+            class_top.flush()
+            bulk_update = mock.patch.object(
+                QuerySet, 'bulk_update', autospec=True, side_effect=QuerySet.bulk_update,
+            )
+            with bulk_update as bulk_update:
+                call_command('importclassifications', class_top.name, stdout=io.StringIO())
+
+        updated = list(bulk_update.call_args.args[1])
+        self.assertEqual([lightcurve.period_number for lightcurve in updated], [2])
+        self.assertEqual(FoldedLightcurve.objects.get(period_number=2).period_length, 7300.0)
+
+
+class SyntheticCatalogueTestCase(SimpleTestCase):
+    def test_import_files_readable(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = write_synthetic_catalogue(temp_dir, 5)
+            for (command, _), path in zip(IMPORT_COMMANDS, paths):
+                module = import_module(f'starcatalogue.management.commands.{command}')
+                with open(path) as f:
+                    self.assertEqual(len(list(module.Command().read_rows(f))), 5 * FOLDS_PER_STAR)
+
+
+class SyntheticImportTestCase(TestCase):
+    def test_run_imports(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            seconds = run_imports(write_synthetic_catalogue(temp_dir, 5))
+
+        self.assertEqual(list(seconds), [command for command, _ in IMPORT_COMMANDS])
+        self.assertEqual(Star.objects.count(), 5)
+        self.assertEqual(CatalogueEntry.objects.count(), 5 * FOLDS_PER_STAR)
+        self.assertFalse(FoldedLightcurve.objects.filter(sigma=None).exists())
+        self.assertFalse(ZooniverseSubject.objects.filter(image_location=None).exists())
+
+
+class LightcurveStoreTestCase(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fits_path = os.path.join(self.temp_dir.name, 'lightcurve.fits')
+        write_synthetic_fits(self.fits_path, points=500)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_load_lightcurve(self):
+        lightcurve = load_lightcurve(1, self.fits_path)
+        self.assertTrue(os.path.exists(sidecar_path(self.fits_path)))
+        with fits.open(self.fits_path) as fits_file:
+            data = fits_file[1].data
+            numpy.testing.assert_allclose(lightcurve['HJD'], data['TMID'] / 86400 + 2453005.5)
+            numpy.testing.assert_allclose(lightcurve['TAMFLUX2'], data['TAMFLUX2'])
+        self.assertIs(load_lightcurve(1, self.fits_path), lightcurve)
+
+    def test_replaced_fits_file_is_reloaded(self):
+        lightcurve = load_lightcurve(2, self.fits_path)
+        write_synthetic_fits(self.fits_path, points=200, seed=1)
+        stat = os.stat(self.fits_path)
+        os.utime(self.fits_path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(len(load_lightcurve(2, self.fits_path)), 200)
+        self.assertEqual(len(lightcurve), 500)
+
+
+class MediaRootMixin(object):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_root.cleanup()
+        super().tearDown()
+
+    def make_star_with_fits(self, i, **kwargs):
+        star = Star.objects.create(superwasp_id=make_superwasp_id(i), **kwargs)
+        star.fits_file.name = f'sources/{star.superwasp_id}/{star.superwasp_id}.fits'
+        os.makedirs(os.path.dirname(star.fits_file.path), exist_ok=True)
+        write_synthetic_fits(star.fits_file.path, seed=i)
+        star.save()
+        return star
+
+
+class MediaGCTestCase(MediaRootMixin, TestCase):
+    def write_media(self, name, age=2 * 86400):
+        path = os.path.join(self.media_root.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def setUp(self):
+        super().setUp()
+        self.star = self.make_star_with_fits(0)
+        self.lightcurve = FoldedLightcurve.objects.create(star=self.star, period_number=1, period_length=3600)
+        star_dir = f'sources/{self.star.superwasp_id}'
+        self.star.image_file.name = f'{star_dir}/v{Star.CURRENT_IMAGE_VERSION}_lightcurve.png'
+        self.star.save()
+        self.lightcurve.image_file.name = f'{star_dir}/v{FoldedLightcurve.CURRENT_IMAGE_VERSION}_lightcurve-1.png'
+        self.lightcurve.save()
+
+        self.kept = [
+            self.write_media(self.star.image_file.name),
+            self.write_media(self.lightcurve.image_file.name),
+            self.write_media(f'{star_dir}/{self.star.superwasp_id}.fits.npy'),
+            # Written by a worker which hasn't saved the record yet
+            self.write_media(f'{star_dir}/v{Star.CURRENT_IMAGE_VERSION}_lightcurve_AbCdEfG.png', age=60),
+        ]
+        self.outdated = [
+            self.write_media(f'{star_dir}/v0.5_lightcurve.png'),
+            self.write_media(f'{star_dir}/v0.5_lightcurve-1-small.png'),
+        ]
+        self.orphaned = [
+            self.write_media(f'{star_dir}/v{Star.CURRENT_IMAGE_VERSION}_lightcurve_HiJkLmN.png'),
+            self.write_media(f'sources/{make_superwasp_id(1)}/v{Star.CURRENT_IMAGE_VERSION}_lightcurve.png'),
+        ]
+        self.temporary = [self.write_media(f'{star_dir}/tmpabcdef.part')]
+
+    def test_dry_run(self):
+        report = collect_media_garbage(batch_size=1)
+        self.assertEqual(report.garbage, {
+            'outdated': [2, 200],
+            'orphaned': [2, 200],
+            'temporary': [1, 100],
+            'migrated': [0, 0],
+        })
+        self.assertEqual(report.reclaimable_bytes, 500)
+        self.assertEqual(report.recent, 1)
+        self.assertEqual(report.removed, 0)
+        for path in self.kept + self.outdated + self.orphaned + self.temporary:
+            self.assertTrue(os.path.exists(path))
+
+    def test_delete(self):
+        report = collect_media_garbage(dry_run=False)
+        self.assertEqual(report.removed, 5)
+        for path in self.kept:
+            self.assertTrue(os.path.exists(path))
+        for path in self.outdated + self.orphaned + self.temporary:
+            self.assertFalse(os.path.exists(path))
+
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as archive_root:
+            report = collect_media_garbage(dry_run=False, archive_root=archive_root, limit=3)
+            self.assertEqual(report.removed, 3)
+            self.assertEqual(report.reclaimable_files, 5)
+            archived = [
+                os.path.join(root, name)
+                for root, _, names in os.walk(archive_root) for name in names
+            ]
+            self.assertEqual(len(archived), 3)
+            for path in archived:
+                self.assertTrue(os.path.relpath(path, archive_root).startswith('sources/'))
+
+    def test_busy_stars_kept(self):
+        ArtifactJob.claim(ArtifactJob.STAR_IMAGES, self.star.id)
+        report = collect_media_garbage(dry_run=False)
+        # Only the temporary file and the other star's image
+        self.assertEqual(report.removed, 2)
+        self.assertEqual(report.busy, 3)
+        for path in self.outdated:
+            self.assertTrue(os.path.exists(path))
+
+
+class MediaLayoutTestCase(MediaRootMixin, TestCase):
+    def test_star_media_dir(self):
+        star = Star(superwasp_id=make_superwasp_id(0))
+        media_dir = star_media_dir(star.superwasp_id)
+        self.assertRegex(media_dir, r'^sources/[0-9a-f]{3}/1SWASPJ')
+        self.assertEqual(
+            star.fits_file.field.generate_filename(star, 'x.fits'),
+            f'{media_dir}/v{Star.CURRENT_IMAGE_VERSION}_x.fits',
+        )
+
+    def make_legacy_star(self, i):
+        star = self.make_star_with_fits(i)
+        load_lightcurve(star.id, star.fits_file.path)
+        legacy_dir = os.path.dirname(star.fits_file.path)
+        star.image_file.name = f'sources/{star.superwasp_id}/v0.5_lightcurve.png'
+        star.save()
+        lightcurve = FoldedLightcurve.objects.create(star=star, period_number=1, period_length=3600)
+        lightcurve.image_file.name = f'sources/{star.superwasp_id}/v0.5_lightcurve-1.png'
+        lightcurve.thumbnail_file.name = f'sources/{star.superwasp_id}/v0.5_lightcurve-1-small.png'
+        lightcurve.save()
+        for field_file in (star.image_file, lightcurve.image_file, lightcurve.thumbnail_file):
+            with open(field_file.path, 'wb') as f:
+                f.write(field_file.name.encode())
+        return star, legacy_dir
+
+    def test_migrate_media_layout(self):
+        star, legacy_dir = self.make_legacy_star(0)
+        other_star, other_legacy_dir = self.make_legacy_star(1)
+        # As if an earlier run linked this file and was interrupted
+        new_fits_path = default_storage.path(
+            f'{star_media_dir(other_star.superwasp_id)}/{os.path.basename(other_star.fits_file.name)}'
+        )
+        os.makedirs(os.path.dirname(new_fits_path))
+        os.link(other_star.fits_file.path, new_fits_path)
+
+        report = migrate_media_layout(batch_size=1)
+        self.assertEqual(report.moved_stars, 2)
+        self.assertEqual(report.moved_files, 8)
+        self.assertEqual(report.last_id, other_star.id)
+
+        for star in (star, other_star):
+            star.refresh_from_db()
+            media_dir = star_media_dir(star.superwasp_id)
+            lightcurve = star.foldedlightcurve_set.get()
+            for field_file in (star.fits_file, star.image_file, lightcurve.image_file, lightcurve.thumbnail_file):
+                self.assertTrue(field_file.name.startswith(f'{media_dir}/'))
+                self.assertTrue(os.path.exists(field_file.path))
+            self.assertTrue(os.path.exists(sidecar_path(star.fits_file.path)))
+            self.assertEqual(len(load_lightcurve(star.id, star.fits_file.path)), 10000)
+        with open(lightcurve.image_file.path, 'rb') as f:
+            self.assertEqual(f.read(), f'sources/{star.superwasp_id}/v0.5_lightcurve-1.png'.encode())
+        # The old names are left for gcmedia, until its grace period has passed
+        self.assertEqual(len(os.listdir(legacy_dir)), 5)
+
+        report = migrate_media_layout()
+        self.assertEqual(report.stars, 2)
+        self.assertEqual(report.moved_files, 0)
+
+        report = collect_media_garbage(dry_run=False)
+        self.assertEqual(report.recent, 10)
+        self.assertEqual(report.removed, 0)
+        report = collect_media_garbage(dry_run=False, grace_seconds=0)
+        self.assertEqual(report.garbage['migrated'][0], 10)
+        self.assertEqual(report.removed, 10)
+        self.assertFalse(os.path.exists(legacy_dir))
+        self.assertFalse(os.path.exists(other_legacy_dir))
+        self.assertEqual(len(load_lightcurve(star.id, star.fits_file.path)), 10000)
+
+    def test_gc_scans_both_layouts(self):
+        legacy = os.path.join(self.media_root.name, 'sources', make_superwasp_id(0), 'a.png')
+        fanned_out = default_storage.path(f'{star_media_dir(make_superwasp_id(1))}/b.png')
+        for path in (legacy, fanned_out):
+            os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+        scanned = {
+            superwasp_id: [media_file.name for media_file in files]
+            for superwasp_id, files in scan_sources(default_storage.path('sources'))
+        }
+        self.assertEqual(scanned, {
+            make_superwasp_id(0): [f'sources/{make_superwasp_id(0)}/a.png'],
+            make_superwasp_id(1): [f'{star_media_dir(make_superwasp_id(1))}/b.png'],
+        })
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MagnitudesTestCase(MediaRootMixin, TestCase):
+    def test_flux_magnitudes(self):
+        fits_path = os.path.join(self.media_root.name, 'lightcurve.fits')
+        write_synthetic_fits(fits_path)
+        flux = load_lightcurve(0, fits_path)['TAMFLUX2']
+        clipped = outlier_clip(flux)
+        self.assertEqual(flux_magnitudes(flux), (
+            15 - 2.5 * numpy.log10(clipped.min()),
+            15 - 2.5 * numpy.log10(clipped.mean()),
+            15 - 2.5 * numpy.log10(clipped.max()),
+        ))
+
+    def test_calculate_magnitudes(self):
+        stars = [self.make_star_with_fits(i) for i in range(3)]
+        stars[2].fits_file.name = 'sources/missing.fits'
+        stars[2].save()
+
+        # One update for the stars, and one to bump their generations
+        with self.assertNumQueries(2):
+            calculate_magnitudes(stars)
+
+        for star in stars[:2]:
+            star.refresh_from_db()
+            self.assertEqual(star.stats_version, Star.CURRENT_STATS_VERSION)
+            self.assertLess(star._max_magnitude, star._mean_magnitude)
+            self.assertLess(star._mean_magnitude, star._min_magnitude)
+        stars[2].refresh_from_db()
+        self.assertFalse(stars[2].fits_file)
+        self.assertEqual(stars[2].fits_error_count, 1)
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_worker_timings_recorded(self):
+        stars = [self.make_star_with_fits(i) for i in range(2)]
+
+        @metrics.instrumented
+        def calculate_star_magnitudes():
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                calculate_magnitudes(stars, executor)
+
+        with self.assertLogs('starcatalogue.metrics', 'INFO') as logs:
+            calculate_star_magnitudes()
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['stages']['fits_read']['count'], 2)
+        self.assertEqual(record['stages']['sigma_clip']['count'], 2)
+
+
+class RenderingTestCase(SimpleTestCase):
+    def test_render_lightcurve(self):
+        x = numpy.linspace(0, 1, 1000)
+        y = numpy.ma.masked_greater(numpy.sin(x * 20), 0.9)
+        image_data, thumbnail_data = render_lightcurve(x, y, 'Test', 'phase', thumbnail=True)
+        self.assertEqual(Image.open(image_data).size, (640, 480))
+        self.assertEqual(Image.open(thumbnail_data).size, (80, 60))
+
+        image_data, thumbnail_data = render_lightcurve(x, y, 'Test', 'time')
+        self.assertEqual(Image.open(image_data).format, 'PNG')
+        self.assertIsNone(thumbnail_data)
+
+    def test_render_lightcurve_variants(self):
+        x = numpy.linspace(0, 1, 1000)
+        y = numpy.sin(x * 20)
+        rendered = render_lightcurve_variants(x, y, 'Test', 'phase', thumbnail=True)
+        self.assertEqual(Image.open(rendered.image).format, 'PNG')
+        if not webp_supported():
+            self.assertIsNone(rendered.image_webp)
+            self.assertIsNone(rendered.thumbnail_webp)
+            return
+        image = Image.open(rendered.image_webp)
+        self.assertEqual((image.format, image.size), ('WEBP', (640, 480)))
+        self.assertEqual(Image.open(rendered.thumbnail_webp).size, (80, 60))
+        self.assertLess(rendered.image_webp.size, rendered.image.size)
+
+    def test_compose_sprite(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'thumbnail.png')
+            Image.new('RGB', (80, 60), 'black').save(path)
+            sprite = Image.open(io.BytesIO(compose_sprite([path, None, path], 'png')))
+
+        width, height = THUMBNAIL_SIZE
+        self.assertEqual(sprite.size, (width, height * 3))
+        self.assertEqual(sprite.getpixel((50, 30)), (0, 0, 0))
+        self.assertEqual(sprite.getpixel((5, 30)), (255, 255, 255))
+        self.assertEqual(sprite.getpixel((50, height + 30)), (255, 255, 255))
+        self.assertEqual(sprite.getpixel((50, 2 * height + 30)), (0, 0, 0))
+
+
+class StarImagesTestCase(MediaRootMixin, TestCase):
+    def test_generate_all_star_images(self):
+        star = self.make_star_with_fits(0)
+        for period_number in range(1, 4):
+            FoldedLightcurve.objects.create(
+                star=star,
+                period_number=period_number,
+                period_length=3600.0 * period_number,
+                classification=FoldedLightcurve.EW,
+            )
+
+        with mock.patch('starcatalogue.lightcurves.fits.open', wraps=fits.open) as fits_open:
+            generate_all_star_images(star.id)
+        fits_open.assert_called_once()
+
+        star.refresh_from_db()
+        self.assertEqual(star.image_version, Star.CURRENT_IMAGE_VERSION)
+        self.assertTrue(os.path.exists(star.image_file.path))
+        for lightcurve in star.foldedlightcurve_set.all():
+            self.assertEqual(lightcurve.image_version, FoldedLightcurve.CURRENT_IMAGE_VERSION)
+            self.assertTrue(os.path.exists(lightcurve.image_file.path))
+            self.assertTrue(os.path.exists(lightcurve.thumbnail_file.path))
+            if webp_supported():
+                self.assertTrue(os.path.exists(lightcurve.thumbnail_webp_file.path))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ResponseCacheTestCase(ResponseCacheMixin, MediaRootMixin, TestCase):
+    def make_current_star(self, i):
+        star = self.make_star_with_fits(
+            i,
+            image_version=Star.CURRENT_IMAGE_VERSION,
+            stats_version=Star.CURRENT_STATS_VERSION,
+            _min_magnitude=13.0,
+            _mean_magnitude=12.0,
+            _max_magnitude=11.0,
+        )
+        star.image_file.name = f'sources/{star.superwasp_id}/lightcurve.png'
+        star.save()
+        return star
+
+    def test_versioned_key_changes_on_invalidation(self):
+        params = {'page': 1}
+        key = versioned_key('test', params, catalogue_generation())
+        self.assertEqual(key, versioned_key('test', dict(params), catalogue_generation()))
+
+        star_key = versioned_key('test', params, star_generation('1SWASP'))
+        invalidate_stars(['1SWASP'])
+        self.assertEqual(key, versioned_key('test', params, catalogue_generation()))
+        self.assertNotEqual(star_key, versioned_key('test', params, star_generation('1SWASP')))
+
+        invalidate_catalogue()
+        self.assertNotEqual(key, versioned_key('test', params, catalogue_generation()))
+
+        key = versioned_key('test', params, catalogue_generation())
+        with override_settings(DATA_VERSION=settings.DATA_VERSION + 1):
+            self.assertNotEqual(key, versioned_key('test', params, catalogue_generation()))
+
+    def test_generations_start_from_base_without_writes(self):
+        base = Counter.get_values([GENERATION_BASE_KEY]).get(GENERATION_BASE_KEY, 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(star_generation('1SWASP'), base)
+        self.assertEqual(Counter.get_values([star_generation_key('1SWASP')]), {})
+
+        invalidate_stars(['1SWASP'])
+        self.assertEqual(star_generation('1SWASP'), base + 1)
+        invalidate_stars(['1SWASP'])
+        self.assertEqual(star_generation('1SWASP'), base + 2)
+
+    def test_source_page_cached_until_invalidated(self):
+        star = self.make_current_star(0)
+        url = reverse('view_source', args=[star.superwasp_id])
+
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, star.superwasp_id)
+        self.assertEqual(hit_rates()['source'][:2], (1, 1))
+
+        invalidate_stars([star.superwasp_id])
+        self.client.get(url)
+        self.assertEqual(hit_rates()['source'][:2], (1, 2))
+
+    @mock.patch('starcatalogue.models.generate_all_star_images.delay')
+    def test_incomplete_source_page_not_cached(self, generate_all_star_images):
+        star = self.make_current_star(0)
+        Star.objects.filter(id=star.id).update(image_version=None)
+        url = reverse('view_source', args=[star.superwasp_id])
+
+        self.client.get(url)
+        self.client.get(url)
+        generate_all_star_images.assert_called_once_with(star.id)
+        self.assertEqual(hit_rates()['source'][:2], (0, 2))
+
+
+# The configured backend, culling after a few entries
+CULLING_CACHES = {
+    'default': dict(settings.CACHES['default'], OPTIONS={'MAX_ENTRIES': 10, 'CULL_FREQUENCY': 2}),
+}
+
+
+@override_settings(CACHES=CULLING_CACHES)
+class ConfiguredCacheTestCase(ResponseCacheMixin, TestCase):
+    def test_counters_survive_culling(self):
+        generation = catalogue_generation()
+        record_lookup('browse', True)
+        record_lookup('browse', False)
+        hit_rates()
+
+        for i in range(50):
+            cache.set(f'filler:{i}', i)
+        self.assertEqual(catalogue_generation(), generation)
+        self.assertEqual(hit_rates()['browse'][:2], (1, 1))
+
+        invalidate_catalogue()
+        for i in range(50):
+            cache.set(f'filler:{i}', i)
+        self.assertEqual(catalogue_generation(), generation + 1)
+
+
+class CounterTestCase(TransactionTestCase):
+    def test_concurrent_adds(self):
+        def add():
+            for i in range(20):
+                Counter.add({'test:a': 1, 'test:b': 2})
+            connection.close()
+
+        threads = [threading.Thread(target=add) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(Counter.get_values(['test:a', 'test:b', 'test:c']), {'test:a': 80, 'test:b': 160})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ThumbnailSpriteTestCase(ResponseCacheMixin, MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        make_catalogue(3)
+        lightcurve = FoldedLightcurve.objects.get(star__superwasp_id=make_superwasp_id(1))
+        lightcurve.thumbnail_file.name = f'{star_media_dir(lightcurve.star.superwasp_id)}/lightcurve-small.png'
+        lightcurve.image_version = FoldedLightcurve.CURRENT_IMAGE_VERSION
+        lightcurve.save()
+        os.makedirs(os.path.dirname(lightcurve.thumbnail_file.path))
+        Image.new('RGB', (80, 60), 'black').save(lightcurve.thumbnail_file.path)
+
+    def test_sprite(self):
+        url = reverse('browse_sprite') + '?sort=star__superwasp_id'
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Vary'], 'Accept')
+        sprite = Image.open(io.BytesIO(response.content))
+        self.assertEqual(sprite.size, (100, 180))
+        self.assertEqual(sprite.getpixel((50, 30)), (255, 255, 255))
+        self.assertEqual(sprite.getpixel((50, 90)), (0, 0, 0))
+
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.assertEqual(hit_rates()['sprite'][:2], (1, 1))
+
+        if webp_supported():
+            response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*')
+            self.assertEqual(response['Content-Type'], 'image/webp')
+
+    def test_results_use_sprite(self):
+        response = self.client.get(reverse('browse'), {'sort': 'star__superwasp_id'})
+        self.assertContains(response, reverse('browse_sprite'))
+        self.assertContains(response, '0 -60px')
+        # Thumbnails which haven't been rendered still come from Zooniverse
+        self.assertContains(response, 'subject_location/0.png')
+
+    def test_sprite_url_is_canonical(self):
+        sprite_url = self.client.get(reverse('browse'), {'sort': 'period_length'}).context['sprite_url']
+        self.assertIn(f'generation={catalogue_generation()}', sprite_url)
+        for params in (
+            {'sort': 'period_length', 'order': 'bad', 'page': '1'},
+            {'sort': 'period_length', 'type_ew': 'off', 'utm_source': 'x'},
+        ):
+            response = self.client.get(reverse('browse'), params)
+            self.assertEqual(response.context['sprite_url'], sprite_url, params)
+
+        # Searches are given by their coordinates
+        response = self.client.get(reverse('browse'), {'search': '0h0m0s +0d0m0s', 'search_radius': '5'})
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(response.context['sprite_url']).query)
+        self.assertEqual(params['search'], ['00h00m00.000000s +00d00m00.000000s'])
+        self.assertEqual(params['search_radius'], ['5.0'])
+
+
+class ArtifactJobTestCase(MediaRootMixin, TestCase):
+    def test_claim(self):
+        self.assertTrue(ArtifactJob.claim(ArtifactJob.FITS, 1))
+        self.assertFalse(ArtifactJob.claim(ArtifactJob.FITS, 1))
+        self.assertTrue(ArtifactJob.claim(ArtifactJob.STAR_IMAGES, 1))
+        self.assertTrue(ArtifactJob.claim(ArtifactJob.FITS, 2))
+        self.assertTrue(ArtifactJob.claim(ArtifactJob.FITS, 1, force=True))
+
+        ArtifactJob.objects.filter(object_id=1).update(lease_expires=timezone.now())
+        self.assertTrue(ArtifactJob.claim(ArtifactJob.FITS, 1))
+        job = ArtifactJob.objects.get(kind=ArtifactJob.FITS, object_id=1)
+        self.assertEqual(job.state, ArtifactJob.QUEUED)
+        self.assertEqual(job.attempts, 3)
+
+    def test_run(self):
+        ArtifactJob.claim(ArtifactJob.FITS, 1)
+        with ArtifactJob.run(ArtifactJob.FITS, [1]):
+            self.assertEqual(ArtifactJob.objects.get().state, ArtifactJob.RUNNING)
+        self.assertEqual(ArtifactJob.objects.get().state, ArtifactJob.DONE)
+
+        ArtifactJob.objects.update(lease_expires=timezone.now())
+        with self.assertRaises(OSError):
+            with ArtifactJob.run(ArtifactJob.FITS, [1]):
+                raise OSError()
+        self.assertEqual(ArtifactJob.objects.get().state, ArtifactJob.FAILED)
+        # Failures aren't retried until the lease expires
+        self.assertFalse(ArtifactJob.claim(ArtifactJob.FITS, 1))
+
+    def test_claim_many(self):
+        ArtifactJob.claim(ArtifactJob.STATS, 2)
+        self.assertEqual(ArtifactJob.claim_many(ArtifactJob.STATS, [3, 2, 1], lease_seconds=3600), [3, 1])
+        self.assertEqual(ArtifactJob.claim_many(ArtifactJob.STATS, [1, 2, 3]), [])
+        self.assertGreater(
+            ArtifactJob.objects.get(kind=ArtifactJob.STATS, object_id=1).lease_expires,
+            timezone.now() + datetime.timedelta(seconds=settings.TASK_LEASE_SECONDS),
+        )
+
+    @mock.patch('starcatalogue.tasks.calculate_star_magnitudes.apply_async')
+    def test_magnitudes_queued_once(self, calculate_star_magnitudes):
+        stars = [self.make_star_with_fits(i) for i in range(3)]
+        # Without a FITS file, so there's nothing to calculate
+        Star.objects.create(superwasp_id=make_superwasp_id(3))
+        queue_magnitude_calculations()
+        queue_magnitude_calculations()
+        calculate_star_magnitudes.assert_called_once()
+        args, kwargs = calculate_star_magnitudes.call_args
+        self.assertEqual(args[0][0], [star.id for star in stars])
+        self.assertEqual(kwargs, {'expires': STATS_QUEUE_INTERVAL})
+
+    @override_settings(TASK_LEASE_SECONDS=300)
+    def test_run_renews_leases(self):
+        ArtifactJob.claim(ArtifactJob.FITS, 1)
+        with mock.patch('starcatalogue.models.time.monotonic', side_effect=[0, 60, 200, 200]):
+            with ArtifactJob.run(ArtifactJob.FITS, [1]) as renew_leases:
+                ArtifactJob.objects.update(lease_expires=timezone.now())
+                # Only once a third of the lease has passed
+                with self.assertNumQueries(0):
+                    renew_leases()
+                with self.assertNumQueries(1):
+                    renew_leases()
+                self.assertFalse(ArtifactJob.claim(ArtifactJob.FITS, 1))
+
+    @mock.patch('starcatalogue.models.download_fits.apply_async')
+    def test_fits_queued_once(self, download_fits):
+        star = Star.objects.create(superwasp_id=make_superwasp_id(0))
+        with self.assertNumQueries(0):
+            self.assertIsNone(star.fits)
+        download_fits.assert_not_called()
+
+        star.queue_fits_download()
+        Star.objects.get(id=star.id).queue_fits_download()
+        download_fits.assert_called_once_with((star.id,), expires=settings.TASK_LEASE_SECONDS)
+
+        Star.objects.filter(id=star.id).update(fits_error_count=settings.FITS_DOWNLOAD_ATTEMPTS)
+        ArtifactJob.objects.update(lease_expires=timezone.now())
+        Star.objects.get(id=star.id).queue_fits_download()
+        download_fits.assert_called_once()
+
+    @mock.patch('starcatalogue.models.generate_all_star_images.delay')
+    def test_images_queued_once_per_source_page(self, generate_all_star_images):
+        star = self.make_star_with_fits(0)
+        lightcurves = [
+            FoldedLightcurve.objects.create(star=star, period_number=i, period_length=3600.0 * i)
+            for i in range(1, 4)
+        ]
+        for lightcurve in lightcurves:
+            ZooniverseSubject.objects.create(
+                zooniverse_id=lightcurve.id,
+                lightcurve=lightcurve,
+                image_location='https://panoptes-uploads.zooniverse.org/production/subject_location/0.png',
+            )
+
+        # Rendering a page only reads
+        with self.assertNumQueries(0):
+            self.assertIsNone(star.image_location)
+        for lightcurve in FoldedLightcurve.objects.select_related('zooniversesubject'):
+            with self.assertNumQueries(0):
+                self.assertTrue(lightcurve.image_location.startswith('https://panoptes-uploads'))
+        generate_all_star_images.assert_not_called()
+
+        url = reverse('view_source', args=[star.superwasp_id])
+        self.client.get(url)
+        generate_all_star_images.assert_called_once_with(star.id)
+        self.client.get(url)
+        generate_all_star_images.assert_called_once()
+
+    @mock.patch('starcatalogue.models.generate_all_star_images.delay')
+    @mock.patch('starcatalogue.models.download_fits.apply_async')
+    def test_source_page_queues_download_before_images(self, download_fits, generate_all_star_images):
+        star = Star.objects.create(superwasp_id=make_superwasp_id(0))
+        self.client.get(reverse('view_source', args=[star.superwasp_id]))
+        download_fits.assert_called_once_with((star.id,), expires=settings.TASK_LEASE_SECONDS)
+        generate_all_star_images.assert_not_called()
+
+
+class FITSStandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves synthetic FITS files in place of the lcextract endpoint, keeping
+    connections alive. Set files to a dict of objid: bytes.
+    """
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    connections = set()
+
+    def do_GET(self):
+        FITSStandInHandler.connections.add(self.client_address)
+        objid = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)['objid'][0]
+        data = self.files.get(objid)
+        if data is None:
+            self.send_response(404)
+            data = b'Not found'
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FITSStandInMixin(object):
+    def setUp(self):
+        super().setUp()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FITSStandInHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        FITSStandInHandler.files = {}
+        FITSStandInHandler.connections = set()
+        self.url_override = override_settings(
+            FITS_DOWNLOAD_URL='http://127.0.0.1:{}/lcextract'.format(self.server.server_port),
+        )
+        self.url_override.enable()
+
+    def tearDown(self):
+        self.url_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        super().tearDown()
+
+    def serve_fits(self, superwasp_id, seed=0):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'lightcurve.fits')
+            write_synthetic_fits(path, points=1000, seed=seed)
+            with open(path, 'rb') as f:
+                data = f.read()
+        FITSStandInHandler.files[superwasp_id.replace('1SWASP', '1SWASP ')] = data
+        return data
+
+
+class FITSDownloadTestCase(FITSStandInMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def test_connections_reused(self):
+        pool = ConnectionPool(timeout=5)
+        paths = []
+        for i in range(5):
+            superwasp_id = make_superwasp_id(i)
+            data = self.serve_fits(superwasp_id, seed=i)
+            path = os.path.join(self.tmp.name, f'{i}.fits')
+            self.assertEqual(download_fits_file(pool, fits_url(superwasp_id), path), len(data))
+            paths.append(path)
+        pool.close()
+
+        self.assertEqual(len(FITSStandInHandler.connections), 1)
+        for path in paths:
+            self.assertEqual(len(load_lightcurve(0, path)), 1000)
+
+    def test_invalid_downloads_not_written(self):
+        pool = ConnectionPool(timeout=5)
+        superwasp_id = make_superwasp_id(0)
+        data = self.serve_fits(superwasp_id)
+        path = os.path.join(self.tmp.name, 'sources', 'lightcurve.fits')
+
+        for bad_data in (b'<html>Error</html>', data[:-2880], b'X' + data[1:]):
+            FITSStandInHandler.files['1SWASP ' + superwasp_id[6:]] = bad_data
+            with self.assertRaises(InvalidFITSDownload):
+                download_fits_file(pool, fits_url(superwasp_id), path)
+        with self.assertRaises(InvalidFITSDownload):
+            download_fits_file(pool, fits_url(make_superwasp_id(1)), path)
+        with override_settings(FITS_DOWNLOAD_MAX_SIZE=len(data) - 1):
+            FITSStandInHandler.files['1SWASP ' + superwasp_id[6:]] = data
+            with self.assertRaises(InvalidFITSDownload):
+                download_fits_file(pool, fits_url(superwasp_id), path)
+        pool.close()
+
+        # Nothing left behind, not even the temporary files
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+
+class FITSDownloadTaskTestCase(FITSStandInMixin, MediaRootMixin, TestCase):
+    @mock.patch('starcatalogue.tasks.generate_all_star_images.delay')
+    def test_download_fits_batch(self, generate_all_star_images):
+        stars = [Star.objects.create(superwasp_id=make_superwasp_id(i)) for i in range(6)]
+        for star in stars[:5]:
+            self.serve_fits(star.superwasp_id, seed=star.id)
+        # Already downloaded, by a run whose lease expired
+        downloaded_star = self.make_star_with_fits(6)
+
+        with override_settings(FITS_DOWNLOAD_CONCURRENCY=2):
+            download_fits_batch([star.id for star in stars + [downloaded_star]])
+
+        # Two workers, each with its own keep-alive connection
+        self.assertLessEqual(len(FITSStandInHandler.connections), 2)
+        for star in stars[:5]:
+            star.refresh_from_db()
+            self.assertTrue(os.path.exists(star.fits_file.path))
+            self.assertEqual(star.stats_version, Star.CURRENT_STATS_VERSION)
+            self.assertEqual(star.fits_error_count, 0)
+        stars[5].refresh_from_db()
+        self.assertFalse(stars[5].fits_file)
+        self.assertEqual(stars[5].fits_error_count, 1)
+        self.assertEqual(generate_all_star_images.call_count, 5)
+        self.assertEqual(Star.objects.get(id=downloaded_star.id).fits_error_count, 0)
+
+    @mock.patch('starcatalogue.management.commands.downloadfits.download_fits_batch.delay')
+    def test_downloadfits_command(self, download_fits_batch_delay):
+        stars = [Star.objects.create(superwasp_id=make_superwasp_id(i)) for i in range(4)]
+        # Stars whose FITS file couldn't be read are saved with NULL
+        Star.objects.filter(id=stars[1].id).update(fits_file=None)
+        Star.objects.filter(id=stars[2].id).update(fits_error_count=settings.FITS_DOWNLOAD_ATTEMPTS)
+        self.make_star_with_fits(4)
+
+        stdout = io.StringIO()
+        call_command('downloadfits', batch_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Queued 3 downloads')
+        self.assertEqual(
+            [call.args[0] for call in download_fits_batch_delay.call_args_list],
+            [[stars[0].id, stars[1].id], [stars[3].id]],
+        )
+
+        # Already claimed
+        call_command('downloadfits', stdout=io.StringIO())
+        self.assertEqual(download_fits_batch_delay.call_count, 2)
+
+
+def counter_value(name):
+    return Counter.get_values([name]).get(name)
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTestCase(TestCase):
+    def test_task_metrics_recorded(self):
+        @metrics.instrumented
+        def generate_export():
+            with metrics.timer('fold'):
+                pass
+            with metrics.timer('fold'):
+                pass
+            metrics.increment('export_rows', 10)
+
+        with self.assertLogs('starcatalogue.metrics', 'INFO') as logs:
+            generate_export()
+            generate_export()
+
+        self.assertEqual(counter_value(metrics.task_key('task_runs_total', 'generate_export')), 2)
+        self.assertIsNone(counter_value(metrics.task_key('task_failures_total', 'generate_export')))
+        self.assertEqual(counter_value(metrics.stage_key('stage_seconds_count', 'fold')), 4)
+        self.assertEqual(counter_value(metrics.counter_key('export_rows')), 20)
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['task'], 'generate_export')
+        self.assertEqual(record['stages']['fold']['count'], 2)
+        self.assertEqual(record['counters'], {'export_rows': 10})
+
+    def test_failures_recorded(self):
+        @metrics.instrumented
+        def download_fits():
+            raise OSError()
+
+        with self.assertLogs('starcatalogue.metrics', 'INFO'), self.assertRaises(OSError):
+            download_fits()
+        self.assertEqual(counter_value(metrics.task_key('task_failures_total', 'download_fits')), 1)
+
+    def test_disabled(self):
+        @metrics.instrumented
+        def generate_export():
+            self.assertIsNone(metrics.current_metrics())
+            with metrics.timer('fold'):
+                metrics.increment('export_rows')
+
+        with override_settings(METRICS_ENABLED=False):
+            generate_export()
+        self.assertIsNone(counter_value(metrics.task_key('task_runs_total', 'generate_export')))
+        self.assertIsNone(counter_value(metrics.counter_key('export_rows')))
+
+    def test_format_metric(self):
+        lines = []
+        metrics.format_metric(lines, 'stage_seconds', 'summary', 'Stage time', [
+            ('_sum', {'stage': 'fold'}, 1.5),
+            ('_count', {'stage': 'fold'}, 3),
+        ])
+        self.assertEqual(lines, [
+            '# HELP vespa_stage_seconds Stage time',
+            '# TYPE vespa_stage_seconds summary',
+            'vespa_stage_seconds_sum{stage="fold"} 1.5',
+            'vespa_stage_seconds_count{stage="fold"} 3',
+        ])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MetricsViewTestCase(ResponseCacheMixin, TestCase):
+
+    def test_disabled(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_metrics(self):
+        make_catalogue(3)
+        ArtifactJob.claim(ArtifactJob.FITS, 1)
+
+        @metrics.instrumented
+        def generate_all_star_images():
+            metrics.increment('images_rendered', 2)
+
+        with self.assertLogs('starcatalogue.metrics', 'INFO'):
+            generate_all_star_images()
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.METRICS_CONTENT_TYPE)
+        lines = response.content.decode().splitlines()
+        self.assertIn('vespa_task_seconds_count{task="generate_all_star_images"} 1', lines)
+        self.assertIn('vespa_images_rendered_total 2', lines)
+        self.assertIn('vespa_backlog_stars_missing_fits 3', lines)
+        self.assertIn('vespa_artifact_jobs{kind="FITS download",state="Queued"} 1', lines)
+        self.assertIn('vespa_response_cache_hits_total{cache="browse"} 0', lines)
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_restricted(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='192.0.2.1').status_code, 403)
+        with override_settings(METRICS_ALLOWED_IPS=['192.0.2.1']):
+            self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='192.0.2.1').status_code, 200)
+
+        self.client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='192.0.2.1').status_code, 200)
+
+
+class FoldingTestCase(SimpleTestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(0)
+        self.hjd = numpy.sort(rng.uniform(2453005.5, 2453005.5 + 4 * 365, 5000))
+        self.flux = rng.normal(1000, 20, 5000)
+        # TDB, so that astropy doesn't account for leap seconds
+        self.timeseries = TimeSeries(
+            time=Time(self.hjd, format='jd', scale='tdb'),
+            data={'TAMFLUX2': self.flux},
+        )
+
+    def assertPhasesEqual(self, phase, expected):
+        difference = numpy.abs(phase - expected)
+        # Phases either side of a cycle boundary are equivalent
+        numpy.testing.assert_allclose(numpy.minimum(difference, 1 - difference), 0, atol=1e-8)
+
+    def test_fold_phase_matches_astropy(self):
+        for period in (0.1, 1.2345, 30.0):
+            for epoch in (self.hjd[0], self.hjd[123]):
+                folded = self.timeseries.fold(
+                    period=period * units.day,
+                    epoch_time=Time(epoch, format='jd', scale='tdb'),
+                    normalize_phase=True,
+                    wrap_phase=1,
+                )
+                phase = fold_phase(self.hjd, period, epoch)
+                self.assertTrue(((phase >= 0) & (phase < 1)).all())
+                self.assertPhasesEqual(phase, folded.time.value)
+
+    def test_tile_cycles(self):
+        phase = fold_phase(self.hjd, 1.5)
+        flux = numpy.ma.masked_greater(self.flux, 1040)
+        tiled_phase, tiled_flux = tile_cycles(phase, flux, cycles=3)
+        self.assertEqual(len(tiled_phase), 15000)
+        numpy.testing.assert_array_equal(tiled_phase[10000:], phase + 2)
+        numpy.testing.assert_array_equal(tiled_flux.mask[5000:10000], flux.mask)
+
+    def test_fold_lightcurve_matches_legacy_images(self):
+        period_length = 86400 * 1.2345
+        phase, flux = fold_lightcurve(self.hjd, self.flux, period_length)
+        legacy_phase, legacy_flux = legacy_fold_lightcurve(self.timeseries, period_length)
+        numpy.testing.assert_allclose(phase, legacy_phase.value, atol=1e-3)
+        numpy.testing.assert_array_equal(flux, legacy_flux)
+
+
+class StandInResolver(object):
+    """
+    Resolves a fixed set of names, and counts how often it's asked. It's
+    unavailable when asked for "Sesame is down".
+    """
+    NAMES = {
+        'rr lyrae': SkyCoord('19h25m27.9s +42d47m03.7s'),
+    }
+    calls = 0
+
+    def resolve(self, name):
+        StandInResolver.calls += 1
+        name = ' '.join(name.split()).lower()
+        if name == 'sesame is down':
+            raise NameResolverUnavailable('Request took longer than the allowed 10.0 seconds')
+        return self.NAMES.get(name)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    NAME_RESOLVER_BACKEND='starcatalogue.tests.StandInResolver',
+)
+class NameResolverTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        name_cache.clear()
+        StandInResolver.calls = 0
+
+    def test_resolve_name_is_cached(self):
+        coords = resolve_name('RR Lyrae')
+        self.assertAlmostEqual(coords.ra.deg, 291.36625)
+        self.assertEqual(resolve_name('rr  lyrae').dec.deg, coords.dec.deg)
+        self.assertEqual(StandInResolver.calls, 1)
+
+        name_cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(resolve_name('RR Lyrae').ra.deg, coords.ra.deg)
+        self.assertEqual(StandInResolver.calls, 1)
+
+    def test_unresolved_names_are_cached(self):
+        self.assertIsNone(resolve_name('Not a star'))
+        self.assertIsNone(resolve_name('Not a star'))
+        self.assertEqual(StandInResolver.calls, 1)
+        self.assertIsNone(ResolvedName.objects.get(name='not a star').location)
+
+        name_cache.clear()
+        ResolvedName.objects.update(updated=timezone.now() - datetime.timedelta(days=2))
+        self.assertIsNone(resolve_name('Not a star'))
+        self.assertEqual(StandInResolver.calls, 2)
+
+    def test_unavailable_resolver_not_cached(self):
+        for i in range(2):
+            with self.assertRaises(NameResolverUnavailable):
+                resolve_name('Sesame is down')
+        self.assertEqual(StandInResolver.calls, 2)
+        self.assertFalse(ResolvedName.objects.exists())
+
+        response = self.client.get(reverse('browse'), {'search': 'Sesame is down'})
+        self.assertEqual(response.status_code, 503)
+
+    def test_sesame_errors(self):
+        with mock.patch('starcatalogue.resolvers.SkyCoord.from_name') as from_name:
+            from_name.side_effect = NameResolveError("Unable to find coordinates for name 'x' using url")
+            self.assertIsNone(SesameResolver().resolve('x'))
+            from_name.side_effect = NameResolveError('All Sesame queries failed. Unable to retrieve coordinates.')
+            with self.assertRaises(NameResolverUnavailable):
+                SesameResolver().resolve('x')
+
+    def test_browse_search_resolves_once(self):
+        make_catalogue(3)
+        for page_params in ({}, {'sort': 'period_length'}, {'order': 'desc'}):
+            response = self.client.get(reverse('browse'), {'search': 'RR Lyrae', **page_params})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(StandInResolver.calls, 1)
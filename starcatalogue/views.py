@@ -1,31 +1,77 @@
 from astropy.coordinates import SkyCoord
-from astropy.coordinates.name_resolve import NameResolveError
-from astropy import units as u
 
 from celery.result import AsyncResult
 
 from django.conf import settings
-from django.db.models import Q, F
-from django.http import HttpResponseRedirect, HttpResponseBadRequest
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
 from django.views.generic.base import TemplateView
 from django.views.generic.list import ListView
 from django.views.generic import DetailView
 from django.views import View
 
-from starcatalogue.models import Star, FoldedLightcurve, DataExport
+from starcatalogue.api import (
+    API_DEFAULT_FORMAT,
+    API_FORMATS,
+    CatalogueStream,
+    parse_fields,
+    parse_limit,
+)
+from starcatalogue.models import CatalogueEntry, DataExport, FoldedLightcurve, Star
+from starcatalogue.caching import (
+    RESPONSE_CACHE_TIMEOUT,
+    catalogue_generation,
+    record_lookup,
+    star_generation,
+    versioned_key,
+)
+from starcatalogue.counts import CachedCountPaginator
+from starcatalogue.cursors import CursorPage, decode_cursor, encode_cursor, seek
 from starcatalogue.fields import Distance
+from starcatalogue.metrics import METRICS_CONTENT_TYPE, metrics_enabled, render_metrics
+from starcatalogue.rendering import compose_sprite, webp_supported
+from starcatalogue.resolvers import NameResolverUnavailable, resolve_name
+from starcatalogue.votable import (
+    VOTABLE_CONTENT_TYPE,
+    ConeSearchError,
+    ConeSearchStream,
+    error_votable,
+    parse_cone_search,
+)
 
 
 class StarListView(ListView):
     paginate_by = 20
+    template_name = 'starcatalogue/foldedlightcurve_list.html'
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except NameResolverUnavailable:
+            # Rather than no results, which would look like the name doesn't exist
+            return HttpResponse(
+                'The object name resolver is unavailable. Please try again later, or search by coordinates.',
+                status=503,
+            )
 
     def get_queryset(self, params=None):
         if params is None:
             params = self.request.GET
 
-        qs = FoldedLightcurve.objects.all()
+        qs = CatalogueEntry.objects.select_related('lightcurve__zooniversesubject')
 
         try:
             self.min_period = float(params.get('min_period', None))
@@ -67,7 +113,7 @@ class StarListView(ListView):
         try:
             self.min_magnitude = float(params.get('min_magnitude', None))
             if self.min_magnitude:
-                qs = qs.filter(star___mean_magnitude__gte=self.min_magnitude)
+                qs = qs.filter(mean_magnitude__gte=self.min_magnitude)
             else:
                 # To ensure it's None rather than ''
                 self.min_magnitude = None
@@ -77,7 +123,7 @@ class StarListView(ListView):
         try:
             self.max_magnitude = float(params.get('max_magnitude', None))
             if self.max_magnitude:
-                qs = qs.filter(star___mean_magnitude__lte=self.max_magnitude)
+                qs = qs.filter(mean_magnitude__lte=self.max_magnitude)
             else:
                 # To ensure it's None rather than ''
                 self.max_magnitude = None
@@ -137,33 +183,35 @@ class StarListView(ListView):
                 try:
                     self.coords = SkyCoord(self.search)
                 except ValueError:
-                    try:
-                        self.coords = SkyCoord.from_name(self.search, parse=True)
-                    except NameResolveError:
-                        pass
+                    self.coords = resolve_name(self.search)
                 
             if self.coords is None:
                 qs = qs.none()
             else:
                 qs = qs.filter(Q(
-                    star__location__inradius=(
+                    location__inradius=(
                         (self.coords.ra.to_value(), self.coords.dec.to_value()),
                         self.search_radius
                     )
                 ))
 
-        sort_fields = (
-            'distance',
-            'star__superwasp_id',
-            'period_length',
-            'classification',
-            'star___mean_magnitude',
-            'star___max_magnitude',
-            'star___min_magnitude'
-        )
+        # Keys are the sort values used in URLs
+        sort_fields = {
+            'distance': 'distance',
+            'star__superwasp_id': 'superwasp_id',
+            'period_length': 'period_length',
+            'classification': 'classification',
+            'star___mean_magnitude': 'mean_magnitude',
+            'star___max_magnitude': 'max_magnitude',
+            'star___min_magnitude': 'min_magnitude',
+        }
         self.sort = params.get('sort', None)
         if self.sort not in sort_fields:
-            self.sort = sort_fields[0]
+            self.sort = 'distance'
+        if self.sort == 'distance' and self.coords is None:
+            # Without a search, distance means nothing, so fall back to an
+            # ordering which can be read straight from an index.
+            self.sort = 'star__superwasp_id'
 
         self.order = params.get('order', None)
         if self.order == 'desc':
@@ -172,17 +220,88 @@ class StarListView(ListView):
             order_prefix = ''
             self.order = 'asc' # To ditch any invalid values
         
-        if self.coords is None:
-            self.coords = SkyCoord(0,0, unit=u.deg)
+        self.count_params = {
+            'min_period': self.min_period,
+            'max_period': self.max_period,
+            'min_magnitude': self.min_magnitude,
+            'max_magnitude': self.max_magnitude,
+            'period_uncertainties': sorted(enabled_uncertainties),
+            'classifications': sorted(enabled_types),
+            'search': (
+                round(self.coords.ra.deg, 6),
+                round(self.coords.dec.deg, 6),
+                self.search_radius,
+            ) if self.coords is not None else None,
+        }
 
-        qs = qs.annotate(
-            distance=Distance('star__location', (
+        if self.coords is not None:
+            # Only cone searches need the distance. Sorting by it gives a
+            # KNN scan of the location index.
+            qs = qs.annotate(distance=Distance('location', (
                 self.coords.ra.to_value(), self.coords.dec.to_value(),
-            )),
-        ).order_by('{}{}'.format(order_prefix, self.sort))
+            )))
+
+        # Ties are broken by pk, so that pages are stable and cursors can
+        # seek in the (column, pk) indexes
+        self.sort_column = sort_fields[self.sort]
+        qs = qs.order_by(
+            '{}{}'.format(order_prefix, self.sort_column),
+            '{}pk'.format(order_prefix),
+        )
+
+        self.cursor = params.get('cursor', None)
 
         return qs
 
+    def paginate_queryset(self, queryset, page_size):
+        """
+        With a cursor param (which may be empty, for the first page), pages
+        are fetched by seeking past the previous page's last row, so that
+        each page costs the same however deep it is. Otherwise the usual
+        numbered pages are used.
+        """
+        if self.cursor is None:
+            return super().paginate_queryset(queryset, page_size)
+
+        descending = self.order == 'desc'
+        after = None
+        if self.cursor:
+            try:
+                after = decode_cursor(self.cursor, self.sort, self.order)
+            except ValueError:
+                raise Http404('Invalid cursor')
+
+        rows = seek(queryset, self.sort_column, descending, after, page_size)
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            last = rows[-1]
+            next_cursor = encode_cursor(self.sort, self.order, getattr(last, self.sort_column), last.pk)
+        page = CursorPage(rows, self.cursor, next_cursor)
+        return (None, page, page.object_list, page.has_other_pages())
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super().render_to_response(context, **response_kwargs)
+        page = context.get('page_obj')
+        if isinstance(page, CursorPage) and page.has_next():
+            params = self.request.GET.copy()
+            params['cursor'] = page.next_cursor
+            response['Link'] = '<{}?{}>; rel="next"'.format(
+                self.request.build_absolute_uri(self.request.path),
+                params.urlencode(),
+            )
+        return response
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        return CachedCountPaginator(
+            queryset,
+            per_page,
+            self.count_params,
+            orphans=orphans,
+            allow_empty_first_page=allow_empty_first_page,
+            **kwargs,
+        )
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['min_period'] = self.min_period
@@ -201,9 +320,154 @@ class StarListView(ListView):
         context['coords'] = self.coords
         context['sort'] = self.sort
         context['order'] = self.order
+        context['export_formats'] = available_export_formats()
+        context['sprite_url'] = self.get_sprite_url(context['page_obj'])
+        context['results_html'] = self.get_results_html(context)
 
         return context
 
+    def canonical_params(self, page):
+        """
+        Returns query params for the page which are the same for every
+        request with the same filters, sort and page, and which select the
+        same rows.
+        """
+        params = {}
+        for name in ('min_period', 'max_period', 'min_magnitude', 'max_magnitude'):
+            if getattr(self, name) is not None:
+                params[name] = getattr(self, name)
+        for name in (
+            'certain_period',
+            'uncertain_period',
+            'type_pulsator',
+            'type_rotator',
+            'type_ew',
+            'type_eaeb',
+            'type_unknown',
+        ):
+            if getattr(self, name) == 'on':
+                params[name] = 'on'
+        if self.coords is not None:
+            # Coordinates rather than a name, so that they needn't be resolved
+            params['search'] = self.coords.to_string('hmsdms', precision=6)
+            params['search_radius'] = self.search_radius
+        params['sort'] = self.sort
+        params['order'] = self.order
+        if self.cursor is None:
+            params['page'] = page.number
+        else:
+            params['cursor'] = self.cursor
+        return params
+
+    def get_sprite_url(self, page):
+        if not settings.BROWSE_THUMBNAIL_SPRITES:
+            return None
+        if self.search and self.coords is None:
+            # Nothing was found, so there are no thumbnails
+            return None
+        params = self.canonical_params(page)
+        # Changes whenever the thumbnails might have, so that browsers can
+        # cache the sprite for as long as the page
+        params['generation'] = catalogue_generation()
+        return '{}?{}'.format(reverse('browse_sprite'), urlencode(params))
+
+    def get_results_html(self, context):
+        """
+        Renders the results listing, caching it under the canonical query
+        params so that repeat hits don't query or render the page's rows.
+        """
+        key = versioned_key('catalogue-results', dict(
+            self.count_params,
+            sort=self.sort,
+            order=self.order,
+            page=context['page_obj'].number,
+            cursor=self.cursor,
+            show_distance=bool(self.search),
+        ), catalogue_generation())
+        results_html = cache.get(key)
+        record_lookup('browse', results_html is not None)
+        if results_html is None:
+            results_html = render_to_string(
+                'starcatalogue/results.html',
+                context,
+                request=self.request,
+            ).strip()
+            cache.set(key, results_html, RESPONSE_CACHE_TIMEOUT)
+        return mark_safe(results_html)
+
+
+class ThumbnailSpriteView(StarListView):
+    """
+    Serves the rendered thumbnails for a page of results as a single image,
+    one THUMBNAIL_SIZE cell per row in the page's order, so that the compact
+    listing needs one request rather than one per row. WebP is served to
+    browsers which accept it.
+    """
+
+    def get(self, request, *args, **kwargs):
+        image_format = 'png'
+        if 'image/webp' in request.META.get('HTTP_ACCEPT', '') and webp_supported():
+            image_format = 'webp'
+
+        queryset = self.get_queryset()
+        key = versioned_key('catalogue-sprite', dict(
+            self.count_params,
+            sort=self.sort,
+            order=self.order,
+            page=request.GET.get('page'),
+            cursor=self.cursor,
+            format=image_format,
+        ), catalogue_generation())
+        sprite = cache.get(key)
+        record_lookup('sprite', sprite is not None)
+        if sprite is None:
+            _, _, entries, _ = self.paginate_queryset(queryset, self.get_paginate_by(queryset))
+            sprite = compose_sprite([entry.listing_thumbnail_path for entry in entries], image_format)
+            cache.set(key, sprite, RESPONSE_CACHE_TIMEOUT)
+
+        response = HttpResponse(sprite, content_type=f'image/{image_format}')
+        response['Vary'] = 'Accept'
+        response['Cache-Control'] = f'public, max-age={RESPONSE_CACHE_TIMEOUT}'
+        return response
+
+
+class CatalogueAPIView(StarListView):
+    """
+    Streams the catalogue entries matching the same params as the browse
+    pages, as NDJSON or JSON. fields selects the fields of each row, and
+    limit how many are returned; the next_cursor at the end of a response
+    is passed as the cursor param to continue from there.
+    """
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        response_format = request.GET.get('format', API_DEFAULT_FORMAT)
+        if response_format not in API_FORMATS:
+            return HttpResponseBadRequest('Unknown format')
+        try:
+            fields = parse_fields(request.GET.get('fields'), distance=self.coords is not None)
+            limit = parse_limit(request.GET.get('limit'))
+            after = None
+            if self.cursor:
+                after = decode_cursor(self.cursor, self.sort, self.order)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        stream = CatalogueStream(
+            queryset,
+            fields,
+            self.sort,
+            self.order,
+            self.sort_column,
+            after=after,
+            limit=limit,
+        )
+        if response_format == 'json':
+            content = stream.json()
+        else:
+            content = stream.ndjson()
+        return StreamingHttpResponse(content, content_type=API_FORMATS[response_format])
+
 
 class IndexListView(StarListView):
     template_name = 'starcatalogue/index.html'
@@ -239,6 +503,10 @@ class GenerateExportView(View):
             if not search_radius:
                 search_radius = None
 
+            export_format = DataExport.FORMAT_CHOICES_DICT[request.POST.get('export_format', 'CSV')]
+            if export_format not in available_export_formats().values():
+                raise ValueError('Export format not available')
+
             export, created = DataExport.objects.get_or_create(
                 data_version=settings.DATA_VERSION,
                 min_period = min_period,
@@ -254,6 +522,7 @@ class GenerateExportView(View):
                 type_unknown = DataExport.CHECKBOX_CHOICES_DICT[request.POST.get('type_unknown', 'on')],
                 search = request.POST.get('search', None),
                 search_radius = search_radius,
+                export_format = export_format,
             )
             if (
                 export.export_status in (export.STATUS_PENDING, export.STATUS_FAILED) 
@@ -262,7 +531,7 @@ class GenerateExportView(View):
                 export.celery_task_id = generate_export.delay(export.id).id
                 export.save()
             return HttpResponseRedirect(reverse('view_export', kwargs={'pk': export.id.hex}))
-        except (ValueError, TypeError):
+        except (ValueError, TypeError, KeyError):
             return HttpResponseBadRequest('Bad Request')
 
 
@@ -276,5 +545,65 @@ class SourceView(DetailView):
     def get_object(self, queryset=None):
         return get_object_or_404(self.model, superwasp_id=self.kwargs['swasp_id'])
 
+    def get(self, request, *args, **kwargs):
+        swasp_id = self.kwargs['swasp_id']
+        key = versioned_key('source', {'swasp_id': swasp_id}, star_generation(swasp_id))
+        content = cache.get(key)
+        record_lookup('source', content is not None)
+        if content is not None:
+            return HttpResponse(content)
+
+        response = super().get(request, *args, **kwargs)
+        response.render()
+        # Pages still waiting on a download or images are left uncached so
+        # that later hits pick up the results, and queue whatever's missing.
+        if self.object.derived_data_current:
+            cache.set(key, response.content, RESPONSE_CACHE_TIMEOUT)
+        else:
+            self.object.queue_derived_data()
+        return response
+
+
+class ConeSearchView(View):
+    """
+    An IVOA Simple Cone Search service, returning the catalogue entries
+    within SR degrees of (RA, DEC) as a VOTable. No more than
+    SCS_MAX_RECORDS entries are returned, whatever MAXREC asks for.
+    """
+
+    def get(self, request, *args, **kwargs):
+        # Parameter names are case-insensitive
+        params = {name.upper(): value for name, value in request.GET.items()}
+        try:
+            ra, dec, sr, verb, limit = parse_cone_search(params, settings.SCS_MAX_RECORDS)
+        except ConeSearchError as e:
+            # Errors are reported in the VOTable, with a 200 status
+            return HttpResponse(error_votable(str(e)), content_type=VOTABLE_CONTENT_TYPE)
+
+        # Both the cone and the ordering by distance are answered from the
+        # location index
+        queryset = CatalogueEntry.objects.filter(
+            location__inradius=((ra, dec), sr),
+        ).annotate(
+            distance=Distance('location', (ra, dec)),
+        ).order_by('distance', 'pk')
+        return StreamingHttpResponse(
+            ConeSearchStream(queryset, verb, limit),
+            content_type=VOTABLE_CONTENT_TYPE,
+        )
+
+
+class MetricsView(View):
+    """
+    Serves the metrics to staff, and to scrapers at METRICS_ALLOWED_IPS.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not metrics_enabled():
+            raise Http404('Metrics are disabled')
+        if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS):
+            raise PermissionDenied()
+        return HttpResponse(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
 
-from .tasks import generate_export
\ No newline at end of file
+from .tasks import available_export_formats, generate_export
\ No newline at end of file
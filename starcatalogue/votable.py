@@ -0,0 +1,225 @@
+import base64
+import itertools
+import math
+import struct
+
+from collections import namedtuple
+from xml.sax.saxutils import escape, quoteattr
+
+from .models import FoldedLightcurve
+
+
+SCS_CHUNK_SIZE = 2000
+SCS_DEFAULT_VERB = 2
+VOTABLE_CONTENT_TYPE = 'text/xml; content=x-votable; charset=utf-8'
+
+# Base64 lines of 76 characters
+BASE64_LINE_BYTES = 57
+BASE64_CHUNK_BYTES = BASE64_LINE_BYTES * 1024
+
+VOTableField = namedtuple('VOTableField', ('name', 'datatype', 'unit', 'ucd', 'verb', 'description'))
+
+# In column order. A field is included when VERB is at least its verb; the
+# three verb 1 fields are the ones Simple Cone Search requires, with the
+# UCD1 words it requires them to have.
+SCS_FIELDS = (
+    VOTableField('superwasp_id', 'char', None, 'ID_MAIN', 1, 'The unique identifier for the source'),
+    VOTableField('ra', 'double', 'deg', 'POS_EQ_RA_MAIN', 1, 'Right ascension (ICRS)'),
+    VOTableField('dec', 'double', 'deg', 'POS_EQ_DEC_MAIN', 1, 'Declination (ICRS)'),
+    VOTableField('distance', 'double', 'deg', 'pos.angDistance', 2, 'Distance from the search position'),
+    VOTableField('period_length', 'double', 's', 'time.period', 2, 'The period length'),
+    VOTableField('mean_magnitude', 'double', 'mag', 'phot.mag;stat.mean', 2, 'The mean magnitude for this source'),
+    VOTableField('classification', 'char', None, 'meta.code.class', 2, 'The candidate variable star type'),
+    VOTableField('max_magnitude', 'double', 'mag', 'phot.mag;stat.max', 3, 'The brightest magnitude for this source'),
+    VOTableField('min_magnitude', 'double', 'mag', 'phot.mag;stat.min', 3, 'The least bright magnitude for this source'),
+    VOTableField(
+        'classification_count', 'int', None, 'meta.number', 3,
+        'How many Zooniverse classifications this entry received',
+    ),
+    VOTableField(
+        'period_uncertainty', 'char', None, 'meta.code.qual', 3,
+        'Whether the correctness of this period is certain or uncertain',
+    ),
+    VOTableField('sigma', 'double', None, 'stat.error', 3, 'Sigma error estimate from original period search'),
+    VOTableField('chi_squared', 'double', None, 'stat.fit.chi2', 3, 'Chi squared error estimate from original period search'),
+)
+
+# The catalogue columns which aren't read straight into a field
+SCS_COLUMNS = ('location', 'distance', 'pk')
+
+
+class ConeSearchError(Exception):
+    pass
+
+
+def parse_float(params, name, minimum, maximum):
+    try:
+        value = float(params[name])
+    except KeyError:
+        raise ConeSearchError(f'{name} is required')
+    except ValueError:
+        raise ConeSearchError(f'{name} must be a number')
+    if math.isnan(value) or not minimum <= value <= maximum:
+        raise ConeSearchError(f'{name} must be between {minimum} and {maximum}')
+    return value
+
+
+def parse_cone_search(params, max_records):
+    """
+    Returns (ra, dec, sr, verb, limit) from Simple Cone Search params, where
+    limit is MAXREC capped at max_records. Raises ConeSearchError if they're
+    missing or invalid.
+    """
+    ra = parse_float(params, 'RA', 0, 360)
+    dec = parse_float(params, 'DEC', -90, 90)
+    sr = parse_float(params, 'SR', 0, 180)
+
+    try:
+        verb = int(params.get('VERB') or SCS_DEFAULT_VERB)
+    except ValueError:
+        raise ConeSearchError('VERB must be 1, 2 or 3')
+    if verb not in (1, 2, 3):
+        raise ConeSearchError('VERB must be 1, 2 or 3')
+
+    limit = max_records
+    if params.get('MAXREC'):
+        try:
+            limit = int(params['MAXREC'])
+        except ValueError:
+            raise ConeSearchError('MAXREC must be an integer')
+        if limit < 0:
+            raise ConeSearchError('MAXREC must not be negative')
+        limit = min(limit, max_records)
+    return ra, dec, sr, verb, limit
+
+
+def verb_fields(verb):
+    return [field for field in SCS_FIELDS if field.verb <= verb]
+
+
+def encode_row(fields, values):
+    """
+    Encodes a row in the BINARY2 serialization: a bit per field which is
+    set for NULLs, then each value. Strings are variable length.
+    """
+    mask = bytearray((len(fields) + 7) // 8)
+    parts = [mask]
+    for i, (field, value) in enumerate(zip(fields, values)):
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            mask[i // 8] |= 0x80 >> (i % 8)
+        if field.datatype == 'char':
+            data = (value or '').encode('ascii', 'replace')
+            parts.append(struct.pack('>I', len(data)))
+            parts.append(data)
+        elif field.datatype == 'int':
+            parts.append(struct.pack('>i', 0 if value is None else value))
+        else:
+            parts.append(struct.pack('>d', math.nan if value is None else value))
+    return b''.join(parts)
+
+
+def base64_lines(chunks):
+    """
+    Base64 encodes an iterable of bytes in pieces, yielding whole lines as
+    they're filled.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= BASE64_CHUNK_BYTES:
+            size = len(buffer) - len(buffer) % BASE64_LINE_BYTES
+            yield base64.encodebytes(bytes(buffer[:size])).decode()
+            del buffer[:size]
+    if buffer:
+        yield base64.encodebytes(bytes(buffer)).decode()
+
+
+def field_xml(field):
+    attrs = {
+        'ID': field.name,
+        'name': field.name,
+        'datatype': field.datatype,
+        'ucd': field.ucd,
+    }
+    if field.datatype == 'char':
+        attrs['arraysize'] = '*'
+    if field.unit is not None:
+        attrs['unit'] = field.unit
+    if field.name in ('ra', 'dec'):
+        attrs['ref'] = 'icrs'
+    attr_text = ' '.join(f'{name}={quoteattr(value)}' for name, value in attrs.items())
+    return f'<FIELD {attr_text}><DESCRIPTION>{escape(field.description)}</DESCRIPTION></FIELD>\n'
+
+
+def votable_header(description):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">\n'
+        f'<DESCRIPTION>{escape(description)}</DESCRIPTION>\n'
+    )
+
+
+def error_votable(message):
+    """
+    Returns a VOTable reporting an error, in both the Simple Cone Search 1.03
+    and DALI forms.
+    """
+    return (
+        votable_header('VeSPA Simple Cone Search')
+        + f'<INFO ID="Error" name="Error" value={quoteattr(message)}/>\n'
+        + '<RESOURCE type="results">\n'
+        + f'<INFO name="QUERY_STATUS" value="ERROR">{escape(message)}</INFO>\n'
+        + '</RESOURCE>\n</VOTABLE>\n'
+    )
+
+
+class ConeSearchStream(object):
+    """
+    Streams a VOTable of up to limit catalogue entries, nearest first, with
+    the rows in a base64 BINARY2 stream. Rows are read from a server-side
+    cursor in chunks, so memory use doesn't depend on the cone size. If more
+    than limit entries match, the table is followed by an OVERFLOW status.
+    """
+
+    def __init__(self, queryset, verb, limit, chunk_size=SCS_CHUNK_SIZE):
+        self.queryset = queryset
+        self.fields = verb_fields(verb)
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.overflow = False
+
+    def rows(self):
+        columns = set(SCS_COLUMNS)
+        columns.update(field.name for field in self.fields if field.name not in ('ra', 'dec'))
+        rows = self.queryset.values(*columns).iterator(chunk_size=self.chunk_size)
+        return itertools.islice(rows, self.limit + 1)
+
+    def encoded_rows(self):
+        classifications = dict(FoldedLightcurve.CLASSIFICATION_CHOICES)
+        period_uncertainties = dict(FoldedLightcurve.PERIOD_UNCERTAINTY_CHOICES)
+        for count, row in enumerate(self.rows()):
+            if count == self.limit:
+                self.overflow = True
+                return
+            row['ra'], row['dec'] = row['location']
+            row['distance'] = math.degrees(row['distance'])
+            if 'classification' in row:
+                row['classification'] = classifications.get(row['classification'])
+            if 'period_uncertainty' in row:
+                row['period_uncertainty'] = period_uncertainties.get(row['period_uncertainty'])
+            yield encode_row(self.fields, [row[field.name] for field in self.fields])
+
+    def __iter__(self):
+        yield votable_header('VeSPA Simple Cone Search')
+        yield '<RESOURCE type="results">\n'
+        yield '<INFO name="QUERY_STATUS" value="OK"/>\n'
+        yield '<COOSYS ID="icrs" system="ICRS"/>\n'
+        yield '<TABLE name="results">\n'
+        for field in self.fields:
+            yield field_xml(field)
+        yield '<DATA><BINARY2><STREAM encoding="base64">\n'
+        yield from base64_lines(self.encoded_rows())
+        yield '</STREAM></BINARY2></DATA>\n</TABLE>\n'
+        if self.overflow:
+            yield '<INFO name="QUERY_STATUS" value="OVERFLOW"/>\n'
+        yield '</RESOURCE>\n</VOTABLE>\n'
@@ -5,6 +5,7 @@ if [ "$DJANGO_ENV" == "production" ]; then
   
   echo Applying migrations
   python manage.py migrate --noinput
+  python manage.py createcachetable
   if [ ! -d "vespa/static" ]; then
     echo Generating static files
     python manage.py collectstatic --clear --no-input
@@ -14,6 +15,7 @@ if [ "$DJANGO_ENV" == "production" ]; then
 else
   echo Applying migrations
   python manage.py migrate --noinput
+  python manage.py createcachetable
   echo Starting development server
   exec python manage.py runserver 0:8080
 fi
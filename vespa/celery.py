@@ -5,6 +5,8 @@ from celery import Celery
 from django.conf import settings
 from django.db.models import Q
 
+from starcatalogue.metrics import instrumented
+
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vespa.settings')
@@ -20,50 +22,73 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
+# Stars are claimed for magnitude calculations for this long, so that ones
+# which are still queued aren't queued again by the next run
+STATS_QUEUE_INTERVAL = 3600
+
 @app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
     sender.add_periodic_task(3600, queue_image_generations.s())
-    sender.add_periodic_task(3600, calculate_magnitudes.s())
+    sender.add_periodic_task(STATS_QUEUE_INTERVAL, calculate_magnitudes.s())
     sender.add_periodic_task(3600, set_locations.s())
+    sender.add_periodic_task(3600, refresh_catalogue.s())
 
 @app.task
+@instrumented
 def queue_image_generations():
-    from starcatalogue.models import Star, FoldedLightcurve
-    for star in Star.objects.filter(
+    from starcatalogue.models import ArtifactJob, Star, FoldedLightcurve
+    from starcatalogue.tasks import generate_all_star_images
+    star_ids = set(Star.objects.filter(
         fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
     ).filter(
         Q(image_version=None) 
         | Q(image_version__lt=Star.CURRENT_IMAGE_VERSION)
-    )[:1000]:
-        star.get_image_location()
+    ).values_list('id', flat=True)[:1000])
 
-    for lightcurve in FoldedLightcurve.objects.filter(
+    star_ids.update(FoldedLightcurve.objects.filter(
         star__fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
     ).filter(
         Q(image_version=None) 
         | Q(image_version__lt=FoldedLightcurve.CURRENT_IMAGE_VERSION)
-    )[:1000]:
-        lightcurve.get_image_location()
+    ).values_list('star_id', flat=True).distinct()[:1000])
+
+    for star_id in star_ids:
+        if ArtifactJob.claim(ArtifactJob.STAR_IMAGES, star_id):
+            generate_all_star_images.delay(star_id)
 
 @app.task
+@instrumented
 def calculate_magnitudes():
-    from starcatalogue.models import Star
-    for star in Star.objects.filter(
-        fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
-    ).filter(
-        Q(fits_file__isnull=False)
-        & (
-            Q(_min_magnitude__isnull=True)
-            | Q(_max_magnitude__isnull=True)
-            | Q(_mean_magnitude__isnull=True)
-            | Q(stats_version__lt=Star.CURRENT_STATS_VERSION)
-            | Q(stats_version__isnull=True)
+    from django.utils import timezone
+    from starcatalogue.models import ArtifactJob
+    from starcatalogue.stats import STATS_CHUNK_SIZE, stale_stats_stars
+    from starcatalogue.tasks import calculate_star_magnitudes
+    claimed = ArtifactJob.objects.filter(
+        kind=ArtifactJob.STATS,
+        lease_expires__gt=timezone.now(),
+    ).values('object_id')
+    star_ids = ArtifactJob.claim_many(
+        ArtifactJob.STATS,
+        stale_stats_stars().exclude(id__in=claimed).order_by('id').values_list('id', flat=True)[:10000],
+        lease_seconds=STATS_QUEUE_INTERVAL,
+    )
+    for i in range(0, len(star_ids), STATS_CHUNK_SIZE):
+        # Chunks which haven't run by the time their claims expire are
+        # dropped, and queued again by the next run
+        calculate_star_magnitudes.apply_async(
+            (star_ids[i:i + STATS_CHUNK_SIZE],),
+            expires=STATS_QUEUE_INTERVAL,
         )
-    )[:1000]:
-        star.calculate_magnitudes()
 
 @app.task
+@instrumented
 def set_locations():
     from starcatalogue.models import Star
-    for star in Star.objects.filter(location=None)[:1000]:
-        star.set_location()
\ No newline at end of file
+    Star.update_locations(Star.missing_locations()[:10000])
+
+@app.task
+@instrumented
+def refresh_catalogue():
+    # Picks up magnitudes and locations calculated since the last refresh
+    from starcatalogue.models import CatalogueEntry
+    CatalogueEntry.refresh()
@@ -28,10 +28,14 @@ urlpatterns = [
     path('exoplanets/', TemplateView.as_view(template_name='waspstatic/exoplanets.html'), name='exoplanets'),
     path('vespa/', starcatalogue.views.IndexListView.as_view(), name='vespa'),
     path('vespa/browse/', starcatalogue.views.StarListView.as_view(), name='browse'),
+    path('vespa/browse/sprite/', starcatalogue.views.ThumbnailSpriteView.as_view(), name='browse_sprite'),
+    path('vespa/api/catalogue/', starcatalogue.views.CatalogueAPIView.as_view(), name='catalogue_api'),
+    path('vespa/scs/', starcatalogue.views.ConeSearchView.as_view(), name='cone_search'),
     path('vespa/download/', starcatalogue.views.DownloadView.as_view(), name='download'),
     path('vespa/export/', starcatalogue.views.GenerateExportView.as_view(), name='generate_export'),
     path('vespa/export/<str:pk>/', starcatalogue.views.DataExportView.as_view(), name='view_export'),
     path('vespa/source/<str:swasp_id>/', starcatalogue.views.SourceView.as_view(), name='view_source'),
+    path('metrics', starcatalogue.views.MetricsView.as_view(), name='metrics'),
     path('about/', waspstatic.views.AboutView.as_view(), name='about'),
     path('admin/', admin.site.urls),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file